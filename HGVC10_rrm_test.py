@@ -99,6 +99,17 @@ import arcpy   # New for ArcGIS v.10
 from arcpy import env
 from arcpy.sa import *
 
+# NumPy engines (kept alongside this script)
+import numpy
+import raster_io
+import map_algebra
+import flood_geometry
+import preprocess_cache
+import segment_catalog
+import terrain
+import valley_width
+import vector_io
+
 arcpy.ResetEnvironments()
 
 ####################################################################################
@@ -167,6 +178,38 @@ delete_temp = "NO"  # Delete files from /temp folder
 diff_tol = 0.1         # Acceptible tolerance for % diff btw Q_est & Q_calc
 flood_min = 0.5     # Minimum flood elevation (think of as vertical resolution of DEM)
 iter_max = 4        # Num. of iterations w/ depth lower then flood_min before exiting Q100 calculations
+algebra_engine = "NUMPY"    # "NUMPY" = fused NumPy map algebra (map_algebra.py), "ARCGIS" = Spatial Analyst tools
+fused_chunk_rows = 1024     # Rows per block for fused (single pass) cell-wise map algebra
+terrain_engine = "NUMPY"    # "NUMPY" = slope and total curvature of the whole DEM in one pass (terrain.py), "ARCGIS" = Slope + per-block Curvature
+flood_engine = "NUMPY"      # "NUMPY" = flood geometry from one height-above-channel field per block (needs window_engine "NUMPY"), "ARCGIS" = CostDistance + SurfaceVolume per depth
+flood_max_depth = 30.0      # Height above channel (m) the NUMPY flood search first stops at (the 0-30 flood reclass range); searched deeper when a flood needs it
+depth_solver = "ILLINOIS"   # "ILLINOIS" = bracketed Illinois iteration on the stage table (needs flood_engine "NUMPY"), "LEGACY" = Divisor schedule
+solver_max_iter = 50        # Maximum discharge evaluations of the ILLINOIS depth solver
+cache_folder = userworkfolder + '/cache/stage'   # Cache of the per-segment flood stage tables, apart from the ValleySegs grids (None = no cache)
+cache_max_gb = 5.0          # Stage table cache size limit; least recently used tables are deleted beyond it
+window_engine = "NUMPY"     # "NUMPY" = read each block's window of the inputs and mask it in memory, "ARCGIS" = ExtractByMask
+window_margin = 10.0        # Margin (m) read around each block's extent by the NUMPY window engine
+width_engine = "NUMPY"      # "NUMPY" = valley widths from the edge cells of the block's valley masks (needs flood_engine "NUMPY"), "ARCGIS" = PolygonToLine + ZonalStatistics per valley type
+save_dfs = False            # True = save each block's distance to stream raster (temp/seg/DFS_S#####)
+hillslope_engine = "NUMPY"  # "NUMPY" = hillslope class areas from a histogram of the slope window (needs window_engine "NUMPY"), "ARCGIS" = Reclassify + RasterToPolygon per side
+save_hillslope_cats = True  # Build the Hillslope_categories.shp polygons (the NUMPY hillslope engine needs none to classify)
+
+# The NUMPY flood geometry works on the segment and slope windows of the NUMPY window engine
+if flood_engine == "NUMPY" and window_engine != "NUMPY":
+    print '  ERROR: flood_engine = "NUMPY" needs window_engine = "NUMPY"'
+    sys.exit(1)
+
+# The ILLINOIS solver brackets the depth on the NUMPY stage table; without it the Divisor schedule runs
+if depth_solver == "ILLINOIS" and flood_engine != "NUMPY":
+    print '  NOTICE: depth_solver = "ILLINOIS" needs flood_engine = "NUMPY", using the LEGACY solver'
+
+# The NUMPY widths are measured on the valley masks of the NUMPY flood engine
+if width_engine == "NUMPY" and flood_engine != "NUMPY":
+    print '  NOTICE: width_engine = "NUMPY" needs flood_engine = "NUMPY", using the ARCGIS widths'
+
+# The NUMPY hillslope classes count the cells of the NUMPY slope window
+if hillslope_engine == "NUMPY" and window_engine != "NUMPY":
+    print '  NOTICE: hillslope_engine = "NUMPY" needs window_engine = "NUMPY", using the ARCGIS hillslope classes'
 
 # &&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 ##userworkspace = sys.argv[1]        # Folder used to store data                            
@@ -254,15 +297,24 @@ tempExtent = dataset.Extent
     # C. Create channel raster and channel bankfull-width shapefile
 ##try:
 try:
-    # Calculate bankfull channel width raster
-    strm_accum = ExtractByMask(da_km, strm_cells)
-    strm_accum.save(userworkspace + '/temp' + '/strm_accum')  # Accumulation of stream cells (in km2)
+    if algebra_engine == "NUMPY":
+        # Calculate bankfull channel width raster in one block-wise pass (no strm_accum/strm_power rasters)
+        graph = map_algebra.Graph(raster_io.describe_raster(da_km))
+        da_km_n = graph.source('da_km', raster_io.RasterRows(da_km))
+        strm_cells_n = graph.source('strm_cells', raster_io.RasterRows(strm_cells))
+        graph.output((graph.ExtractByMask(da_km_n, strm_cells_n) ** beta) * alpha, userworkspace + '/strm_wdth')
+        graph.run(fused_chunk_rows)
+        strm_wdth = Raster(userworkspace + '/strm_wdth')    # Bankfull channel width - raster
+    else:
+        # Calculate bankfull channel width raster
+        strm_accum = ExtractByMask(da_km, strm_cells)
+        strm_accum.save(userworkspace + '/temp' + '/strm_accum')  # Accumulation of stream cells (in km2)
 
-    strm_power = Power(strm_accum, beta)
-    strm_power.save(userworkspace + '/temp' + '/strm_power')  # Intermediate calculation step
+        strm_power = Power(strm_accum, beta)
+        strm_power.save(userworkspace + '/temp' + '/strm_power')  # Intermediate calculation step
 
-    strm_wdth = Times(strm_power, alpha)
-    strm_wdth.save(userworkspace + '/strm_wdth')    # Bankfull channel width - raster
+        strm_wdth = Times(strm_power, alpha)
+        strm_wdth.save(userworkspace + '/strm_wdth')    # Bankfull channel width - raster
   
 except:
     arcpy.AddMessage(arcpy.GetMessages(2))
@@ -272,11 +324,22 @@ except:
 # #############################################################################
 # D. Calculate Slope for entire DEM
 
-all_slp_pct = Slope(inDEM, "PERCENT_RISE", "1")
-all_slp_pct.save(userworkspace + '/temp' + '/all_slp_pct')  # slope in pct of entire DEM
-
-all_slp_100 = Raster("temp/all_slp_pct") / 100.0
-all_slp_100.save(userworkspace + '/temp' + '/all_slp_100')  # slope in decimal pct of entire DEM
+if terrain_engine == "NUMPY":
+    # Slope and total curvature of the entire DEM in one chunked 3x3 pass; the block loop
+    #   slices these instead of recomputing curvature on each clipped DEM
+    dem_info = raster_io.describe_raster(inDEM)
+    terrain_grids = terrain.derivatives(raster_io.RasterRows(inDEM), dem_info.shape, dem_info.cell_size,
+                                        ("slope_pct", "slope_dec", "curvature"), fused_chunk_rows)
+    all_slp_pct = raster_io.write_raster(terrain_grids["slope_pct"], dem_info, userworkspace + '/temp' + '/all_slp_pct')  # slope in pct of entire DEM
+    all_slp_100 = raster_io.write_raster(terrain_grids["slope_dec"], dem_info, userworkspace + '/temp' + '/all_slp_100')  # slope in decimal pct of entire DEM
+    all_curv = raster_io.write_raster(terrain_grids["curvature"], dem_info, userworkspace + '/temp' + '/all_curv')  # curvature of entire DEM
+    del terrain_grids
+else:
+    all_slp_pct = Slope(inDEM, "PERCENT_RISE", "1")
+    all_slp_pct.save(userworkspace + '/temp' + '/all_slp_pct')  # slope in pct of entire DEM
+
+    all_slp_100 = Raster("temp/all_slp_pct") / 100.0
+    all_slp_100.save(userworkspace + '/temp' + '/all_slp_100')  # slope in decimal pct of entire DEM
 
 # #############################################################################
 # E. Extract individual stream segments from comprehensive stream segment shapefile  
@@ -287,76 +350,18 @@ inField = "ARCID"
 
 spatialRef = arcpy.Describe(all_slp_100).spatialReference
 
-# Create empty parameter dictionaries for later use
-s_length_dict = {}         # Empty stream length dictionary
-iter_ARCID_dict = {}        # dictionary to match up the loop number (or FID) with the ARCID
-slope_class_dict = {}       # dictionary of slope classes for each stream segment
-
-##try:
-# Open a cursor on the input shape file attribute table
-cursor1 = arcpy.SearchCursor(inShapeFile)
-##    arcpy.GetCount(inShapeFile) = seg_max
-
-# Open a file to track the names of the new shape files
-##    newShapeList = open(userworkspace + '/temp' + '/Stream_Segment_list.txt','w')
-row1 = cursor1.next()
-#print 
-print "Starting separation of stream segments..."
-# print("  Input shape file: " + inShapeFile)
-# print("  Field to be used for separating shapes: " + inField)
-
-n = 0
-val = 0
-
-while row1:
-##    if val+1 > seg_max:
-##        print "  EARLY OUT: Met preset stream segment limit"
-##        break
-    val = row1.getValue(inField)
-    slope_class = row1.getValue("GRID_CODE")
-    val_s = str("%05d" % (val))
-    select_exp = inField + '=' + str(val)
-    select_exp = inField + '=' + str(val)
-    outShapeFile = userworkspace + '/temp/seg' + '/S_' + inBasename + val_s + '.shp'
-##        print("valley_section - New shape file to be created: " + outShapeFile)
-    try:
-        # Put the feature into a new shape file on it's own
-        arcpy.Select_analysis(inShapeFile,outShapeFile,select_exp)
-
-        # Write the new shapefile names and locations to a text file (currently not needed)
-##        print "Stream segment -", outShapeFile, 'exported to', userworkspace
-##            newShapeList.write(userworkspace + '/temp' + '/' + outShapeFile)
-    except:
-        print("  ERROR -   Could not create " + userworkspace + '/temp' + '/' + outShapeFile)
-        break
-
-    # Create a stream length dictionary (val_s, length in m) for later use
-    temp_length = row1.getValue("SLength")
-##        feat = row.shape
-##        temp_length=feat.length
-    s_length_dict[val_s]=temp_length
-
-    # Create a dictionary of iteration_number vs. ARCID of segment (during the editing
-    #   process some segments were deleted, thus there are fewer segments than the number
-    #   of loops necessary to complete the watershed)
-    iter_ARCID_dict[n]=val
-##        print n, ",", iter_ARCID_dict[n]
+# Hold every stream segment and valley block in memory keyed by ARCID, one cursor pass each
+#   (no per-segment S_/B_ shapefiles; each is handed to the block loop as an in_memory feature)
+print "Reading stream segments and valley blocks..."
+seg_features = vector_io.FeatureStore(inShapeFile, inField, ("SLength", "GRID_CODE"))
+blk_features = vector_io.FeatureStore(valley_block, "GRIDCODE")
 
-    # Create a dictionary of stream slope classes
-    slope_class_dict[val_s]=slope_class
-    
-    # Read the next record from the search cursor        
-    row1 = cursor1.next()
-    n += 1
-    
-# Delete the cursors
-del row1
-del cursor1
-
-# Close the file listing the new shape files
-##    newShapeList.close()
+# ARCID, SLength, GRID_CODE, end/mid points and block extent of every segment
+#   (replaces the s_length_dict, slope_class_dict and iter_ARCID_dict dictionaries)
+seg_catalog = segment_catalog.build_catalog(seg_features, blk_features)
+n = len(seg_catalog)
 
-print '  FINISHED separation of', n , 'stream segments'    
+print '  FINISHED reading', n , 'stream segments'    
 
 ##except:
 ##    arcpy.AddMessage(arcpy.GetMessages(2))
@@ -371,186 +376,27 @@ print '  FINISHED separation of', n , 'stream segments'
 print 'Preparing cut lines for hillslopes of 1st order streams'
 # Input/Output files
 inputlines = valley_section
-textfile = userworkspace + '/temp' + '/Segment_Extension.txt'
 outputlines = userworkspace + '/temp' + '/valley_extension' +'.shp'
 ##ext_distance = 0.0
 ext_distance = 20 * hill_buff_dist   # distance to extend stream segments
 
 #print "  Extension distance = " + str(ext_distance)
 
-try:
-    os.remove(textfile)
-except:
-    pass
-
-#Create a text file and write polylines to the first line.
-f = open(textfile,'a')
-thestring = "ARCID,E1S0,x1,y1,x2,y2\n"
-f.writelines(thestring)
-f.close()   
-
-# Create search cursor
-cursor6 = arcpy.SearchCursor(inputlines)
-row6 = cursor6.next()
-
-counter = 0
-#start the row iteration
-n = 0
-val = 0
-while row6:
-    if val+1 > seg_max:
-        print "  EARLY OUT: Met preset stream segment limit"
-        break
-    val = row6.getValue("ARCID")
-##    print '  Working on entry', val
-    # Create the geometry object
-    feat = row6.Shape
-    #get coordinate values as lists
-    firstpoint1 = feat.firstPoint
-    lastpoint1 = feat.lastPoint
-    midpoint1 = feat.centroid
-    #split the lists by the blank space between the coordinate pairs
-    firstpoint = str(firstpoint1).split(" ")
-    lastpoint = str(lastpoint1).split(" ")
-    midpoint = str(midpoint1).split(" ")
-    #get the x and y values as array positions 0 and 1, and convert them to floating point numbers from the native string literals
-    startx = float(firstpoint[0])
-    starty = float(firstpoint[1])
-    endx = float(lastpoint[0])
-    endy = float(lastpoint[1])
-    midx = float(midpoint[0])
-    midy = float(midpoint[1])
-
-##    print '  Start x,y =', str("%d"%(startx)),',',str("%d"%(starty))
-##    print '  Mid x,y =', str("%d"%(midx)),',',str("%d"%(midy))
-##    print '  End x,y =', str("%d"%(endx)),',',str("%d"%(endy))
-
-    # Add 'End' line    
-    #if the line is horizontal or vertical the slope and negreciprocal will fail so do this instead.
-    if endy==midy or endx==midx:
-        if endy == midy:
-            y1 = endy 
-            y2 = endy 
-            x1 = endx 
-            if endx > midx:
-                x2 = endx + ext_distance
-            elif endx < midx:
-                x2 = endx - ext_distance
-        if endx==midx:
-            y1 = endy 
-            x1 = endx 
-            x2 = endx 
-            if endy > midy:
-                y2 = endy + ext_distance
-            elif endy < midy:
-                y2 = endy - ext_distance
-    
-    else:
-        #get the slope of the line
-        m = ((endy - midy)/(endx - midx))
-##        print '  Slope (end) =', m
-        if endy > midy and endx > midx:
-            y1 = endy
-            y2 = endy + (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = endx
-            x2 = endx + (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif endy < midy and endx > midx:
-            y1 = endy
-            y2 = endy - (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = endx
-            x2 = endx + (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif endy < midy and endx < midx:
-            y1 = endy
-            y2 = endy - (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = endx
-            x2 = endx - (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif endy > midy and endx < midx:
-            y1 = endy
-            y2 = endy + (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = endx
-            x2 = endx - (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        else:
-            print "  ERROR - somewhere in end line"
-        
-    f = open(textfile,'a')
-#    thestring = str(val) + " 0\n" + "0 "+ str(x1)+" "+str(y1) + "\n" + "1 " + str(x2) + " " + str(y2) +"\n"
-    thestring = str(val)+", 1, " + str(x1)+", "+str(y1)+", " + str(x2) + ", " + str(y2) +"\n"
-    f.writelines(thestring)
-    f.close()   
-    del x1
-    del x2
-    del y1
-    del y2
-
-##    # Need to increase counter to it builds another text file    
-##    counter = counter + 1
-    
-    # Add 'Start' line    
-    #if the line is horizontal or vertical the slope and negreciprocal will fail so do this instead.
-    if starty==midy or startx==midx:
-        if starty == midy:
-            y1 = starty 
-            y2 = starty 
-            x1 = startx 
-            if startx > midx:
-                x2 = startx + ext_distance
-            elif startx < midx:
-                x2 = startx - ext_distance
-
-        if startx==midx:
-            y1 = starty 
-            x1 = startx 
-            x2 = startx 
-            if starty > midy:
-                y2 = starty + ext_distance
-            elif starty < midy:
-                y2 = starty - ext_distance
-    
-    else:
-        #get the slope of the line
-        m = ((starty - midy)/(startx - midx))
-##        print '  Slope (start) =', m
-        if starty > midy and startx > midx:
-            y1 = starty
-            y2 = starty + (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = startx
-            x2 = startx + (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif starty < midy and startx > midx:
-            y1 = starty
-            y2 = starty - (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = startx
-            x2 = startx + (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif starty < midy and startx < midx:
-            y1 = starty
-            y2 = starty - (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = startx
-            x2 = startx - (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        elif starty > midy and startx < midx:
-            y1 = starty
-            y2 = starty + (((ext_distance**2.0)/(1 + ((1/m)**2.0)))**(0.5))
-            x1 = startx
-            x2 = startx - (((ext_distance**2.0)/(1 + (m**2.0)))**(0.5))
-        else:
-            print "ERROR - somewhere in start line"
-        
-    f = open(textfile,'a')
-##    thestring = str(val) + " 0\n" + "0 "+ str(x1)+" "+str(y1) + "\n" + "1 " + str(x2) + " " + str(y2) +"\n"
-    thestring = str(val)+", 0, " + str(x1)+", "+str(y1)+", " + str(x2) + ", " + str(y2) +"\n"
-    f.writelines(thestring)
-    f.close()   
-    del x1
-    del x2
-    del y1
-    del y2
-    
-    n += 1
-    row6 = cursor6.next()
-
-del row6
-del cursor6
-
-#Write extension line points to a line shapefile
-arcpy.XYToLine_management(textfile,outputlines,"x1","y1","x2","y2","GEODESIC","ARCID", spatialRef)
+# Segments evaluated in this run: start_ARCID <= ARCID <= seg_max (same rows as the block loop)
+run_rows = seg_catalog.select(start_ARCID, seg_max)
+if run_rows.size < len(seg_catalog):
+    print "  EARLY OUT: Met preset stream segment limit,", run_rows.size, "of", len(seg_catalog), "segments"
+
+# End (E1S0 = 1) and start (E1S0 = 0) extensions of all segments, extended away from the centroid
+ext_arcid, ext_e1s0, ext_x1, ext_y1, ext_x2, ext_y2 = segment_catalog.cutline_extensions(
+    seg_catalog.records[run_rows], ext_distance)
+
+#Write extension lines to a line shapefile in one pass
+vector_io.write_polylines(outputlines,
+                          [(a, e, [(x1, y1), (x2, y2)]) for a, e, x1, y1, x2, y2 in
+                           zip(ext_arcid.tolist(), ext_e1s0.tolist(), ext_x1.tolist(), ext_y1.tolist(),
+                               ext_x2.tolist(), ext_y2.tolist())],
+                          [("ARCID", "LONG"), ("E1S0", "SHORT")], spatialRef)
 # 'spatialRef' as defined above for 'all_slp_100 ~Line 263'
 
 print '  Finished creating shapefile from Extensions.'    
@@ -572,48 +418,9 @@ except:
 # ###############################################################
 # G. Extract individual cutlines from comprehensive cutline shapefile
 
-inShapeFile = hill_cut_final
-inField = "ARCID"                       
-
-try:
-    # Open a cursor on the input shape file attribute table
-    cursor5 = arcpy.SearchCursor(inShapeFile)
-
-    # Open a file to track the names of the new shape files
-##    newShapeList = open(userworkspace + '/temp' + '/Stream_Segment_list.txt','w')
-    row = cursor5.next()
-
-    print "Starting separation of hillslope cut lines..."
-    #print("  Input shape file: " + inShapeFile)
-    #print("  Field to be used for separating shapes: " + inField)
-
-    n = 0
-    val = 0
-    while row:
-        if val+1 > seg_max:
-            print "  EARLY OUT: Met preset stream segment limit"
-            break
-        val = row.getValue(inField)
-        val_s = str("%05d" % (val))
-        select_exp = inField + '=' + str(val)
-        outShapeFile = userworkspace + '/temp/seg' + '/CL_' + inBasename + val_s + '.shp'
-        # Put the feature into a new shape file on it's own
-        try:
-            arcpy.Select_analysis(inShapeFile,outShapeFile,select_exp)
-        except:
-            print("ERROR -   Could not create " + userworkspace + '/temp' + '/' + outShapeFile)
-            break
-
-        # Read the next record from the search cursor        
-        row = cursor5.next()
-        n += 1
-        
-    # Delete the cursors
-    del cursor5
-    del row
-except:
-    arcpy.AddMessage(arcpy.GetMessages(2))
-    print arcpy.GetMessages(2)
+# Cutlines are held in memory keyed by ARCID (no per-segment CL_ shapefiles)
+print "Reading hillslope cut lines..."
+cut_features = vector_io.FeatureStore(hill_cut_final, "ARCID")
 
 # End of valley cut line 
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
@@ -682,34 +489,34 @@ print 'Begin determination the valley bottom for each valley block'
 inShapeFile = valley_block
 inField = "GRIDCODE"             # Set the fields of interest
 
-##try:
-cursor2 = arcpy.SearchCursor(inShapeFile)
-##newShapeList = open(userworkspace + '/temp' + '/Valley_block_list.txt','w')
-row2 = cursor2.next()
-#print("  Input shape file: " + inShapeFile)
-#print("  Field to be used for separating shapes: " + inField)
-
-step_ARCID = 0
-d = 0
+# Blocks are visited in catalog (ARCID) order, start_ARCID <= ARCID <= seg_max
+block_rows = run_rows[seg_catalog.has_block()[run_rows]]
 if start_ARCID > 1:
     print "  NOTICE - NOT starting at beginning, starting with ARCID", start_ARCID
-while iter_ARCID_dict[d] < start_ARCID:
-    row2 = cursor2.next()
-##    print '    Current ARCID', iter_ARCID_dict[d], 'Start ARCID', start_ARCID
-    d += 1
     
 m=0     #   Starting value for segment limit
 val = 0
 
+# Window readers of the block inputs (all on the grid of the DEM)
+if window_engine == "NUMPY":
+    dem_reader = raster_io.RasterRows(inDEM)
+    slp_reader = raster_io.RasterRows(all_slp_100)
+    wdth_reader = raster_io.RasterRows(strm_wdth)
+    q100_reader = raster_io.RasterRows(Q100_raster)
+
+# Cache of the flood stage tables, keyed on the DEM, segments, blocks and the settings they depend on
+stage_cache = None
+if flood_engine == "NUMPY" and cache_folder is not None:
+    stage_cache = preprocess_cache.StageCache(cache_folder, cache_max_gb * 1024 ** 3, flush_every=50)
+    stage_inputs = (preprocess_cache.file_digest(inDEM), preprocess_cache.file_digest(valley_section),
+                    preprocess_cache.file_digest(valley_block), terrain_engine, window_margin, flood_max_depth)
+
 midtime = datetime.datetime.now()  # used to note start time of model run        
-while row2:
+b = 0
+while b < block_rows.size:
+    seg = seg_catalog.records[block_rows[b]]
 ##        print "top loop"
 ##    try:
-    if val +1 > seg_max: # m is the row number of the current segment
-        print 
-        print "  EARLY OUT: Met preset stream segment limit"
-        break
-
     print '----------------------------'
     
     # Reset Extent to full Extent of DEM
@@ -719,29 +526,21 @@ while row2:
     arcpy.env.extent = inDEM_sh
 
     # Extract name of block from 'inField'
-    val = row2.getValue(inField)\
+    val = int(seg['ARCID'])
     #open('last-segment.txt','w+').write(str(int(val + 1)))  #Added by RSAC, incorrect syntax (and I don't know what it does)
     val_s = str("%05d" % (val))
     select_exp = inField + '=' + str(val)
 
     print "#" + str(m+1) + " Valley Section for ARCID", val_s
 
-    # Define name for new individual valley block (toggle permanent name to keep)
-    outShapeFile = userworkspace + '/temp/seg' + '/B_' + inBasename + val_s + '.shp'
-##        outShapeFile = userworkspace + '/temp' + '/block' + '.shp'
-    stream_segment = userworkspace + '/temp/seg' + '/S_' + inBasename + val_s + '.shp'  # referencing previously established files, can't make intermediate
-    block_buff = userworkspace + '/temp' + '/block_buff.shp'
-    # next copy the selected shape into a new shape file
-##        try:
-    arcpy.Select_analysis(inShapeFile,outShapeFile,select_exp)
-##        newShapeList.write(userworkspace + '/' + outShapeFile)
-    arcpy.Buffer_analysis(outShapeFile, block_buff, "10.0", "FULL", "FLAT", "NONE")
-        #print "    Valley Block exported"
-##        except:
-##            print("  ERROR - COULD NOT CREATE " + outShapeFile)
+    # Hand the valley block and its stream segment to the tools as in_memory features
+    outShapeFile = blk_features.write(val, 'in_memory/block')
+    stream_segment = seg_features.write(val, 'in_memory/stream_segment')
+    blk_box = (seg['blk_xmin'], seg['blk_ymin'], seg['blk_xmax'], seg['blk_ymax'])
+    blk_extent = vector_io.extent_string(blk_box)
 
-    # Reset Extent to Extent of outShapeFile
-    arcpy.env.extent = block_buff #Added and removed 6/11/2014
+    # Reset Extent to Extent of outShapeFile buffered by 10 m (the extent of the former block_buff)
+    arcpy.env.extent = vector_io.extent_string(blk_box, 10.0) #Added and removed 6/11/2014
 
 ##        dataset = arcpy.Describe(outShapeFile)
 ##        tempExtent = dataset.Extent
@@ -750,12 +549,25 @@ while row2:
 # #######################################################################
 #   J. Extract DEM and hillslopes by valley block
 
-    outDEM = ExtractByMask(inDEM, outShapeFile)
-    outDEM.save(userworkspace + '/temp' + '/outDEM')
+    if window_engine == "NUMPY":
+        # Read only the block's window of each input and mask the block (and stream segment) in memory
+        dem_win, win_info = dem_reader.read_box(blk_box, window_margin)
+        blk_mask = raster_io.polygon_mask(vector_io.geometry_parts(blk_features[val]), win_info)
+        seg_mask = raster_io.polyline_mask(vector_io.geometry_parts(seg_features[val]), win_info)
+        dem_win[~blk_mask] = numpy.nan
+        outDEM = raster_io.write_raster(dem_win, win_info, userworkspace + '/temp' + '/outDEM')
+
+        # Extract decimal slope by valley block    
+        slp_win = slp_reader.read_box(blk_box, window_margin)[0]
+        slp_win[~blk_mask] = numpy.nan
+        slope_pct_100 = raster_io.write_raster(slp_win, win_info, userworkspace + '/temp' + '/slope_pct_100')
+    else:
+        outDEM = ExtractByMask(inDEM, outShapeFile)
+        outDEM.save(userworkspace + '/temp' + '/outDEM')
 
-    # Extract decimal slope by valley block    
-    slope_pct_100 = ExtractByMask(all_slp_100, outShapeFile)
-    slope_pct_100.save(userworkspace + '/temp' + '/slope_pct_100')
+        # Extract decimal slope by valley block    
+        slope_pct_100 = ExtractByMask(all_slp_100, outShapeFile)
+        slope_pct_100.save(userworkspace + '/temp' + '/slope_pct_100')
 ##        slope_pct_100.save(userworkspace + '/temp/seg' + '/SP1_' + inBasename + val_s) ## DB: 6/9/2014 saves unique version
 
 # #######################################################################
@@ -764,19 +576,24 @@ while row2:
 
     print '  Calculating Q100 for stream block...'  
 
-    # Retrieve  stream length from s_length_dict    
+    # Retrieve  stream length from the segment catalog
     try:
-        s_length = float(s_length_dict[val_s])
+        s_length = float(seg['SLength'])
 ##            print '    Stream Length =', str(s_length)[:8]
     except:
         print '  ERROR - Could not retreive valley length for ', val_s
 
     # Pull Q100 value for each segment from Q100_raster
-    Q100_stream = ExtractByMask(Q100_raster, stream_segment)
-    Q100_stream.save(userworkspace + '/temp' + '/Q100_stream')
+    if window_engine == "NUMPY":
+        q100_seg = q100_reader.read_box(blk_box, window_margin)[0][seg_mask]
+        q100_seg = q100_seg[~numpy.isnan(q100_seg)]
+        Q100 = float(q100_seg.max()) if q100_seg.size else 0.0 # RSCAC changed "Mean" to "Maximum"
+    else:
+        Q100_stream = ExtractByMask(Q100_raster, stream_segment)
+        Q100_stream.save(userworkspace + '/temp' + '/Q100_stream')
 
-    Q100val = arcpy.GetRasterProperties_management(Q100_stream, "Maximum") # RSCAC changed "Mean" to "Maximum"
-    Q100 = float(Q100val.getOutput(0))
+        Q100val = arcpy.GetRasterProperties_management(Q100_stream, "Maximum") # RSCAC changed "Mean" to "Maximum"
+        Q100 = float(Q100val.getOutput(0))
     
     #print '    Length =', str(s_length)[:8],' Q100 =', str(Q100)[:6]
     if Q100 == 0.0:
@@ -802,12 +619,24 @@ while row2:
     file_loc = userworkspace + '/temp/seg' + '/SV_' + val_s + '.txt'
 
     # Extract stream DEM and calculate slope using 'rise over run'
-    s_dem = ExtractByMask(outDEM, stream_segment)
-    s_dem.save(userworkspace + '/temp' + '/s_dem')
-    elev_min_result = arcpy.GetRasterProperties_management(s_dem, "Minimum")
-    elev_max_result = arcpy.GetRasterProperties_management(s_dem, "Maximum")
-    elev_min = float(elev_min_result.getOutput(0))
-    elev_max = float(elev_max_result.getOutput(0))
+    if window_engine == "NUMPY":
+        s_dem = dem_win[seg_mask]
+        s_dem = s_dem[~numpy.isnan(s_dem)]
+        if s_dem.size:
+            elev_min = float(s_dem.min())
+            elev_max = float(s_dem.max())
+        else:
+            # The segment covers no DEM cell of the block: fall back to the minimum slope below
+            print "    ERROR reading stream DEM, segment slope set to 0.1%"
+            elev_min = 0.0
+            elev_max = 0.0
+    else:
+        s_dem = ExtractByMask(outDEM, stream_segment)
+        s_dem.save(userworkspace + '/temp' + '/s_dem')
+        elev_min_result = arcpy.GetRasterProperties_management(s_dem, "Minimum")
+        elev_max_result = arcpy.GetRasterProperties_management(s_dem, "Maximum")
+        elev_min = float(elev_min_result.getOutput(0))
+        elev_max = float(elev_max_result.getOutput(0))
     slope = (elev_max - elev_min) / s_length
     
     #print '    elev_min =', str(elev_min)[:6], 'elev_max', str(elev_max)[:6], 'slope =', str(slope)[:6]
@@ -818,141 +647,193 @@ while row2:
         print "    NOTICE: DEM Slope = 0, therefore assigned slope of 0.1% (0.001)"
     flagForContinue = False
 
-    # Iterate Manning's equation to converge on Q_est
-    try:
-        while (Q_diff > diff_tol) and q <= iter_max:
-##                print "loop here"
-    ##        print "Q_diff = " + str(Q_diff)
-
-            # Limit number of iterations to converge on Q
-            if n >= 12:
-                print "  EARLY OUT:  Met iteration limit"
+    if flood_engine == "NUMPY":
+        # Stage table of the block: height above channel (cost distance from the segment over
+        #   the decimal slope) of its cells, sorted once; the flood geometry of each trial
+        #   depth is looked up in it
+        cached = None
+        if stage_cache is not None:
+            stage_key = stage_cache.key('stage', stage_inputs, val)
+            cached = stage_cache.get(stage_key)
+        if cached is not None:
+            flood = flood_geometry.StageTable(cached)
+        else:
+            flood = flood_geometry.stage_table(seg_mask, slp_win, win_info.cell_size, flood_max_depth)
+        stored_flood = flood if cached is not None else None    # Table written to the cache after the BiS flood
+        del cached
+
+    if depth_solver == "ILLINOIS" and flood_engine == "NUMPY":
+        # Bracketed Illinois iteration on the stage table (no Divisor schedule or clamps)
+        flood_depth0 = flood_depth
+        while True:
+            flood_depth, Q_calc, n, Q_resid, solver_status = flood_geometry.solve_depth(
+                flood, Q_est, s_length, slope, mannings_n, flood_depth0, flood_min, diff_tol, solver_max_iter)
+            if solver_status != "beyond_table":
                 break
-            elif q > iter_max:
-                n = 11  # must be n-1 iteration limit above
-                flood_depth = flood_min
-                print "  NOTICE: Flood Depth below vertical accuracy limits of DEM."
-                #print "  Q100 depth set to " + str(flood_min)
-
-            # Provide escape if flood raster is only a single cell wide (hence all
-            #   cells in it have a value of zero, and the volume is zero)
-            p = 0
-    ##            class zero_volume(Exception):
-    ##                pass
-            while Volume == 0.0:
-                if p == 0:
-                    pass
-                elif p > 3:
-                    print "    ERROR - Unable to find depth that gives non-zero flood volume"
+            # The flood reaches past the heights searched: search the block out to twice this
+            #   depth (the true depth is below it) and solve again
+            print '    NOTICE: depth', str(flood_depth)[:6], 'is beyond the flood search of', str(flood.max_depth)[:6], 'm, searching deeper'
+            flood = flood_geometry.deepen(flood, seg_mask, slp_win, win_info.cell_size, 2.0 * flood_depth)
+        Q_diff = abs(Q_resid)
+        flood_depth_old = flood_depth
+        flood_raster_depth = flood_depth
+        Area_2D, Area_3D, Volume = flood.geometry(flood_depth)
+        Q100width = Area_2D / s_length
+        print '    Depth solver:', solver_status, 'after', n, 'evaluations, residual =', str(Q_resid)[:7]
+        if solver_status == "min_depth":
+            print "    NOTICE: Q100 convergance on depth below vertical tolerance of DEM. depth(Q100) set to " + str(flood_min)[:3] + "m"
+        try:
+            flog.write("  ARCID " + val_s + " depth solver " + solver_status + ", evaluations = " + str(n) +
+                       ", residual = " + str(Q_resid) + '\n')
+        except:
+            print '    ERROR: writing to log file'
+    else:
+        # Iterate Manning's equation to converge on Q_est
+        try:
+            while (Q_diff > diff_tol) and q <= iter_max:
+    ##                print "loop here"
+        ##        print "Q_diff = " + str(Q_diff)
+
+                # Limit number of iterations to converge on Q
+                if n >= 12:
+                    print "  EARLY OUT:  Met iteration limit"
+                    break
+                elif q > iter_max:
+                    n = 11  # must be n-1 iteration limit above
                     flood_depth = flood_min
-                    Q_calc = 0.0
-                    break  # need to find a way to pass the remainder of Manning's loop
-    ##                    raise zero_volume
-                else:
-                    print "    CAUTION - Envoking Zero Volume Loop, step", p, 'D =', str(flood_depth)[:5]
-                    flood_depth = flood_depth * 1.5
-
-                # Build flood raster (Norman's flood simulator)
-                arcpy.Extent = "MAXOF"
-                flood_raster = CostDistance(stream_segment, slope_pct_100, flood_depth)
-                #flood_raster.save(userworkspace + '/temp/seg' '/F_' + inBasename + val_s) # Don't need flood raster saved for each
-                flood_raster.save(userworkspace + '/temp' '/Flood_r')
-
-                # Extract flood geometry with Surface Volume
-                arcpy.SurfaceVolume_3d(flood_raster, file_loc, "ABOVE", "0")
-
-                # Read output from Surface Area Tool
-                FO = open(file_loc)
-                SA = csv.DictReader(FO)
-        ##        SA = csv.DictReader(open(file_loc)) 
-                for row in SA:
-                    Area_2D = float(row[' Area_2D'])
-                    Area_3D = float(row[' Area_3D'])
-                    Volume = float(row[' Volume'])
-        ##        print "   ", str("%d"%(Area_2D)), str("%d"%(Area_3D)), str("%d"%(Volume)), file_loc
-
-                # Close SurfaceVolume output file
-                FO.close() 
-                p +=1
-
-            # Preliminary calculations for Manning's Eq   
-            flood_vol = (Area_2D * flood_depth)- Volume 
-            xc_area = flood_vol / s_length
-            wtd_perimeter = Area_3D / s_length
-            hyd_radius = xc_area / wtd_perimeter
-            Q100width = Area_2D / s_length
+                    print "  NOTICE: Flood Depth below vertical accuracy limits of DEM."
+                    #print "  Q100 depth set to " + str(flood_min)
+
+                # Provide escape if flood raster is only a single cell wide (hence all
+                #   cells in it have a value of zero, and the volume is zero)
+                p = 0
+        ##            class zero_volume(Exception):
+        ##                pass
+                while Volume == 0.0:
+                    if p == 0:
+                        pass
+                    elif p > 3:
+                        print "    ERROR - Unable to find depth that gives non-zero flood volume"
+                        flood_depth = flood_min
+                        Q_calc = 0.0
+                        break  # need to find a way to pass the remainder of Manning's loop
+        ##                    raise zero_volume
+                    else:
+                        print "    CAUTION - Envoking Zero Volume Loop, step", p, 'D =', str(flood_depth)[:5]
+                        flood_depth = flood_depth * 1.5
+
+                    if flood_engine == "NUMPY":
+                        # Flood geometry of this depth from the block's stage table
+                        Area_2D, Area_3D, Volume = flood.geometry(flood_depth)
+                        flood_raster_depth = flood_depth
+                        p +=1
+                        continue
+
+                    # Build flood raster (Norman's flood simulator)
+                    arcpy.Extent = "MAXOF"
+                    flood_raster = CostDistance(stream_segment, slope_pct_100, flood_depth)
+                    #flood_raster.save(userworkspace + '/temp/seg' '/F_' + inBasename + val_s) # Don't need flood raster saved for each
+                    flood_raster.save(userworkspace + '/temp' '/Flood_r')
+
+                    # Extract flood geometry with Surface Volume
+                    arcpy.SurfaceVolume_3d(flood_raster, file_loc, "ABOVE", "0")
+
+                    # Read output from Surface Area Tool
+                    FO = open(file_loc)
+                    SA = csv.DictReader(FO)
+            ##        SA = csv.DictReader(open(file_loc)) 
+                    for row in SA:
+                        Area_2D = float(row[' Area_2D'])
+                        Area_3D = float(row[' Area_3D'])
+                        Volume = float(row[' Volume'])
+            ##        print "   ", str("%d"%(Area_2D)), str("%d"%(Area_3D)), str("%d"%(Volume)), file_loc
+
+                    # Close SurfaceVolume output file
+                    FO.close() 
+                    p +=1
+
+                # Preliminary calculations for Manning's Eq   
+                flood_vol = (Area_2D * flood_depth)- Volume 
+                xc_area = flood_vol / s_length
+                wtd_perimeter = Area_3D / s_length
+                hyd_radius = xc_area / wtd_perimeter
+                Q100width = Area_2D / s_length
         
-            # Manning's equation calculations and comparison with Q_est
-            Q_calc = (1 / mannings_n) * (hyd_radius**(0.66666666)) * xc_area * (slope**(0.5))
-            Q_diff = abs((Q_est - Q_calc) / Q_est)
+                # Manning's equation calculations and comparison with Q_est
+                Q_calc = (1 / mannings_n) * (hyd_radius**(0.66666666)) * xc_area * (slope**(0.5))
+                Q_diff = abs((Q_est - Q_calc) / Q_est)
 
-            # Adjust flood depth for next iteration   
-            if n < 5:
-                Divisor = 2
-            else:
-                Divisor *= 1.4
-            Q_compare = ((Q_calc - Q_est) / (Q_calc)) # Used to adust flood_depth in next step
-            flood_depth_old = flood_depth   # Store previous flood depth for reporting purposes
-            flood_depth = ((1+(Q_compare/-Divisor))*flood_depth_old)     # Bisection type convergance equation  
+                # Adjust flood depth for next iteration   
+                if n < 5:
+                    Divisor = 2
+                else:
+                    Divisor *= 1.4
+                Q_compare = ((Q_calc - Q_est) / (Q_calc)) # Used to adust flood_depth in next step
+                flood_depth_old = flood_depth   # Store previous flood depth for reporting purposes
+                flood_depth = ((1+(Q_compare/-Divisor))*flood_depth_old)     # Bisection type convergance equation  
                 
-            #print '    Loop',n,': Q=',str("%f"%(Q_calc)),'d=',str("%f"% (flood_depth_old)),"d_new=", str("%f"%(flood_depth))
-
-            # Limit new flood depth to no more than 3x more or less than the previous step
-            if (flood_depth / flood_depth_old ) > 3.0:
-                flood_depth_temp = flood_depth
-                flood_depth = (flood_depth_temp**(0.5))
-                #print '      ADJUSTED: New depth of ',str(flood_depth_temp)[:5],'too great, adjusted to',str(flood_depth)[:5]
-
-            elif (flood_depth / flood_depth_old ) < 0.3:
-                flood_depth_temp = flood_depth
-    ##                flood_depth = (flood_depth_old/3)
-                flood_depth = flood_depth_temp**(2.0)
-                #print '    ADJUSTED: New depth',str(flood_depth_temp)[:5],'too shallow, adjusted to', str(flood_depth)[:5]
+                #print '    Loop',n,': Q=',str("%f"%(Q_calc)),'d=',str("%f"% (flood_depth_old)),"d_new=", str("%f"%(flood_depth))
+
+                # Limit new flood depth to no more than 3x more or less than the previous step
+                if (flood_depth / flood_depth_old ) > 3.0:
+                    flood_depth_temp = flood_depth
+                    flood_depth = (flood_depth_temp**(0.5))
+                    #print '      ADJUSTED: New depth of ',str(flood_depth_temp)[:5],'too great, adjusted to',str(flood_depth)[:5]
+
+                elif (flood_depth / flood_depth_old ) < 0.3:
+                    flood_depth_temp = flood_depth
+        ##                flood_depth = (flood_depth_old/3)
+                    flood_depth = flood_depth_temp**(2.0)
+                    #print '    ADJUSTED: New depth',str(flood_depth_temp)[:5],'too shallow, adjusted to', str(flood_depth)[:5]
                 
-            # Increment for next step of convergance loop
-            n += 1
-            if flood_depth < flood_min:
-                q += 1
-
-##    except zero_volume:
-##        pass
-    except Exception,e:  #RSAC added 'Exception,e'
-        print "    ERROR - Could not calculate Mannings Equation"
-        print '    Final for',val_s,': Q_calc=', str(Q_calc)[:5], "(", str(Q_est)[:5] ,"), Q_diff=", str(Q_diff)[:6]
-        arcpy.AddMessage(arcpy.GetMessages(2))
-        print arcpy.GetMessages(2)
-        flagForContinue = True  #Added by RSAC
-        raise e  #Added by RSAC
+                # Increment for next step of convergance loop
+                n += 1
+                if flood_depth < flood_min:
+                    q += 1
+
+    ##    except zero_volume:
+    ##        pass
+        except Exception,e:  #RSAC added 'Exception,e'
+            print "    ERROR - Could not calculate Mannings Equation"
+            print '    Final for',val_s,': Q_calc=', str(Q_calc)[:5], "(", str(Q_est)[:5] ,"), Q_diff=", str(Q_diff)[:6]
+            arcpy.AddMessage(arcpy.GetMessages(2))
+            print arcpy.GetMessages(2)
+            flagForContinue = True  #Added by RSAC
+            raise e  #Added by RSAC
 
     if flood_depth_old < flood_min:
         print "    NOTICE: Q100 convergance on depth below vertical tolerance of DEM. depth(Q100) set to " + str(flood_min)[:3] + "m"
         flood_depth = flood_min
         flood_depth_old = flood_min
-        # Build flood raster (Norman's flood simulator)
-        arcpy.Delete_management(flood_raster)    
-        flood_raster = CostDistance(stream_segment, slope_pct_100, flood_depth)
-        ###flood_raster.save(userworkspace + '/temp/seg' '/F_' + inBasename + val_s) #Don't need flood raster saved for each
-        flood_raster.save(userworkspace + '/temp' '/Flood_r')
-
-        # Extract flood geometry with Surface Volume
-        try:
-            os.remove(file_loc)
-        except:
-            print "    Could not delete ", file_loc
-        arcpy.SurfaceVolume_3d(flood_raster, file_loc, "ABOVE", "0")
-
-        # Read output from Surface Area Tool
-        FO = open(file_loc)
-        SA = csv.DictReader(FO)
-##        SA = csv.DictReader(open(file_loc)) 
-        for row in SA:
-            Area_2D = float(row[' Area_2D'])
-            Area_3D = float(row[' Area_3D'])
-            Volume = float(row[' Volume'])
-##        print "   ", str("%d"%(Area_2D)), str("%d"%(Area_3D)), str("%d"%(Volume)), file_loc
-
-        # Close SurfaceVolume output file
-        FO.close() 
+        if flood_engine == "NUMPY":
+            Area_2D, Area_3D, Volume = flood.geometry(flood_depth)
+            flood_raster_depth = flood_depth
+        else:
+            # Build flood raster (Norman's flood simulator)
+            arcpy.Delete_management(flood_raster)    
+            flood_raster = CostDistance(stream_segment, slope_pct_100, flood_depth)
+            ###flood_raster.save(userworkspace + '/temp/seg' '/F_' + inBasename + val_s) #Don't need flood raster saved for each
+            flood_raster.save(userworkspace + '/temp' '/Flood_r')
+
+            # Extract flood geometry with Surface Volume
+            try:
+                os.remove(file_loc)
+            except:
+                print "    Could not delete ", file_loc
+            arcpy.SurfaceVolume_3d(flood_raster, file_loc, "ABOVE", "0")
+
+            # Read output from Surface Area Tool
+            FO = open(file_loc)
+            SA = csv.DictReader(FO)
+    ##        SA = csv.DictReader(open(file_loc)) 
+            for row in SA:
+                Area_2D = float(row[' Area_2D'])
+                Area_3D = float(row[' Area_3D'])
+                Volume = float(row[' Volume'])
+    ##        print "   ", str("%d"%(Area_2D)), str("%d"%(Area_3D)), str("%d"%(Volume)), file_loc
+
+            # Close SurfaceVolume output file
+            FO.close() 
             
         # Preliminary calculations for Manning's Eq   
         flood_vol = (Area_2D * flood_depth)- Volume 
@@ -966,6 +847,13 @@ while row2:
             
         #print '    Loop',n,': Q=',str("%f"%(Q_calc)),'d=',str("%f"% (flood_depth))
 
+    if flood_engine == "NUMPY" and flood_depth > flood.max_depth:
+        print "    WARNING: depth(Q100) is beyond the flood search of " + str(flood.max_depth)[:6] + "m, geometry beyond it is not included"
+        try:
+            flog.write("  ARCID " + val_s + " depth " + str(flood_depth) + " beyond flood search of " + str(flood.max_depth) + '\n')
+        except:
+            print '    ERROR: writing to log file'
+
     # Report final values for 
     print '    Final for',val_s,': Q_calc=', str(Q_calc)[:5], "Q_diff=", str(Q_diff)[:5], "Width =", str(Q100width)[:4]
 
@@ -976,8 +864,17 @@ while row2:
     
     # Create Shapefile for upper limits of valley width (based upon Q100)
     reclassifyRanges = "0.000000 30.000000 1"   # Set the reclassify ranges
-    vw_upper = Reclassify(flood_raster, "Value", reclassifyRanges, "NODATA")
-    vw_upper.save(userworkspace + '/temp' + '/vw_upper')
+    reclass_max = 30.0                          # Upper end of reclassifyRanges
+    if flood_engine == "NUMPY":
+        # Every flood of this block is a threshold of the one cost field in the stage table
+        #   (searched out to the deepest flood needed), so no further CostDistance runs are needed
+        flood_raster = raster_io.write_raster(flood.depth_grid(flood_raster_depth), win_info,
+                                              userworkspace + '/temp' + '/Flood_r')
+        vw_upper = raster_io.write_raster(flood.extent_grid(min(flood_raster_depth, reclass_max)), win_info,
+                                          userworkspace + '/temp' + '/vw_upper')
+    else:
+        vw_upper = Reclassify(flood_raster, "Value", reclassifyRanges, "NODATA")
+        vw_upper.save(userworkspace + '/temp' + '/vw_upper')
 
     # ####################################################################
     # L. Proportionally expand area greater than Q100 for BiS analysis 
@@ -991,23 +888,31 @@ while row2:
     
 # 7/26/2013 DB: Encountering an error in the creation of UL_Flood_ra for some segments (and apparently some model
 # runs.
-    try:
-        UL_flood_ra = CostDistance(stream_segment, slope_pct_100, UL_Depth)    
-        UL_flood_ra.save(userworkspace + '/temp' + '/UL_flood_ra')
-        #print '    Flood raster created...'
+    if flood_engine == "NUMPY":
+        # The upper limit flood may reach past the heights searched so far
+        flood = flood_geometry.deepen(flood, seg_mask, slp_win, win_info.cell_size, UL_Depth)
+        UL_flood_ra = raster_io.write_raster(flood.depth_grid(UL_Depth), win_info,
+                                             userworkspace + '/temp' + '/UL_flood_ra')
+        UL_flood_1 = raster_io.write_raster(flood.extent_grid(min(UL_Depth, reclass_max)), win_info,
+                                            userworkspace + '/temp' + '/UL_flood_1')
+    else:
+        try:
+            UL_flood_ra = CostDistance(stream_segment, slope_pct_100, UL_Depth)    
+            UL_flood_ra.save(userworkspace + '/temp' + '/UL_flood_ra')
+            #print '    Flood raster created...'
 
-    except:
-        UL_flood_ra = vw_upper
-        print '    ERROR in BiS analysis, used Q100(exact) for upper limit instead of 2x' # DB should 
+        except:
+            UL_flood_ra = vw_upper
+            print '    ERROR in BiS analysis, used Q100(exact) for upper limit instead of 2x' # DB should 
 
-# Reclassify the flood_raster to a single value to define the outer limit of the valley edge
-    try:
-        reclassifyRanges = "0.000000 30.000000 1"   # Set the reclassify ranges
-        UL_flood_1 = Reclassify(UL_flood_ra, "Value", reclassifyRanges, "NODATA")
-        UL_flood_1.save(userworkspace + '/temp' + '/UL_flood_1')
-        #print '    Single value flood raster created...'
-    except:
-        print '    ERROR reclassifying UL_flood_ra'
+    # Reclassify the flood_raster to a single value to define the outer limit of the valley edge
+        try:
+            reclassifyRanges = "0.000000 30.000000 1"   # Set the reclassify ranges
+            UL_flood_1 = Reclassify(UL_flood_ra, "Value", reclassifyRanges, "NODATA")
+            UL_flood_1.save(userworkspace + '/temp' + '/UL_flood_1')
+            #print '    Single value flood raster created...'
+        except:
+            print '    ERROR reclassifying UL_flood_ra'
 ##    # &&&&&&&&&&&&&&&&&&&&&&&&
 ##    # TIME TEST FINISH
 ##    finish_time = datetime.now()
@@ -1030,17 +935,27 @@ while row2:
                     #   channel will be excluded from BiS analysis
 
     # Set extent for upper and lower limits to the allocation block for this segment  
-    dataset = arcpy.Describe(outShapeFile)
-    tempExtent = dataset.Extent
+    tempExtent = blk_extent
     arcpy.Extent = tempExtent
 ##    print "tempExtent= ", str(tempExtent)
 
     # Extract and buffer lower limit of stream
-    strm_block = ExtractByMask(strm_wdth, outShapeFile)
-    strm_block.save(userworkspace + '/temp' + '/strm_block')
+    if window_engine == "NUMPY":
+        strm_block = wdth_reader.read_box(blk_box, window_margin)[0][blk_mask]
+        strm_block = strm_block[~numpy.isnan(strm_block)]
+        if strm_block.size:
+            BF_width = float(strm_block.mean())
+        else:
+            # No stream width cell in the block: take the channel as one cell wide
+            BF_width = float(win_info.cell_size)
+            print "    ERROR reading stream width, BF width set to one cell (" + str(BF_width) + " m)"
+            flog.write("  ARCID " + val_s + " stream width missing, BF width set to " + str(BF_width) + " m" + '\n')
+    else:
+        strm_block = ExtractByMask(strm_wdth, outShapeFile)
+        strm_block.save(userworkspace + '/temp' + '/strm_block')
 
-    BF_width_result = arcpy.GetRasterProperties_management (strm_block, "Mean")
-    BF_width = float(BF_width_result.getOutput(0))
+        BF_width_result = arcpy.GetRasterProperties_management (strm_block, "Mean")
+        BF_width = float(BF_width_result.getOutput(0))
 
 ##    # Create a stream length dictionary (val_s, length in m) for later use
 ##    s_BFwidth_dict[val_s]=BF_width
@@ -1087,8 +1002,11 @@ while row2:
     BiS_stat_name = 'Mean' # Can't do 'median' on ArcGIS 9.2 or with floating point DEM's
 
     #Calculate curvature and extract by possible valley bottom    
-    arcpy.Curvature_3d(outDEM, curvature)   # Could use slp-slp times reclassed curv, but that would require more steps
-    BiS_surf = ExtractByMask(curvature, vw_final)
+    if terrain_engine == "NUMPY":
+        BiS_surf = ExtractByMask(all_curv, vw_final)    # Curvature of the entire DEM (section D)
+    else:
+        arcpy.Curvature_3d(outDEM, curvature)   # Could use slp-slp times reclassed curv, but that would require more steps
+        BiS_surf = ExtractByMask(curvature, vw_final)
     BiS_surf.save(userworkspace + '/temp' + '/BiS_surf')
 ##        BiS_surf.save(userworkspace + '/temp/seg' + '/BiS_' + inBasename + val_s)## DB: 6/9/2014 saves unique version
 
@@ -1123,11 +1041,19 @@ while row2:
         BiS_stat = 1.0
 
     # Flood block to final BiS_stat value, then reclass and convert to .shp
-    BiS_btmR = CostDistance(stream_segment, slope_pct_100, BiS_stat)
-    BiS_btmR.save(userworkspace + '/temp' + '/BiS_btmR')
+    if flood_engine == "NUMPY":
+        flood = flood_geometry.deepen(flood, seg_mask, slp_win, win_info.cell_size, min(BiS_stat, reclass_max))
+        BiS_1 = raster_io.write_raster(flood.extent_grid(min(BiS_stat, reclass_max)), win_info,
+                                       userworkspace + '/temp' + '/BiS_1')
+        # Every flood of the block is made: cache the table once, as deep as they needed it
+        if stage_cache is not None and flood is not stored_flood:
+            stage_cache.put(stage_key, **flood.arrays)
+    else:
+        BiS_btmR = CostDistance(stream_segment, slope_pct_100, BiS_stat)
+        BiS_btmR.save(userworkspace + '/temp' + '/BiS_btmR')
 
-    BiS_1 = Reclassify(BiS_btmR, "Value", reclassifyRanges, "DATA")
-    BiS_1.save(userworkspace + '/temp' + '/BiS_1')
+        BiS_1 = Reclassify(BiS_btmR, "Value", reclassifyRanges, "DATA")
+        BiS_1.save(userworkspace + '/temp' + '/BiS_1')
 
     inField = "GRIDCODE"
     arcpy.RasterToPolygon_conversion(BiS_1, G_final_temp, "NO_SIMPLIFY")
@@ -1147,110 +1073,125 @@ while row2:
     #   than the 'area' technique (dividing the valley bottom area by the stream
     #   length to get width).  Thus the 'area' technique is commented out.
     
-    # Initiate fields for this step
-    block_minus = userworkspace + '/temp' + '/block_minus' + '.shp'
-
-    HG_final_line = userworkspace + '/temp' + '/HG_final_line' + '.shp'
-    HG_final_sep = userworkspace + '/temp' + '/HG_final_sep' + '.shp'
-    HG_final_sides = userworkspace + '/temp' + '/HG_final_sides' + '.shp'
-##        HG_final_sides = userworkspace + '/temp/seg' + '/HGs_' + inBasename + val_s + '.shp' ## DB: 6/9/2014 saves unique version
-
-    H_final_line = userworkspace + '/temp' + '/H_final_line' + '.shp'
-    H_final_sides = userworkspace + '/temp' + '/H_final_sides' + '.shp'
-    H_final_sep = userworkspace + '/temp' + '/H_final_sep' + '.shp'
-
-    G_final_line = userworkspace + '/temp' + '/G_final_line' + '.shp'
-    G_final_sides = userworkspace + '/temp' + '/G_final_sides' + '.shp'
-    G_final_sep = userworkspace + '/temp' + '/G_final_sep' + '.shp'
-
-    # Back buffer the stream segment block 
-    arcpy.Buffer_analysis(outShapeFile, block_minus, "-5 Meters", "" , "FLAT", "NONE")
-
-    # Set extent for upper and lower limits to the allocation block for this segment  
-    dataset = arcpy.Describe(outShapeFile)
-    tempExtent = dataset.Extent
-    arcpy.Extent = tempExtent
+    if width_engine == "NUMPY" and flood_engine == "NUMPY":
+        # One distance to stream field per block, sampled on the edge cells of the three
+        #   valley masks (the same floods BiS_1 and vw_upper were made from); edges within
+        #   5 m of the block boundary are left out, as the clip by block_minus does
+        H_mask = flood.extent_grid(min(flood_raster_depth, reclass_max)) > 0
+        G_mask = flood.extent_grid(min(BiS_stat, reclass_max)) > 0
+        DistFromStr = valley_width.distance_to_stream(seg_mask, win_info.cell_size)
+        if save_dfs:
+            raster_io.write_raster(DistFromStr, win_info, userworkspace + '/temp/seg' + '/DFS_' + inBasename + val_s)
+        blk_interior = valley_width.block_interior(blk_mask, win_info.cell_size, 5.0)
+        HG_width, Q100_width, BiS_width = valley_width.valley_widths(
+            DistFromStr, (H_mask & G_mask, H_mask, G_mask), blk_mask, blk_interior)
+        #print '    HG, Q100, BiS width =', str(HG_width)[0:6], str(Q100_width)[0:6], str(BiS_width)[0:6]
+    else:
+        # Initiate fields for this step
+        block_minus = userworkspace + '/temp' + '/block_minus' + '.shp'
+
+        HG_final_line = userworkspace + '/temp' + '/HG_final_line' + '.shp'
+        HG_final_sep = userworkspace + '/temp' + '/HG_final_sep' + '.shp'
+        HG_final_sides = userworkspace + '/temp' + '/HG_final_sides' + '.shp'
+##            HG_final_sides = userworkspace + '/temp/seg' + '/HGs_' + inBasename + val_s + '.shp' ## DB: 6/9/2014 saves unique version
+
+        H_final_line = userworkspace + '/temp' + '/H_final_line' + '.shp'
+        H_final_sides = userworkspace + '/temp' + '/H_final_sides' + '.shp'
+        H_final_sep = userworkspace + '/temp' + '/H_final_sep' + '.shp'
+
+        G_final_line = userworkspace + '/temp' + '/G_final_line' + '.shp'
+        G_final_sides = userworkspace + '/temp' + '/G_final_sides' + '.shp'
+        G_final_sep = userworkspace + '/temp' + '/G_final_sep' + '.shp'
+
+        # Back buffer the stream segment block 
+        arcpy.Buffer_analysis(outShapeFile, block_minus, "-5 Meters", "" , "FLAT", "NONE")
+
+        # Set extent for upper and lower limits to the allocation block for this segment  
+        tempExtent = blk_extent
+        arcpy.Extent = tempExtent
+
+        # Create raster of distance from the stream
+        DistFromStr = EucDistance(stream_segment) 
+##            DistFromStr.save(userworkspace + '/temp' + '/DistFromStr')
+        if save_dfs:
+            DistFromStr.save(userworkspace + '/temp/seg' + '/DFS_' + inBasename + val_s)
+
+        # Calculate average width for HG_final (HG Valley Bottom) 'edge' technique
+        arcpy.PolygonToLine_management(HG_final, HG_final_line)
+        arcpy.Clip_analysis(HG_final_line, block_minus, HG_final_sep)
+        arcpy.Dissolve_management(HG_final_sep, HG_final_sides, "FID")
+        HG_width_r = ZonalStatistics(HG_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
+        HG_width_r.save(userworkspace + '/temp' + '/HG_width_r')
+
+        HG_width1_result = arcpy.GetRasterProperties_management (HG_width_r, "Mean")
+        HG_width1 = float(HG_width1_result.getOutput(0))
+        HG_width = 2.0*(HG_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
+        #print '    HG_width =', str(HG_width)[0:6]
+
+        # 'area' technique for HG_width
+##        cursor3 = arcpy.SearchCursor(HG_final)
+##        row3 = cursor3.next()
+##        feat = row3.shape
+##        HG_area = feat.area
+##        HG_width = HG_area / float(seg['SLength'])
+##        del cursor3
+##        del row3
+
+##        print 'Area, Width =',temp_area, HG_width
+##        print '***Width_edges, Width_area =', HG_width1, HG_width 
+
+        # Calculate average width for Q100 (Hydro Valley Bottom)'edge' technique
+        arcpy.PolygonToLine_management(H_final, H_final_line)
+        arcpy.Clip_analysis(H_final_line, block_minus, H_final_sep)
+        arcpy.Dissolve_management(H_final_sep, H_final_sides, "FID")
+        H_width_r = ZonalStatistics(H_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
+        H_width_r.save(userworkspace + '/temp' + '/H_width_r')
+
+        #Q100_width = 2.0*(arcpy.GetRasterProperties_management (H_width_r, "Mean"))  # Must multiply by 2.0 as raster distance is from only one side to the stream
+
+        Q100_width1_result = arcpy.GetRasterProperties_management (H_width_r, "Mean")
+        Q100_width1 = float(Q100_width1_result.getOutput(0))
+        Q100_width = 2.0*(Q100_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
+        #print '    Q100 width =', str(Q100_width1)[:5], '(with multiplier)'
+
+        # 'area' technique for Q100_width
+##        cursor7 = arcpy.SearchCursor(H_final)
+##        row7 = cursor7.next()
+##        feat = row7.shape
+##        Q100_area = feat.area
+##        Q100_width = Q100_area / float(seg['SLength'])
+##        del cursor7
+##        del row7
+##        print 'Area, Width =',temp_area, Q100_width
+
+        # Calculate average width for BiS (Geomorphic Valley Bottom)'edge' technique
+        arcpy.PolygonToLine_management(G_final, G_final_line)
+        arcpy.Clip_analysis(G_final_line, block_minus, G_final_sep)
+        arcpy.Dissolve_management(G_final_sep, G_final_sides, "FID")
+        G_width_r = ZonalStatistics(G_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
+        G_width_r.save(userworkspace + '/temp' + '/G_width_r')
+
+##        BiS_width = 2.0*(arcpy.GetRasterProperties_management (G_width_r, "Mean"))  # Must multiply by 2.0 as raster distance is from only one side to the stream
+
+        BiS_width1_result = arcpy.GetRasterProperties_management (G_width_r, "Mean")
+        BiS_width1 = float(BiS_width1_result.getOutput(0))
+        BiS_width = 2.0*(BiS_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
+        #print '    BiS width =', str(BiS_width)[:5]
+
+        # 'area' technique for BiS_width
+##        cursor8 = arcpy.SearchCursor(G_final)
+##        row8 = cursor8.next()
+##        feat = row8.shape
+##        BiS_area = feat.area
+##        BiS_width = BiS_area / float(seg['SLength'])
+##        del cursor8
+##        del row8
+##        print 'Area, Width =',temp_area, BiS_width
 
-    # Create raster of distance from the stream
-    DistFromStr = EucDistance(stream_segment) 
-##        DistFromStr.save(userworkspace + '/temp' + '/DistFromStr')
-    DistFromStr.save(userworkspace + '/temp/seg' + '/DFS_' + inBasename + val_s)
-
-    # Calculate average width for HG_final (HG Valley Bottom) 'edge' technique
-    arcpy.PolygonToLine_management(HG_final, HG_final_line)
-    arcpy.Clip_analysis(HG_final_line, block_minus, HG_final_sep)
-    arcpy.Dissolve_management(HG_final_sep, HG_final_sides, "FID")
-    HG_width_r = ZonalStatistics(HG_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
-    HG_width_r.save(userworkspace + '/temp' + '/HG_width_r')
-
-    HG_width1_result = arcpy.GetRasterProperties_management (HG_width_r, "Mean")
-    HG_width1 = float(HG_width1_result.getOutput(0))
-    HG_width = 2.0*(HG_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
-    #print '    HG_width =', str(HG_width)[0:6]
-
-    # 'area' technique for HG_width
-##    cursor3 = arcpy.SearchCursor(HG_final)
-##    row3 = cursor3.next()
-##    feat = row3.shape
-##    HG_area = feat.area
-##    HG_width = HG_area / float(s_length_dict[val_s])
-##    del cursor3
-##    del row3
-
-##    print 'Area, Width =',temp_area, HG_width
-##    print '***Width_edges, Width_area =', HG_width1, HG_width 
 
     # Calculate Valley/BF width ratio
     V_BF_ratio = HG_width / BF_width
 
-    # Calculate average width for Q100 (Hydro Valley Bottom)'edge' technique
-    arcpy.PolygonToLine_management(H_final, H_final_line)
-    arcpy.Clip_analysis(H_final_line, block_minus, H_final_sep)
-    arcpy.Dissolve_management(H_final_sep, H_final_sides, "FID")
-    H_width_r = ZonalStatistics(H_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
-    H_width_r.save(userworkspace + '/temp' + '/H_width_r')
-
-    #Q100_width = 2.0*(arcpy.GetRasterProperties_management (H_width_r, "Mean"))  # Must multiply by 2.0 as raster distance is from only one side to the stream
-
-    Q100_width1_result = arcpy.GetRasterProperties_management (H_width_r, "Mean")
-    Q100_width1 = float(Q100_width1_result.getOutput(0))
-    Q100_width = 2.0*(Q100_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
-    #print '    Q100 width =', str(Q100_width1)[:5], '(with multiplier)'
-     
-    # 'area' technique for Q100_width
-##    cursor7 = arcpy.SearchCursor(H_final)
-##    row7 = cursor7.next()
-##    feat = row7.shape
-##    Q100_area = feat.area
-##    Q100_width = Q100_area / float(s_length_dict[val_s])
-##    del cursor7
-##    del row7
-##    print 'Area, Width =',temp_area, Q100_width
-
-    # Calculate average width for BiS (Geomorphic Valley Bottom)'edge' technique
-    arcpy.PolygonToLine_management(G_final, G_final_line)
-    arcpy.Clip_analysis(G_final_line, block_minus, G_final_sep)
-    arcpy.Dissolve_management(G_final_sep, G_final_sides, "FID")
-    G_width_r = ZonalStatistics(G_final_sides, "ID", DistFromStr, "MEAN", "DATA") #RSAC changed "FID" to "ID"
-    G_width_r.save(userworkspace + '/temp' + '/G_width_r')
-    
-##    BiS_width = 2.0*(arcpy.GetRasterProperties_management (G_width_r, "Mean"))  # Must multiply by 2.0 as raster distance is from only one side to the stream
-
-    BiS_width1_result = arcpy.GetRasterProperties_management (G_width_r, "Mean")
-    BiS_width1 = float(BiS_width1_result.getOutput(0))
-    BiS_width = 2.0*(BiS_width1)  # Must multiply by 2.0 as raster distance is from only one side to the stream
-    #print '    BiS width =', str(BiS_width)[:5]
-
-    # 'area' technique for BiS_width
-##    cursor8 = arcpy.SearchCursor(G_final)
-##    row8 = cursor8.next()
-##    feat = row8.shape
-##    BiS_area = feat.area
-##    BiS_width = BiS_area / float(s_length_dict[val_s])
-##    del cursor8
-##    del row8
-##    print 'Area, Width =',temp_area, BiS_width
-    
 ##    except:
 ##        print "    ERROR - Could not calculate BiS for this block"
 ##        arcpy.AddMessage(arcpy.GetMessages(2))
@@ -1297,7 +1238,6 @@ while row2:
     #print "    Building 1st order cutlines..."
 
 ##    try:
-    cutline = userworkspace + '/temp/seg' + '/CL_' + inBasename + val_s + '.shp'  # Referencing previously established file
     cut_clip = userworkspace + '/temp'+ '/cut_clip' + '.shp'
     cut_buff = userworkspace + '/temp'+ '/cut_buff' + '.shp'
     hill_union = userworkspace + '/temp'+ '/hill_union' + '.shp'
@@ -1306,17 +1246,23 @@ while row2:
 ##        hill_split = userworkspace + '/temp'+ '/hill_split' + '.shp'
     hill_split = userworkspace + '/temp/seg' + '/HS_' + inBasename + val_s + '.shp'
     
-##        if os.path.exists(cutline):   
-    arcpy.Clip_analysis(cutline, outShapeFile, cut_clip)
-    arcpy.Buffer_analysis(cut_clip, cut_buff, "1 Meter", "FULL", "FLAT", "NONE") #This is the source of many of the errors
-    #union_str = hill_clip + ";" + cut_buff 
-    union_str = '\"%(hill)s\"; \"%(cut)s\"' % {"hill":hill_clip,"cut":cut_buff}# RSAC replaced above line with this one        
-    arcpy.Union_analysis(union_str, hill_union,"ONLY_FID")
-    arcpy.MultipartToSinglepart_management(hill_union, hill_erase)
-    arcpy.Erase_analysis(hill_erase,cut_buff,hill_split)
-##        else:
-##            arcpy.MultipartToSinglepart_management(hill_clip, hill_split)
-##            print'    NOTE: No existing cutline'
+    # Only clip the cutline if its extent reaches the block, and only split the hillslopes
+    #   with it if the clip kept some of it (an empty clip fails the buffer)
+    cut_kept = False
+    if val in cut_features and vector_io.boxes_overlap(vector_io.feature_box(cut_features[val]), blk_box):
+        cutline = cut_features.write(val, 'in_memory/cutline')
+        arcpy.Clip_analysis(cutline, outShapeFile, cut_clip)
+        cut_kept = int(arcpy.GetCount_management(cut_clip).getOutput(0)) > 0
+    if cut_kept:
+        arcpy.Buffer_analysis(cut_clip, cut_buff, "1 Meter", "FULL", "FLAT", "NONE") #This is the source of many of the errors
+        #union_str = hill_clip + ";" + cut_buff 
+        union_str = '\"%(hill)s\"; \"%(cut)s\"' % {"hill":hill_clip,"cut":cut_buff}# RSAC replaced above line with this one        
+        arcpy.Union_analysis(union_str, hill_union,"ONLY_FID")
+        arcpy.MultipartToSinglepart_management(hill_union, hill_erase)
+        arcpy.Erase_analysis(hill_erase,cut_buff,hill_split)
+    else:
+        arcpy.MultipartToSinglepart_management(hill_clip, hill_split)
+        print'    NOTE: No existing cutline'
 
     # #################################################################
     # R. Separate split hillslopes into right and left
@@ -1368,6 +1314,7 @@ while row2:
     
     s = 0
     r = 0
+    hill_cats = []      # (side, HS_Cat, class grid) of each side classified by the NUMPY engine
     while s <=1:
 ##          ---------------------
 ##            if s == 0:
@@ -1405,61 +1352,78 @@ while row2:
         if n_cat ==0:
             report_stat = 99
         else:
-            hill_sl_pct = ExtractByMask(slope_pct_100, hill_side)
-            hill_sl_pct.save(userworkspace + '/temp' + '/hill_sl_pct')
-
             reclassifxyRanges = "0.00 "+str(HSthresh_low)+" 1; "+str(HS_low_plus)+" "+str(HSthresh_up)+" 2; "+str(HS_up_plus)+" 1000.0 3"
-            hill_sl_cl = Reclassify(hill_sl_pct, "Value", reclassifxyRanges, "NODATA")
-            hill_sl_cl.save(userworkspace + '/temp'+ '/hill_sl_cl')
-            arcpy.RasterToPolygon_conversion(hill_sl_cl, hill_sl_sh, "NO_SIMPLIFY")
-            arcpy.Dissolve_management(hill_sl_sh, hill_sl_cat, "GRIDCODE")
-
-            # Associate hillslopes with current segment
-            arcpy.AddField_management(hill_sl_cat, "ARCID", "Short")
-            arcpy.CalculateField_management (hill_sl_cat, "ARCID", val)
-
-            # Assign "R" or "L"         
-            arcpy.AddField_management(hill_sl_cat, "R_OR_L", "TEXT","", "", "5")
-            arcpy.CalculateField_management (hill_sl_cat, "R_OR_L", side)
-
-            # Add area to each entry
-            arcpy.AddField_management(hill_sl_cat, "Poly_Area", "Float")
-            arcpy.CalculateField_management(hill_sl_cat, "POLY_AREA", "float(!SHAPE.AREA!)", "PYTHON")
-
-            # Zero out stats from previous segment   
-            area1 = 0.0
-            area2 = 0.0
-            area3 = 0.0
-            area_tot = 0.0
-            prop1 = 0.0
-            prop2 = 0.0
-            prop3 = 0.0
-            report_stat = 0
-
-        # Calculate proportions for each category and determine a the final slope category
-            cursor4 = arcpy.SearchCursor(hill_sl_cat)
-            row4 = cursor4.next()
-
-            while row4:
-                P_area = row4.getValue("Poly_Area")
-                grid = row4.getValue("GRIDCODE")
-                if grid ==1:
-                    area1 = P_area
-                elif grid ==2:
-                    area2 = P_area
-                elif grid == 3:
-                    area3 = P_area
-                else:
-                    print "    ERROR - Incorrect slope class reported"
+            if hillslope_engine == "NUMPY" and window_engine == "NUMPY":
+                # Class areas straight from the block's slope window: a histogram of the slope
+                #   classes over the hillslope's cells times the cell area, no polygons
+                hill_store = vector_io.FeatureStore(hill_side, "FID")
+                hill_mask = raster_io.polygon_mask(vector_io.geometry_parts(hill_store[hill_store.keys[0]]), win_info)
+                hill_cl = map_algebra.reclassify(slp_win, reclassifxyRanges, "NODATA")
+                hill_cl = numpy.where(hill_mask & ~numpy.isnan(hill_cl), hill_cl, 0).astype(numpy.uint8)
+                area1, area2, area3 = (numpy.bincount(hill_cl.ravel(), minlength=4)[1:4] *
+                                       win_info.cell_size * win_info.cell_size).tolist()
+            else:
+                hill_sl_pct = ExtractByMask(slope_pct_100, hill_side)
+                hill_sl_pct.save(userworkspace + '/temp' + '/hill_sl_pct')
+
+                hill_sl_cl = Reclassify(hill_sl_pct, "Value", reclassifxyRanges, "NODATA")
+                hill_sl_cl.save(userworkspace + '/temp'+ '/hill_sl_cl')
+                arcpy.RasterToPolygon_conversion(hill_sl_cl, hill_sl_sh, "NO_SIMPLIFY")
+                arcpy.Dissolve_management(hill_sl_sh, hill_sl_cat, "GRIDCODE")
+
+                # Associate hillslopes with current segment
+                arcpy.AddField_management(hill_sl_cat, "ARCID", "Short")
+                arcpy.CalculateField_management (hill_sl_cat, "ARCID", val)
+
+                # Assign "R" or "L"         
+                arcpy.AddField_management(hill_sl_cat, "R_OR_L", "TEXT","", "", "5")
+                arcpy.CalculateField_management (hill_sl_cat, "R_OR_L", side)
+
+                # Add area to each entry
+                arcpy.AddField_management(hill_sl_cat, "Poly_Area", "Float")
+                arcpy.CalculateField_management(hill_sl_cat, "POLY_AREA", "float(!SHAPE.AREA!)", "PYTHON")
+
+                # Zero out stats from previous segment   
+                area1 = 0.0
+                area2 = 0.0
+                area3 = 0.0
+                area_tot = 0.0
+                prop1 = 0.0
+                prop2 = 0.0
+                prop3 = 0.0
+                report_stat = 0
+
+            # Calculate proportions for each category and determine a the final slope category
+                cursor4 = arcpy.SearchCursor(hill_sl_cat)
                 row4 = cursor4.next()
-            del cursor4
-            del row4
-            del P_area
+
+                while row4:
+                    P_area = row4.getValue("Poly_Area")
+                    grid = row4.getValue("GRIDCODE")
+                    if grid ==1:
+                        area1 = P_area
+                    elif grid ==2:
+                        area2 = P_area
+                    elif grid == 3:
+                        area3 = P_area
+                    else:
+                        print "    ERROR - Incorrect slope class reported"
+                    row4 = cursor4.next()
+                del cursor4
+                del row4
+                del P_area
 
             area_tot = area1 + area2 + area3
-            prop1 = area1 / area_tot
-            prop2 = area2 / area_tot
-            prop3 = area3 / area_tot
+            if area_tot > 0:
+                prop1 = area1 / area_tot
+                prop2 = area2 / area_tot
+                prop3 = area3 / area_tot
+            else:
+                # A sliver hillslope that covers no cell centres has no slope to classify
+                print "    CAUTION - No slope cells in hillslope", side
+                prop1 = 0.0
+                prop2 = 0.0
+                prop3 = 0.0
 ##            print '    area1',side, str(area1)[:9], str(prop1)[:5]
 ##            print '    area2',side, str(area2)[:9], str(prop2)[:5]
 ##            print '    area3',side, str(area3)[:9], str(prop3)[:5]
@@ -1468,7 +1432,9 @@ while row2:
     # Limits of proportion of hillslopes in each category for classification
             thresh1 = 0.75      # % < HSthresh_low required for  'low' hillslope 
             thresh3 = 0.25      # % > HSthresh_up required for 'high' hillslope
-            if prop1 >= thresh1:
+            if area_tot <= 0:
+                report_stat = 99
+            elif prop1 >= thresh1:
                 report_stat = 1
             elif prop3 >= thresh3:
                 report_stat = 3
@@ -1476,8 +1442,12 @@ while row2:
                 report_stat = 2
     ##        print '    report_stat=', report_stat
 
-            arcpy.AddField_management(hill_sl_cat, "HS_Cat", "SHORT")
-            arcpy.CalculateField_management (hill_sl_cat, "HS_Cat", report_stat)
+            if hillslope_engine == "NUMPY" and window_engine == "NUMPY":
+                if area_tot > 0:    # No polygons to build from an empty class grid
+                    hill_cats.append((side, report_stat, hill_cl))
+            else:
+                arcpy.AddField_management(hill_sl_cat, "HS_Cat", "SHORT")
+                arcpy.CalculateField_management (hill_sl_cat, "HS_Cat", report_stat)
 
             # Pass values to report_stat (1st time through is R, 2nd time L)
             if s == 0:
@@ -1522,7 +1492,7 @@ while row2:
     valley_class = 0
     valley_name = '"UNC"'
     
-    slope_class = slope_class_dict[val_s]    
+    slope_class = int(seg['GRID_CODE'])
     if slope_class == 3:
         if coup_stat >= 0.75:
             valley_class = 1        # High energy coupled
@@ -1592,7 +1562,7 @@ while row2:
         arcpy.DeleteField_management(HG_final, "ID; GRIDCODE")
         
         arcpy.AddField_management(HG_final, FieldName2, "Long", "8")
-        arcpy.CalculateField_management (HG_final, FieldName2, float(s_length_dict[val_s]))
+        arcpy.CalculateField_management (HG_final, FieldName2, float(seg['SLength']))
         
         arcpy.AddField_management(HG_final, FieldName3, "Float")
         arcpy.CalculateField_management (HG_final, FieldName3, float(BF_width))
@@ -1649,7 +1619,7 @@ while row2:
         arcpy.DeleteField_management(H_final, "ID; GRIDCODE")
         
         arcpy.AddField_management(H_final, FieldName2, "long")
-        arcpy.CalculateField_management (H_final, FieldName2, float(s_length_dict[val_s]))
+        arcpy.CalculateField_management (H_final, FieldName2, float(seg['SLength']))
         
         arcpy.AddField_management(H_final, FieldName3, "Float")
         arcpy.CalculateField_management (H_final, FieldName3, float(BF_width))
@@ -1688,7 +1658,7 @@ while row2:
     arcpy.DeleteField_management(G_final, "ID; GRIDCODE")
     
     arcpy.AddField_management(G_final, FieldName2, "LONG", "8")
-    arcpy.CalculateField_management (G_final, FieldName2, float(s_length_dict[val_s]))
+    arcpy.CalculateField_management (G_final, FieldName2, float(seg['SLength']))
 
     arcpy.AddField_management(G_final, FieldName3, "Float")
     arcpy.CalculateField_management (G_final, FieldName3, float(BiS_stat))
@@ -1728,20 +1698,47 @@ while row2:
     # ________________________________________________________________
     # Append the hillslope classifications into a single .shp
     HS_cat = userworkspace + '/Hillslope_categories' + '.shp'
-    # Left First
-    hill_sl_cat = userworkspace + '/temp' + '/hill_L_cat' + '.shp'
-    try:
-        arcpy.Append_management(hill_sl_cat, HS_cat, "NO_TEST")
-    except:
-        arcpy.CopyFeatures_management(hill_sl_cat, HS_cat)
-    # Right Second
-    hill_sl_cat = userworkspace + '/temp' + '/hill_R_cat' + '.shp'
-    try:
-        arcpy.Append_management(hill_sl_cat, HS_cat, "NO_TEST")
-    except:
-        arcpy.CopyFeatures_management(hill_sl_cat, HS_cat)
+    if hillslope_engine == "NUMPY" and window_engine == "NUMPY":
+        # The class grids of this block's sides are only turned into polygons here, and
+        #   only when the output is wanted (Left first, then Right)
+        if save_hillslope_cats:
+            hill_sl_sh = userworkspace + '/temp' + '/hill_sl_sh' + '.shp'
+            for side, report_stat, hill_cl in reversed(hill_cats):
+                if side == '"R"':
+                    hill_sl_cat = userworkspace + '/temp' + '/hill_R_cat' + '.shp'
+                else:
+                    hill_sl_cat = userworkspace + '/temp' + '/hill_L_cat' + '.shp'
+                hill_sl_cl = raster_io.write_raster(hill_cl, win_info, userworkspace + '/temp'+ '/hill_sl_cl')
+                arcpy.RasterToPolygon_conversion(hill_sl_cl, hill_sl_sh, "NO_SIMPLIFY")
+                arcpy.Dissolve_management(hill_sl_sh, hill_sl_cat, "GRIDCODE")
+                arcpy.AddField_management(hill_sl_cat, "ARCID", "Short")
+                arcpy.CalculateField_management (hill_sl_cat, "ARCID", val)
+                arcpy.AddField_management(hill_sl_cat, "R_OR_L", "TEXT","", "", "5")
+                arcpy.CalculateField_management (hill_sl_cat, "R_OR_L", side)
+                arcpy.AddField_management(hill_sl_cat, "Poly_Area", "Float")
+                arcpy.CalculateField_management(hill_sl_cat, "POLY_AREA", "float(!SHAPE.AREA!)", "PYTHON")
+                arcpy.AddField_management(hill_sl_cat, "HS_Cat", "SHORT")
+                arcpy.CalculateField_management (hill_sl_cat, "HS_Cat", report_stat)
+                try:
+                    arcpy.Append_management(hill_sl_cat, HS_cat, "NO_TEST")
+                except:
+                    arcpy.CopyFeatures_management(hill_sl_cat, HS_cat)
+            print '    Finished appending to Hillslopes'
+    else:
+        # Left First
+        hill_sl_cat = userworkspace + '/temp' + '/hill_L_cat' + '.shp'
+        try:
+            arcpy.Append_management(hill_sl_cat, HS_cat, "NO_TEST")
+        except:
+            arcpy.CopyFeatures_management(hill_sl_cat, HS_cat)
+        # Right Second
+        hill_sl_cat = userworkspace + '/temp' + '/hill_R_cat' + '.shp'
+        try:
+            arcpy.Append_management(hill_sl_cat, HS_cat, "NO_TEST")
+        except:
+            arcpy.CopyFeatures_management(hill_sl_cat, HS_cat)
 
-    print '    Finished appending to Hillslopes'   
+        print '    Finished appending to Hillslopes'   
 
 ##    except: #release with BIG try:except:
 ##        msgs = arcpy.GetMessages(0)
@@ -1763,18 +1760,17 @@ while row2:
 ##    arcpy.delete(stream_segment)
 ##    arcpy.delete(cutline)
 
-# Read the next record from the search cursor     
+# Move on to the next block
     m += 1
-    row2 = cursor2.next()
+    b += 1
 
-# Delete the cursors
-del cursor2
-del row2
 # Close the file listing the new shape files
 ##newShapeList.close()
 #print
 
 # End of valley block loop (it's a long one!)
+if stage_cache is not None:
+    stage_cache.flush()
 # ***********************************************************************************
 
 print '__________________________________________________________________ '
@@ -11,217 +11,469 @@ import arcpy   # New for ArcGIS v.10
 from arcpy import env
 from arcpy.sa import *
 
-print '  Set up environment...'
-# Set environment settings
-arcpy.ResetEnvironments()
-
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
-
-# Set OverWriteOutput to 1 to copy over existing outputs, 0 to through exceptions for existing output
-arcpy.env.OverWriteOutput = True
-
-# File names and locations
-root    = "rmorrison"
-folder  = "C:/GIS"
-userworkfolder = folder + '/' + root 
-##dem_     = userworkfolder + '/' + root + "_dem.img"
-dem = 'C:/GIS/srout/srout_dem.img' # Note slashed have to be changed from \ to /
-##fdem = 'C:/GIS/nrout/A008/nrout_fdem' 
-##fdir = 'C:/GIS/nrout/A008/temp/nrout_fdir' 
-##facc = 'C:/GIS/nrout/A008/temp/nrout_facc' 
-##strm = 'C:/GIS/nrout/A008/nrout_strm'
-##strm_slp = 
-##strm_link_img
-##link_slp_raw 
-
-# Create workspace folder (Iteratively numbered)
-filenum = 1
-dir_exists = False 
-while not dir_exists:
-    if filenum > 500:
-        break
+# NumPy engines (kept alongside this script)
+import numpy
+import raster_io
+import dem_fill
+import flow_routing
+import map_algebra
+import stream_network
+import vector_io
+import preprocess_cache
+import threshold_sweep
+
+# The model only runs in the parent process: with flow_engine = "TILED" or a threshold sweep the
+#   process pool re-imports this script in every worker on Windows
+if __name__ == '__main__':
+    print '  Set up environment...'
+    # Set environment settings
+    arcpy.ResetEnvironments()
+
+    # Check out any necessary licenses
+    arcpy.CheckOutExtension("Spatial")
+
+    # Set OverWriteOutput to 1 to copy over existing outputs, 0 to through exceptions for existing output
+    arcpy.env.OverWriteOutput = True
+
+    # File names and locations
+    root    = "rmorrison"
+    folder  = "C:/GIS"
+    userworkfolder = folder + '/' + root 
+    ##dem_     = userworkfolder + '/' + root + "_dem.img"
+    dem = 'C:/GIS/srout/srout_dem.img' # Note slashed have to be changed from \ to /
+    ##fdem = 'C:/GIS/nrout/A008/nrout_fdem' 
+    ##fdir = 'C:/GIS/nrout/A008/temp/nrout_fdir' 
+    ##facc = 'C:/GIS/nrout/A008/temp/nrout_facc' 
+    ##strm = 'C:/GIS/nrout/A008/nrout_strm'
+    ##strm_slp = 
+    ##strm_link_img
+    ##link_slp_raw 
+
+    # Create workspace folder (Iteratively numbered)
+    filenum = 1
+    dir_exists = False 
+    while not dir_exists:
+        if filenum > 500:
+            break
+        try:
+            userworkspace = userworkfolder + '/' + "A" + str(filenum).zfill(3)
+            os.mkdir(userworkspace) # Create the workspace
+            dir_exists = True
+        except:
+            filenum += 1
+    ##        print "  Working Folder =" + str(filenum).zfill(3)
+            pass
     try:
-        userworkspace = userworkfolder + '/' + "A" + str(filenum).zfill(3)
-        os.mkdir(userworkspace) # Create the workspace
-        dir_exists = True
+        os.mkdir(userworkspace + '/temp') # Create the /TEMP folder
     except:
-        filenum += 1
-##        print "  Working Folder =" + str(filenum).zfill(3)
+        print '  ERROR - establishing temp directory (may already exist)'
+        arcpy.AddMessage(arcpy.GetMessages(2))
         pass
-try:
-    os.mkdir(userworkspace + '/temp') # Create the /TEMP folder
-except:
-    print '  ERROR - establishing temp directory (may already exist)'
-    arcpy.AddMessage(arcpy.GetMessages(2))
-    pass
-
-arcpy.env.workspace = userworkspace
-
-print '  Workspace is set to:', str(env.workspace)
-
-# Set output and temp names and file locations
-fdem_    = userworkspace + '/' + root + "_fdem"
-fdir_    = userworkspace + '/temp/' + root + "_fdir"
-facc_    = userworkspace + '/temp/' + root + "_facc"
-strm_    = userworkspace + '/' + root + "_strm"
-da_km_   = userworkspace + '/' + root + "_da_km"
-da_mi_   = userworkspace + '/temp/' + root + "_da_mi"
-segs_   = userworkspace + '/' + root + "_segs" + ".shp"
-blks_   = userworkspace + '/' + root + "_blks" + ".shp"
-Minimum_Mapping_Unit__cells_ = "\"COUNT\" > 30"
-DA_Threshold_Eq = "VALUE > 30000" 
-
-print 'dem =', dem
-print 'fdem =', fdem_
-print 'fdir =',fdir_
-print 'facc =',facc_
-print 'strm =',strm_
-print da_km_  
-print da_mi_   
-print segs_   
-print blks_
-
-# Set Geoprocessing environments
-arcpy.env.extent = dem
-env.workspace = userworkfolder
-
-# ############################################################################
-# This section of code creates the necessary input files for the HGVC script
-
-# Process: Fill
-print ' Fill'
-fdem = Fill(dem, "")
-fdem.save(fdem_)  # filled DEM
-
-# Process: Flow Direction
-print ' Dir'
-fdir = FlowDirection(fdem, "NORMAL")
-fdir.save(fdir_)
-
-# Process: Flow Accumulation
-print ' Acc'
-facc = FlowAccumulation(fdir, "", "FLOAT")
-facc.save(facc_)
-
-# Process: Con
-print ' DA_Threshold'
-strm = Con(facc, "1", "", DA_Threshold_Eq)
-strm.save(strm_)
-
-# Process: Divide
-print ' Acc km2'
-da_km = Float(Raster(facc_) / 10000.0)
-da_km.save(da_km_)
-
-# Process: Divide (2)
-print ' Acc mi'
-da_mi = Float(Raster(facc_) / 25899.8811)
-da_mi.save(da_mi_)
-
-# Process: Slope
-print ' Slope'
-tempEnvironment0 = arcpy.env.mask
-arcpy.env.mask = strm_
-strm_slp = Slope(fdem, "PERCENT_RISE", "1")
-strm_slp.save(userworkspace + '/temp' + '/strm_slp')    # Channel slope
-##strm_slp_ = '"%s"' % strm_slp
-
-# Process: Stream Link - Create individual stream links separated by nodes @ junctions
-print ' StreamLink'
-strm_link_img = StreamLink(strm, fdir)
-strm_link_img.save(userworkspace + '/temp' + '/strm_link_img')
-               
-# Process: Zonal Statistics
-print ' zonal stat'
-link_slp_raw = ZonalStatistics(strm_link_img, "Value", strm_slp, "MEAN", "DATA")
-link_slp_raw.save(userworkspace + '/temp' + '/link_slp_raw')
-##link_slp_raw_ =  "'" + link_slp_raw + "'" 
-
-# Process: Raster Calculator - Calc average of local slope and link slope to smooth out local variation
-print ' Raster1'
-strm_slp_   = userworkspace + '/temp/' + 'strm_slp'
-link_slp_raw_   = userworkspace + '/temp/' + 'link_slp_raw'
-
-strm_slp_mean = Float((Raster(strm_slp_) + Raster(link_slp_raw_)) /2.0)
-strm_slp_mean.save(userworkspace + '/temp' + '/strm_slp_mean')
-
-# Process: Zonal Statistics (2)
-print ' zonal stat2'
-seg_slp_mean = ZonalStatistics(strm_link_img, "Value", strm_slp_mean, "MEAN", "DATA")
-seg_slp_mean.save(userworkspace + '/temp' + '/seg_slp_mean')
-
-# Process: Reclassify 
-seg_slp_cls = Reclassify(seg_slp_mean, "Value", "0 0.10000000000000001 1;0.10000000000000001 3 2;3 10000 3", "DATA")
-seg_slp_cls.save(userworkspace + '/temp' + '/seg_slp_cls')
-seg_slp_cls.save(userworkspace + '/temp' + '/seg_slp_cls')
-
-# Process: Region Group - Group segments by value
-print ' RegionGroup2'
-val_segs_r = RegionGroup(seg_slp_cls, "EIGHT", "WITHIN", "ADD_LINK", "")
-val_segs_r.save(userworkspace + '/temp' + '/val_segs_r')
-
-# Process: Raster to Polyline - Create polyline of stream segments
-print ' Raster to Polyline'
-val_segs_shpA = (userworkspace + '/temp' + '/val_segs_shpA.shp')
-arcpy.RasterToPolyline_conversion(val_segs_r, val_segs_shpA, "ZERO", "20", "SIMPLIFY", "LINK")
-
-# Copy so I have a record of the original Raster to Polyline
-val_segs_shp = (segs_)
-arcpy.CopyFeatures_management(val_segs_shpA, val_segs_shp)
-
-# Process: Surface Length
-print ' Surface Length'
-arcpy.AddField_management(val_segs_shp, "SLength", "FLOAT")
-arcpy.CalculateField_management (val_segs_shp, "SLength", "!shape.length@meters!", "PYTHON_9.3")
-
-# Process: Remove all short segments
-print ' Delete short segments'
-try:
-    arcpy.Delete_management("val_segs_tbl") # Delete table if it currently exists
-except:
-    print '  Note: val_segs_tbl does not exist yet'
-arcpy.MakeFeatureLayer_management(val_segs_shp, "val_segs_tbl")
-arcpy.SelectLayerByAttribute_management ("val_segs_tbl", "NEW_SELECTION", "\"SLength\" <= 50.0")
-arcpy.DeleteFeatures_management("val_segs_tbl")
-#val_segs_shp2.save(userworkspace + '/val_segs_tbl')
-
-# Convert final valley segments back to raster for watershed delineation
-print ' Polyline to Raster'
-val_seg_ras = (userworkspace + '/temp' + '/val_segs_ras')
-arcpy.PolylineToRaster_conversion(val_segs_shp, "ARCID", val_seg_ras,"", "", 10.0)
-
-# Process: Watersheds
-print ' Watersheds'
-arcpy.env.mask = fdir_
-val_seg_ws = Watershed(fdir, val_seg_ras)
-val_seg_ws.save(userworkspace + '/temp' +  '/val_seg_ws')
-
-# Initiate parameters   
-inField = "GRIDCODE"
-valley_bl_sh = userworkspace + '/temp' +  '/valley_bl_sh' + '.shp'
-valley_block = blks_
-
-# Convert Watersheds from raster to polygon
-arcpy.RasterToPolygon_conversion(val_seg_ws, valley_bl_sh, "NO_SIMPLIFY", "VALUE") 
-arcpy.Dissolve_management(valley_bl_sh, valley_block, inField)
-
-
-
-print '("_______________________________________________________________")'
-
-    
-# ##############################################################################################
-#Calculate Time Elapsed in Model
-nowtime = datetime.now()
-diff = nowtime - thentime
-print 'COMPLETE: Model run time',str(diff)[:-7]
-
-try:
-    three = 2+1
-finally:
+
+    arcpy.env.workspace = userworkspace
+
+    print '  Workspace is set to:', str(env.workspace)
+
+    # Set output and temp names and file locations
+    fdem_    = userworkspace + '/' + root + "_fdem"
+    fdir_    = userworkspace + '/temp/' + root + "_fdir"
+    facc_    = userworkspace + '/temp/' + root + "_facc"
+    strm_    = userworkspace + '/' + root + "_strm"
+    da_km_   = userworkspace + '/' + root + "_da_km"
+    da_mi_   = userworkspace + '/temp/' + root + "_da_mi"
+    segs_   = userworkspace + '/' + root + "_segs" + ".shp"
+    blks_   = userworkspace + '/' + root + "_blks" + ".shp"
+    Minimum_Mapping_Unit__cells_ = "\"COUNT\" > 30"
+    DA_Threshold = 30000    # Channel initiation threshold (cells of flow accumulation)
+    DA_Threshold_Eq = "VALUE > " + str(DA_Threshold)
+    sweep_thresholds = []   # Threshold sweep, e.g. [20000, 30000, 40000]: facc is computed once and each
+                            #   threshold gets its own workspace (A###/T<threshold>) plus a row in
+                            #   A###/<root>_sweep.csv (needs flow_engine = "NUMPY"; [] = single run)
+    sweep_processes = None  # Worker processes for the threshold sweep (None = all cores)
+    fill_engine = "NUMPY"   # "NUMPY" = priority-flood fill (dem_fill.py), "ARCGIS" = Spatial Analyst Fill
+    fill_epsilon = 0.0      # Plateau gradient for the NUMPY fill (0.0 = flat fills, same as ArcGIS Fill)
+    flow_engine = "NUMPY"   # "NUMPY" = D8 direction/accumulation (flow_routing.py), "ARCGIS" = Spatial Analyst
+                            # "TILED" = ArcGIS FlowDirection + tile-parallel accumulation for DEMs larger
+                            #   than RAM (pair with fill_engine = "ARCGIS", the NUMPY fill holds the whole DEM)
+    tile_size = 4096        # Tile edge (cells) for the TILED flow accumulation
+    tile_processes = None   # Worker processes for the TILED flow accumulation (None = all cores)
+    algebra_engine = "LINKS" # "LINKS" = per-link slope means on the stream cells only (stream_network.py),
+                            # "NUMPY" = lazy map algebra (map_algebra.py), "ARCGIS" = Spatial Analyst tools
+    vector_engine = "NUMPY" # "NUMPY" = trace segments along D8 (stream_network.py, needs group_engine = "NUMPY"),
+                            # "ARCGIS" = RasterToPolyline + SLength + delete short segments
+    watershed_engine = "NUMPY" # "NUMPY" = upstream label sweep (flow_routing.watershed), "ARCGIS" = Watershed
+                            #   (with vector_engine = "NUMPY" the pour points come from memory, no val_segs_ras)
+    group_engine = "NUMPY"  # "NUMPY" = union-find grouping of the stream cells (stream_network.py),
+                            # "ARCGIS" = RegionGroup
+    min_seg_length = 50.0   # Segments this long or shorter (m) are deleted
+    cache_folder = userworkfolder + '/cache'   # Cache of fdem/fdir/facc keyed on the DEM and the settings
+                            #   they depend on (None = no cache; not used with flow_engine = "TILED")
+    cache_max_gb = 20.0     # Cache size limit; least recently used entries are deleted beyond it
+    fused_chunk_rows = 1024 # Rows per block for fused (single pass) cell-wise map algebra
+    debug_rasters = []      # Intermediate rasters to also save to /temp, e.g. ['strm_slp', 'seg_slp_cls']
+                            #   (only the products HGVC reads are written otherwise)
+
+    # The NUMPY segment tracing uses the stream cell groups of the NUMPY grouping
+    if vector_engine == "NUMPY" and group_engine != "NUMPY":
+        print '  ERROR: vector_engine = "NUMPY" needs group_engine = "NUMPY"'
+        sys.exit(1)
+
+    print 'dem =', dem
+    print 'fdem =', fdem_
+    print 'fdir =',fdir_
+    print 'facc =',facc_
+    print 'strm =',strm_
+    print da_km_  
+    print da_mi_   
+    print segs_   
+    print blks_
+
+    # Set Geoprocessing environments
+    arcpy.env.extent = dem
+    env.workspace = userworkfolder
+
+    # ############################################################################
+    # This section of code creates the necessary input files for the HGVC script
+
+    # Reuse fdem/fdir/facc from an earlier run on the same DEM with the same settings
+    if cache_folder is not None and flow_engine != "TILED":
+        cache = preprocess_cache.StageCache(cache_folder, cache_max_gb * 1024 ** 3)
+        fill_key = cache.key('fill', preprocess_cache.file_digest(dem), fill_engine, fill_epsilon)
+        cached = cache.get(fill_key)
+    else:
+        cache = None
+        cached = None
+
+    # Process: Fill
+    print ' Fill'
+    if cached is not None:
+        print '  Using cached fdem'
+        fdem_arr = cached['fdem']
+        dem_info = raster_io.describe_raster(dem)
+        fdem = raster_io.write_raster(fdem_arr, dem_info, fdem_)  # filled DEM
+    elif fill_engine == "NUMPY":
+        dem_arr, dem_info = raster_io.read_raster(dem)
+        fdem_arr = dem_fill.fill_depressions(dem_arr, fill_epsilon)
+        del dem_arr
+        fdem = raster_io.write_raster(fdem_arr, dem_info, fdem_)  # filled DEM
+        if cache is not None:
+            cache.put(fill_key, fdem=fdem_arr)
+    else:
+        fdem = Fill(dem, "")
+        fdem.save(fdem_)  # filled DEM
+        fdem_arr = None
+        dem_info = raster_io.describe_raster(fdem_)
+        if cache is not None:
+            fdem_arr = raster_io.read_raster(fdem_)[0]
+            cache.put(fill_key, fdem=fdem_arr)
+
+    # Rasters computed in NumPy are only written when HGVC needs them (or listed in debug_rasters)
+    graph = map_algebra.Graph(dem_info, debug_rasters, userworkspace + '/temp')
+
+    if flow_engine == "NUMPY":
+        # Process: Flow Direction and Flow Accumulation
+        print ' Dir + Acc'
+        cached = None
+        if cache is not None:
+            flow_key = cache.key('flow', fill_key, flow_engine)
+            cached = cache.get(flow_key)
+        if cached is not None:
+            print '  Using cached fdir, facc'
+            fdir_arr = cached['fdir']
+            facc_arr = cached['facc']
+        else:
+            if fdem_arr is None:
+                fdem_arr, dem_info = raster_io.read_raster(fdem_)
+            fdir_arr = flow_routing.flow_direction(fdem_arr)
+            facc_arr = flow_routing.flow_accumulation(fdir_arr)
+            if cache is not None:
+                cache.put(flow_key, fdir=fdir_arr, facc=facc_arr)
+        del cached
+        if algebra_engine != "LINKS" or watershed_engine != "NUMPY":
+            fdir = raster_io.write_raster(fdir_arr, dem_info, fdir_)   # StreamLink / Watershed read it from disk
+
+        # Process: Divide, Divide (2) - drainage areas (computed with DA_Threshold below)
+        facc_n = graph.source('facc', facc_arr)
+        graph.output(graph.Float(facc_n / flow_routing.CELLS_PER_KM2, name='da_km'), da_km_)
+        graph.Float(facc_n / flow_routing.CELLS_PER_MI2, name='da_mi')  # Not used by HGVC, debug only
+    elif flow_engine == "TILED":
+        # Process: Flow Direction
+        print ' Dir'
+        fdir = FlowDirection(fdem, "NORMAL")
+        fdir.save(fdir_)
+        fdir_arr = None
+
+        # Process: Flow Accumulation, DA_Threshold and drainage areas, tile by tile
+        print ' Acc (tiled)'
+        npy_ = userworkspace + '/temp/' + root
+        dem_info = raster_io.raster_to_npy(fdir_, npy_ + "_fdir.npy", numpy.uint8)
+        flow_routing.tiled_flow_accumulation(npy_ + "_fdir.npy", npy_ + "_facc.npy", tile_size,
+                                             tile_processes, DA_Threshold, npy_ + "_strm.npy",
+                                             npy_ + "_da_km.npy", npy_ + "_da_mi.npy")
+        facc = raster_io.npy_to_raster(npy_ + "_facc.npy", dem_info, facc_)
+        strm = raster_io.npy_to_raster(npy_ + "_strm.npy", dem_info, strm_)
+        da_km = raster_io.npy_to_raster(npy_ + "_da_km.npy", dem_info, da_km_)
+        da_mi = raster_io.npy_to_raster(npy_ + "_da_mi.npy", dem_info, da_mi_)
+    else:
+        # Process: Flow Direction
+        print ' Dir'
+        fdir = FlowDirection(fdem, "NORMAL")
+        fdir.save(fdir_)
+        fdir_arr = None
+
+        # Process: Flow Accumulation
+        print ' Acc'
+        facc = FlowAccumulation(fdir, "", "FLOAT")
+        facc.save(facc_)
+
+        # Process: Divide
+        print ' Acc km2'
+        da_km = Float(Raster(facc_) / 10000.0)
+        da_km.save(da_km_)
+
+        # Process: Divide (2)
+        print ' Acc mi'
+        da_mi = Float(Raster(facc_) / 25899.8811)
+        da_mi.save(da_mi_)
+
+    if cache is not None:
+        cache.flush()   # Record the last use of the entries read above
+
+    if sweep_thresholds:
+        # Process: DA_Threshold sweep - streams, segments and blocks for every threshold, in parallel
+        print ' DA_Threshold sweep', sweep_thresholds
+        if flow_engine != "NUMPY":
+            print '  ERROR: the threshold sweep needs flow_engine = "NUMPY"'
+            sys.exit(1)
+        graph.run(fused_chunk_rows)     # da_km, shared by every threshold
+        if fdem_arr is None:
+            fdem_arr = raster_io.read_raster(fdem_)[0]
+        sweep_rows = threshold_sweep.sweep(sweep_thresholds, fdem_arr, fdir_arr, facc_arr, dem_info,
+                                           userworkspace, root, min_seg_length, sweep_processes)
+        print '  DA_Threshold, stream cells, segments, total length (m)'
+        for row in sweep_rows:
+            print '  ', row[0], row[2], row[3], round(row[4], 1)
+
+        nowtime = datetime.now()
+        diff = nowtime - thentime
+        print 'COMPLETE: Model run time',str(diff)[:-7]
+        sys.exit(0)
+
+    # Process: Con
+    if flow_engine == "NUMPY":
+        # da_km, da_mi and strm in one fused pass over facc
+        print ' DA_Threshold'
+        graph.output(graph.Con(facc_n > DA_Threshold, 1, name='strm'), strm_, numpy.uint8)
+        graph.run(fused_chunk_rows)
+        graph.release('facc', 'da_km', 'da_mi', 'strm')
+        del facc_n, facc_arr
+        strm = Raster(strm_)
+    elif flow_engine == "ARCGIS":
+        print ' DA_Threshold'
+        strm = Con(facc, "1", "", DA_Threshold_Eq)
+        strm.save(strm_)
+
+    tempEnvironment0 = arcpy.env.mask
+    arcpy.env.mask = strm_
+
+    if algebra_engine == "LINKS":
+        # Slope, StreamLink, link means and Reclassify on the stream cells only
+        print ' Slope, StreamLink, zonal stats (stream cells)'
+        if fdem_arr is None:
+            fdem_arr = raster_io.read_raster(fdem_)[0]
+        if fdir_arr is None:
+            fdir_arr = raster_io.read_raster(fdir_, numpy.uint8)[0]
+        strm_arr = raster_io.read_raster(strm_, numpy.uint8)[0]
+        seg_slp_cls_arr, strm_cells, strm_links = stream_network.segment_slope_classes(
+            fdem_arr, fdir_arr, strm_arr, dem_info.cell_size)
+        del strm_arr
+        if 'seg_slp_cls' in debug_rasters:
+            seg_slp_cls = raster_io.write_raster(seg_slp_cls_arr, dem_info, userworkspace + '/temp' + '/seg_slp_cls')
+        else:
+            seg_slp_cls = raster_io.write_raster(seg_slp_cls_arr, dem_info)
+
+    elif algebra_engine == "NUMPY":
+        # Slope smoothing chain built lazily; only seg_slp_cls is computed (for RegionGroup)
+        print ' Slope, StreamLink, zonal stats'
+        if fdem_arr is not None:
+            fdem_n = graph.source('fdem', fdem_arr)
+        else:
+            fdem_n = graph.source('fdem', lambda: raster_io.read_raster(fdem_)[0])
+        strm_n = graph.source('strm_cells', lambda: raster_io.read_raster(strm_)[0])
+
+        # Channel slope (masked to stream cells, as with arcpy.env.mask = strm_)
+        strm_slp = graph.Con(strm_n, graph.Slope(fdem_n, "PERCENT_RISE", 1.0), name='strm_slp')
+
+        # Stream links separated by nodes @ junctions
+        strm_link_img = StreamLink(strm, fdir)
+        link_n = graph.source('strm_link_img',
+                              lambda: raster_io.read_raster(strm_link_img, numpy.int32)[0])
+
+        # Average of local slope and link slope to smooth out local variation
+        link_slp_raw = graph.ZonalStatistics(link_n, strm_slp, "MEAN", name='link_slp_raw')
+        strm_slp_mean = graph.name(graph.Float((strm_slp + link_slp_raw) / 2.0), 'strm_slp_mean')
+        seg_slp_mean = graph.ZonalStatistics(link_n, strm_slp_mean, "MEAN", name='seg_slp_mean')
+        seg_slp_cls_n = graph.Reclassify(seg_slp_mean, "0 0.10000000000000001 1;0.10000000000000001 3 2;3 10000 3",
+                                         "DATA", name='seg_slp_cls')
+        seg_slp_cls = graph.to_raster(seg_slp_cls_n)
+        del fdem_arr
+
+    else:
+        # Process: Slope
+        print ' Slope'
+        strm_slp = Slope(fdem, "PERCENT_RISE", "1")
+        strm_slp.save(userworkspace + '/temp' + '/strm_slp')    # Channel slope
+        ##strm_slp_ = '"%s"' % strm_slp
+
+        # Process: Stream Link - Create individual stream links separated by nodes @ junctions
+        print ' StreamLink'
+        strm_link_img = StreamLink(strm, fdir)
+        strm_link_img.save(userworkspace + '/temp' + '/strm_link_img')
+
+        # Process: Zonal Statistics
+        print ' zonal stat'
+        link_slp_raw = ZonalStatistics(strm_link_img, "Value", strm_slp, "MEAN", "DATA")
+        link_slp_raw.save(userworkspace + '/temp' + '/link_slp_raw')
+        ##link_slp_raw_ =  "'" + link_slp_raw + "'" 
+
+        # Process: Raster Calculator - Calc average of local slope and link slope to smooth out local variation
+        print ' Raster1'
+        strm_slp_   = userworkspace + '/temp/' + 'strm_slp'
+        link_slp_raw_   = userworkspace + '/temp/' + 'link_slp_raw'
+
+        strm_slp_mean = Float((Raster(strm_slp_) + Raster(link_slp_raw_)) /2.0)
+        strm_slp_mean.save(userworkspace + '/temp' + '/strm_slp_mean')
+
+        # Process: Zonal Statistics (2)
+        print ' zonal stat2'
+        seg_slp_mean = ZonalStatistics(strm_link_img, "Value", strm_slp_mean, "MEAN", "DATA")
+        seg_slp_mean.save(userworkspace + '/temp' + '/seg_slp_mean')
+
+        # Process: Reclassify 
+        seg_slp_cls = Reclassify(seg_slp_mean, "Value", "0 0.10000000000000001 1;0.10000000000000001 3 2;3 10000 3", "DATA")
+        seg_slp_cls.save(userworkspace + '/temp' + '/seg_slp_cls')
+
+    # Process: Region Group - Group segments by value
+    print ' RegionGroup2'
+    if group_engine == "NUMPY":
+        # 8-connected runs of equal slope class over the stream cells only, LINK = slope class
+        if algebra_engine == "LINKS":
+            cls_idx = strm_cells.idx[seg_slp_cls_arr.ravel()[strm_cells.idx] > 0]
+        else:
+            seg_slp_cls_arr = raster_io.read_raster(seg_slp_cls, numpy.uint8)[0]
+            cls_idx = numpy.flatnonzero(seg_slp_cls_arr.ravel())
+        seg_labels, seg_counts, seg_link = stream_network.region_group(
+            dem_info.shape, cls_idx, seg_slp_cls_arr.ravel()[cls_idx])
+        if vector_engine != "NUMPY" or 'val_segs_r' in debug_rasters:
+            val_segs_arr = numpy.zeros(dem_info.shape, dtype=numpy.int32)
+            val_segs_arr.ravel()[cls_idx] = seg_labels
+            val_segs_r = raster_io.write_raster(val_segs_arr, dem_info, userworkspace + '/temp' + '/val_segs_r')
+            raster_io.add_value_field(userworkspace + '/temp' + '/val_segs_r', "LINK", seg_link)
+            del val_segs_arr
+    else:
+        val_segs_r = RegionGroup(seg_slp_cls, "EIGHT", "WITHIN", "ADD_LINK", "")
+        val_segs_r.save(userworkspace + '/temp' + '/val_segs_r')
+
+    val_segs_shp = (segs_)
+    if vector_engine == "NUMPY":
+        # Process: Trace segments along D8 with their length, drop short ones, write _segs once
+        print ' Trace segments'
+        if algebra_engine != "LINKS":
+            if fdir_arr is None:
+                fdir_arr = raster_io.read_raster(fdir_, numpy.uint8)[0]
+            strm_cells = stream_network.StreamCells(fdir_arr, seg_slp_cls_arr)
+            strm_links = stream_network.stream_links(strm_cells)
+        cell_segs = numpy.zeros(strm_cells.size, dtype=numpy.int64)
+        cell_segs[numpy.searchsorted(strm_cells.idx, cls_idx)] = seg_labels
+        seg_lines, cell_arcids = stream_network.segment_polylines(strm_cells, strm_links, cell_segs, seg_link,
+                                                     dem_info, min_seg_length)
+        vector_io.write_polylines(val_segs_shp, seg_lines,
+                                  [("ARCID", "LONG"), ("GRID_CODE", "LONG"), ("SLength", "FLOAT")],
+                                  dem_info.spatial_reference)
+        print '  ' + str(len(seg_lines)) + ' segments longer than ' + str(min_seg_length) + ' m'
+        del cell_segs, seg_lines
+    else:
+        # Process: Raster to Polyline - Create polyline of stream segments
+        print ' Raster to Polyline'
+        val_segs_shpA = (userworkspace + '/temp' + '/val_segs_shpA.shp')
+        arcpy.RasterToPolyline_conversion(val_segs_r, val_segs_shpA, "ZERO", "20", "SIMPLIFY", "LINK")
+
+        # Copy so I have a record of the original Raster to Polyline
+        arcpy.CopyFeatures_management(val_segs_shpA, val_segs_shp)
+
+        # Process: Surface Length
+        print ' Surface Length'
+        arcpy.AddField_management(val_segs_shp, "SLength", "FLOAT")
+        arcpy.CalculateField_management (val_segs_shp, "SLength", "!shape.length@meters!", "PYTHON_9.3")
+
+        # Process: Remove all short segments
+        print ' Delete short segments'
+        try:
+            arcpy.Delete_management("val_segs_tbl") # Delete table if it currently exists
+        except:
+            print '  Note: val_segs_tbl does not exist yet'
+        arcpy.MakeFeatureLayer_management(val_segs_shp, "val_segs_tbl")
+        arcpy.SelectLayerByAttribute_management ("val_segs_tbl", "NEW_SELECTION", "\"SLength\" <= " + str(min_seg_length))
+        arcpy.DeleteFeatures_management("val_segs_tbl")
+        #val_segs_shp2.save(userworkspace + '/val_segs_tbl')
+
+    if watershed_engine == "NUMPY" and vector_engine == "NUMPY":
+        # Process: Watersheds - segment ARCIDs passed upstream from their own cells, no val_segs_ras
+        print ' Watersheds'
+        if fdir_arr is None:
+            fdir_arr = raster_io.read_raster(fdir_, numpy.uint8)[0]
+        on_seg = cell_arcids > 0
+        val_seg_ws = raster_io.write_raster(
+            flow_routing.watershed(fdir_arr, strm_cells.idx[on_seg], cell_arcids[on_seg]),
+            dem_info, userworkspace + '/temp' +  '/val_seg_ws')
+        del on_seg, cell_arcids
+    else:
+        # Convert final valley segments back to raster for watershed delineation
+        print ' Polyline to Raster'
+        val_seg_ras = (userworkspace + '/temp' + '/val_segs_ras')
+        arcpy.PolylineToRaster_conversion(val_segs_shp, "ARCID", val_seg_ras,"", "", 10.0)
+
+        # Process: Watersheds
+        print ' Watersheds'
+        if watershed_engine == "NUMPY":
+            if fdir_arr is None:
+                fdir_arr = raster_io.read_raster(fdir_, numpy.uint8)[0]
+            seg_ras_arr = raster_io.read_raster(val_seg_ras, numpy.int32)[0]
+            seed_idx = numpy.flatnonzero(seg_ras_arr.ravel())
+            val_seg_ws = raster_io.write_raster(
+                flow_routing.watershed(fdir_arr, seed_idx, seg_ras_arr.ravel()[seed_idx]),
+                dem_info, userworkspace + '/temp' +  '/val_seg_ws')
+            del seg_ras_arr, seed_idx
+        else:
+            arcpy.env.mask = fdir_
+            val_seg_ws = Watershed(fdir, val_seg_ras)
+            val_seg_ws.save(userworkspace + '/temp' +  '/val_seg_ws')
+
+    # Initiate parameters   
+    inField = "GRIDCODE"
+    valley_bl_sh = userworkspace + '/temp' +  '/valley_bl_sh' + '.shp'
+    valley_block = blks_
+
+    # Convert Watersheds from raster to polygon
+    arcpy.RasterToPolygon_conversion(val_seg_ws, valley_bl_sh, "NO_SIMPLIFY", "VALUE") 
+    arcpy.Dissolve_management(valley_bl_sh, valley_block, inField)
+
+
+
+    print '("_______________________________________________________________")'
+
+
+    # ##############################################################################################
+    #Calculate Time Elapsed in Model
     nowtime = datetime.now()
     diff = nowtime - thentime
-    print 'Model run ',str(diff)[:-7]
-    
-sys.exit(0)
\ No newline at end of file
+    print 'COMPLETE: Model run time',str(diff)[:-7]
+
+    try:
+        three = 2+1
+    finally:
+        nowtime = datetime.now()
+        diff = nowtime - thentime
+        print 'Model run ',str(diff)[:-7]
+
+    sys.exit(0)
@@ -0,0 +1,97 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: distance_transform
+Description: Exact Euclidean distance transform of a grid in memory (replacement for the
+    per-block EucDistance(stream_segment) of HGVC10_rrm_test.py).
+
+    Felzenszwalb and Huttenlocher (2012): the squared distance to the nearest source is
+    separable, so it is found by a 1-D transform down every column (distance to the nearest
+    source in the column) followed by a 1-D transform along every row over those column
+    results.  Each 1-D transform is the lower envelope of the parabolas (x - q)^2 + f(q)
+    rooted at the cells with a finite f, built and read in one sweep each, so the whole
+    transform is linear in the number of cells.  The apex of the parabola that wins a cell
+    is its nearest source, which gives the nearest-source indices at no extra cost.
+
+    Distances are between cell centres, as EucDistance measures them on its rasterized
+    sources.
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+
+def _envelope(f):
+    # 1-D squared distance transform of the list f (None = no source).
+    # Returns (squared distance, position of the nearest source), None where f has no source.
+    n = len(f)
+    v = []      # Apexes of the parabolas of the lower envelope, left to right
+    z = []      # Left boundary of each of them
+    for q in range(n):
+        fq = f[q]
+        if fq is None:
+            continue
+        while v:
+            p = v[-1]
+            s = ((fq + q * q) - (f[p] + p * p)) / (2.0 * (q - p))
+            if s <= z[-1]:
+                v.pop()     # Hidden by the new parabola everywhere it was lowest
+                z.pop()
+            else:
+                break
+        z.append(s if v else -numpy.inf)
+        v.append(q)
+    if not v:
+        return [None] * n, [None] * n
+    d = [0.0] * n
+    arg = [0] * n
+    k = 0
+    last = len(v) - 1
+    for q in range(n):
+        while k < last and z[k + 1] < q:
+            k += 1
+        p = v[k]
+        d[q] = (q - p) * (q - p) + f[p]
+        arg[q] = p
+    return d, arg
+
+
+def edt(sources, cell_size=1.0, return_indices=False):
+    '''Euclidean distance (map units) from every cell to the nearest source cell.
+
+    sources          boolean grid of the source cells
+    return_indices   also return (rows, cols), the row and column of the nearest source of
+                     every cell (-1 where there is none)
+    Returns the float64 distance grid, NaN everywhere when there is no source, or
+    (distance, (rows, cols)) with return_indices.
+    '''
+    src = numpy.asarray(sources, dtype=bool)
+    nrows, ncols = src.shape
+    sq = numpy.empty((nrows, ncols))
+    sq.fill(numpy.nan)
+    rows = -numpy.ones((nrows, ncols), dtype=numpy.int64)
+    cols = -numpy.ones((nrows, ncols), dtype=numpy.int64)
+
+    # Down the columns: squared distance (in cells) to the nearest source in the column
+    col_sq = numpy.empty((nrows, ncols))
+    col_sq.fill(numpy.nan)
+    col_row = -numpy.ones((nrows, ncols), dtype=numpy.int64)
+    for c in numpy.flatnonzero(src.any(axis=0)).tolist():
+        f = [0.0 if s else None for s in src[:, c].tolist()]
+        d, arg = _envelope(f)
+        col_sq[:, c] = d
+        col_row[:, c] = arg
+
+    # Along the rows, over the column results
+    if col_sq.size and not numpy.isnan(col_sq).all():
+        for r in range(nrows):
+            f = [None if x != x else x for x in col_sq[r].tolist()]
+            d, arg = _envelope(f)
+            sq[r] = d
+            cols[r] = arg
+            rows[r] = col_row[r][arg]
+
+    dist = numpy.sqrt(sq) * cell_size
+    if return_indices:
+        return dist, (rows, cols)
+    return dist
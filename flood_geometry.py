@@ -0,0 +1,290 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: flood_geometry
+Description: In-memory flood geometry of a valley block for the Manning's equation loop of
+    HGVC10_rrm_test.py (replacement for CostDistance -> SurfaceVolume_3d -> csv round trip
+    per trial depth).
+
+    HGVC floods a block with CostDistance from the stream segment over the decimal slope:
+    the accumulated cost of a cell (slope times horizontal distance along the cheapest path)
+    is its height above the channel, and the flood of depth d is every cell with a cost of
+    at most d.  That field does not depend on d, so it is computed once per block and its
+    cells sorted by height once into a stage table (StageTable), from which the flood
+    geometry of any depth (the cells with a height of at most d) is read by binary search:
+
+        Area_2D   planimetric area of the flooded cells
+        Area_3D   surface area of the flooded cells, cell area * sqrt(1 + slope^2)
+        Volume    volume between the flood raster surface and 0 (sum of height * cell area)
+
+    the same quantities SurfaceVolume_3d(flood_raster, ABOVE, 0) reports, taken per cell.
+    The flooded cells only change at the stages, so Area_2D * d - Volume (the flood volume
+    below the water surface) is exact, and piecewise linear and increasing in d.
+__________________________________________________________________________________________________
+'''
+
+import heapq
+
+import numpy
+
+_SQRT2 = numpy.sqrt(2.0)
+
+# (row, column, distance in cells) of the 8 neighbours
+_NEIGHBOURS = ((-1, -1, _SQRT2), (-1, 0, 1.0), (-1, 1, _SQRT2), (0, -1, 1.0),
+               (0, 1, 1.0), (1, -1, _SQRT2), (1, 0, 1.0), (1, 1, _SQRT2))
+
+
+def cost_distance(sources, cost, cell_size, max_cost=None):
+    '''Accumulated cost distance from the source cells over a cost grid, as CostDistance.
+
+    sources    boolean grid of the source cells
+    cost       cost per unit distance (NaN = NoData, a barrier)
+    max_cost   accumulated cost beyond which the search stops (the CostDistance maximum
+               distance); None = no limit
+    Moving between adjacent cells costs the mean of their costs times the distance between
+    their centres.  Dijkstra's algorithm from all sources at once; a cell is only ever
+    queued at a cost within max_cost, so the work follows the number of cells reached
+    rather than the extent of the grid.  Cells not reached are NaN.
+    '''
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    nrows, ncols = cost.shape
+    c = cost.ravel().tolist()
+    limit = numpy.inf if max_cost is None else float(max_cost)
+    src = numpy.flatnonzero(numpy.asarray(sources, dtype=bool).ravel() & ~numpy.isnan(cost.ravel()))
+    dist = dict.fromkeys(src.tolist(), 0.0)     # Best cost found so far of every queued cell
+    heap = [(0.0, i) for i in src.tolist()]
+    heapq.heapify(heap)
+    steps = [(dr, dc, 0.5 * w * cell_size) for dr, dc, w in _NEIGHBOURS]
+    while heap:
+        d, i = heapq.heappop(heap)
+        if d > dist[i]:
+            continue    # Stale entry, the cell was reached more cheaply since
+        r, col = divmod(i, ncols)
+        ci = c[i]
+        for dr, dc, w in steps:
+            rr = r + dr
+            cc = col + dc
+            if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols:
+                continue
+            j = rr * ncols + cc
+            cj = c[j]
+            if cj != cj:
+                continue    # NoData
+            nd = d + w * (ci + cj)
+            if nd <= limit and nd < dist.get(j, numpy.inf):
+                dist[j] = nd
+                heapq.heappush(heap, (nd, j))
+    out = numpy.empty(cost.size)
+    out.fill(numpy.nan)
+    if dist:
+        out[numpy.fromiter(dist.keys(), dtype=numpy.int64, count=len(dist))] = \
+            numpy.fromiter(dist.values(), dtype=numpy.float64, count=len(dist))
+    return out.reshape(nrows, ncols)
+
+
+class StageTable(object):
+    '''Stage-geometry table of a block: the flood geometry of every depth.
+
+    The block's flooded cells are sorted by height above channel once; cumulative sums over
+    that order give Area_2D, Area_3D and Volume at every distinct height (stage), so the
+    geometry of any depth is that of the highest stage not above it, found by binary search
+    (the same cells depth_grid and extent_grid flood).
+
+    arrays   {name: array} as returned by build_stage_table (or read back from a cache):
+             meta     (nrows, ncols, cell size, max_depth) of the block grid; max_depth is
+                      the height the search stopped at (inf = the whole block), taken as
+                      the last stage when missing
+             idx      flat indices of the reached cells, in order of height
+             height   their height above channel
+             stage    distinct heights; area_2d, area_3d and volume are the geometry of the
+                      flood of each stage
+    '''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        meta = arrays['meta']
+        self.shape = (int(meta[0]), int(meta[1]))
+        self.cell_size = float(meta[2])
+        self.idx = arrays['idx']
+        self.height = arrays['height']
+        self.stage = arrays['stage']
+        # Floods deeper than max_depth reach cells the table does not hold
+        if meta.size > 3:
+            self.max_depth = float(meta[3])
+        else:
+            self.max_depth = float(self.stage[-1]) if self.stage.size else 0.0
+        self.area_2d = arrays['area_2d']
+        self.area_3d = arrays['area_3d']
+        self.volume = arrays['volume']
+
+    def geometry(self, depth):
+        '''(Area_2D, Area_3D, Volume) of the flood of the given depth.'''
+        k = numpy.searchsorted(self.stage, depth, side='right') - 1
+        if k < 0:
+            return 0.0, 0.0, 0.0
+        return float(self.area_2d[k]), float(self.area_3d[k]), float(self.volume[k])
+
+    def depth_grid(self, depth):
+        '''The flood raster of a depth: height above channel where flooded, NaN elsewhere.'''
+        grid = numpy.empty(self.shape, dtype=numpy.float32)
+        grid.fill(numpy.nan)
+        k = numpy.searchsorted(self.height, depth, side='right')
+        grid.ravel()[self.idx[:k]] = self.height[:k]
+        return grid
+
+    def extent_grid(self, depth):
+        '''The flood extent of a depth: 1 where flooded, 0 (NoData) elsewhere (uint8).'''
+        grid = numpy.zeros(self.shape, dtype=numpy.uint8)
+        k = numpy.searchsorted(self.height, depth, side='right')
+        grid.ravel()[self.idx[:k]] = 1
+        return grid
+
+
+def build_stage_table(hac, slope, cell_size, max_depth=None):
+    '''StageTable from a height above channel grid and the decimal slope of the block.
+
+    Area_3D counts each cell as cell area * sqrt(1 + slope^2).  max_depth is the height
+    the hac search was cut off at (None = not cut off).
+    '''
+    hac = numpy.asarray(hac, dtype=numpy.float64)
+    cell_area = float(cell_size) * float(cell_size)
+    idx = numpy.flatnonzero(~numpy.isnan(hac.ravel()))
+    height = hac.ravel()[idx]
+    order = numpy.argsort(height, kind='mergesort')
+    idx = idx[order]
+    height = height[order]
+    s = numpy.asarray(slope, dtype=numpy.float64).ravel()[idx]
+    # Last cell of each distinct height: all cells up to it are flooded at that stage
+    last = numpy.flatnonzero(numpy.append(numpy.diff(height) > 0, True)) if height.size else idx
+    return StageTable({
+        'meta': numpy.array([hac.shape[0], hac.shape[1], cell_size,
+                             numpy.inf if max_depth is None else max_depth], dtype=numpy.float64),
+        'idx': idx,
+        'height': height,
+        'stage': height[last],
+        'area_2d': (last + 1) * cell_area,
+        'area_3d': numpy.cumsum(cell_area * numpy.sqrt(1.0 + s * s))[last],
+        'volume': numpy.cumsum(height)[last] * cell_area})
+
+
+def stage_table(sources, slope, cell_size, max_depth=None):
+    '''StageTable of a block flooded from sources (the stream segment cells) over the decimal slope.
+
+    Only cells up to max_depth above the channel are searched and tabled (None = all); the
+    geometry of deeper floods is that of max_depth (see StageTable.max_depth).
+    '''
+    return build_stage_table(cost_distance(sources, slope, cell_size, max_depth), slope, cell_size,
+                             max_depth)
+
+
+def deepen(table, sources, slope, cell_size, depth):
+    '''table if its search reaches depth, else the stage table of the block searched out to depth.'''
+    if depth <= table.max_depth:
+        return table
+    return stage_table(sources, slope, cell_size, depth)
+
+
+# ###########################################################################
+# Manning's equation depth solver
+
+def manning_discharge(table, depth, s_length, slope, mannings_n):
+    '''Discharge (Manning's equation) of the flood of a depth, as HGVC section K computes it.
+
+    Cross-section area = flooded volume / segment length, wetted perimeter = Area_3D /
+    segment length.  Returns 0 while nothing is flooded.
+    '''
+    area_2d, area_3d, volume = table.geometry(depth)
+    if area_3d <= 0.0:
+        return 0.0
+    xc_area = (area_2d * depth - volume) / s_length
+    hyd_radius = xc_area / (area_3d / s_length)
+    return (1.0 / mannings_n) * (hyd_radius ** 0.66666666) * xc_area * (slope ** 0.5)
+
+
+def solve_depth(table, q_target, s_length, slope, mannings_n, depth0, min_depth, rel_tol=0.1,
+                max_iter=50):
+    '''Flood depth whose Manning discharge is q_target, by a bracketed Illinois iteration.
+
+    The depth is bracketed from depth0 (doubling or halving it until the discharge is on
+    both sides of q_target, never below min_depth), then narrowed by regula falsi with the
+    Illinois modification (the function value kept at an end point that survives twice in a
+    row is halved) and a bisection step whenever the secant falls outside the bracket.  The
+    discharge increases with depth, so the bracket always holds the root.
+
+    Returns (depth, Q, evaluations, residual, status) with residual = (Q - q_target) /
+    q_target and status "converged" (|residual| <= rel_tol), "min_depth" (min_depth already
+    carries q_target), "max_iter", "no_flood" (no cell of the block is reached) or
+    "beyond_table" (the depth found is above table.max_depth, so it was solved on the frozen
+    geometry of the cut off search and the table must be searched deeper).
+    '''
+    depth, q, evaluations, r, status = _solve(table, q_target, s_length, slope, mannings_n, depth0,
+                                              min_depth, rel_tol, max_iter)
+    if status != "no_flood" and depth > table.max_depth:
+        status = "beyond_table"
+    return depth, q, evaluations, r, status
+
+
+def _solve(table, q_target, s_length, slope, mannings_n, depth0, min_depth, rel_tol, max_iter):
+    # Bracket and Illinois iteration of solve_depth
+    if not table.stage.size:
+        return min_depth, 0.0, 0, -1.0, "no_flood"
+    evaluations = [0]
+
+    def residual(d):
+        evaluations[0] += 1
+        q = manning_discharge(table, d, s_length, slope, mannings_n)
+        return q, (q - q_target) / q_target
+
+    d = max(depth0, min_depth)
+    q, r = residual(d)
+    if abs(r) <= rel_tol:
+        return d, q, evaluations[0], r, "converged"
+    if r < 0:
+        lo, q_lo, r_lo = d, q, r
+        hi = d
+        while True:
+            hi *= 2.0
+            q_hi, r_hi = residual(hi)
+            if abs(r_hi) <= rel_tol:
+                return hi, q_hi, evaluations[0], r_hi, "converged"
+            if r_hi > 0:
+                break
+            lo, q_lo, r_lo = hi, q_hi, r_hi
+            if evaluations[0] >= max_iter:
+                return lo, q_lo, evaluations[0], r_lo, "max_iter"
+    else:
+        hi, q_hi, r_hi = d, q, r
+        while True:
+            lo = max(hi / 2.0, min_depth)
+            q_lo, r_lo = residual(lo)
+            if abs(r_lo) <= rel_tol:
+                return lo, q_lo, evaluations[0], r_lo, "converged"
+            if r_lo < 0:
+                break
+            if lo <= min_depth:
+                return lo, q_lo, evaluations[0], r_lo, "min_depth"
+            hi, q_hi, r_hi = lo, q_lo, r_lo
+
+    # Illinois iteration on the bracket lo < root < hi (r_lo < 0 < r_hi)
+    f_lo, f_hi = r_lo, r_hi
+    side = 0
+    while evaluations[0] < max_iter:
+        d = (lo * f_hi - hi * f_lo) / (f_hi - f_lo)
+        if not lo < d < hi:
+            d = 0.5 * (lo + hi)
+        q, r = residual(d)
+        if abs(r) <= rel_tol:
+            return d, q, evaluations[0], r, "converged"
+        if r < 0:
+            lo, q_lo, r_lo, f_lo = d, q, r, r
+            if side == -1:
+                f_hi *= 0.5
+            side = -1
+        else:
+            hi, q_hi, r_hi, f_hi = d, q, r, r
+            if side == 1:
+                f_lo *= 0.5
+            side = 1
+    if abs(r_lo) < abs(r_hi):
+        return lo, q_lo, evaluations[0], r_lo, "max_iter"
+    return hi, q_hi, evaluations[0], r_hi, "max_iter"
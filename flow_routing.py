@@ -0,0 +1,465 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: flow_routing
+Description: D8 flow direction and flow accumulation on NumPy arrays (replacement for the
+    Spatial Analyst 'FlowDirection(fdem, "NORMAL")' -> 'FlowAccumulation(fdir, "", "FLOAT")'
+    pair in ValleySegs_rrm_test.py).
+
+    Flow directions use the ESRI encoding so the results can be handed straight to
+    StreamLink/Watershed:
+
+                32  64  128
+                16   x    1
+                 8   4    2
+
+    - Each cell flows to the neighbour with the steepest drop (diagonals divided by sqrt(2)).
+    - "NORMAL" edge handling: a cell on the raster edge (or next to NoData) flows outward only
+      when it has no downslope neighbour inside the raster.
+    - Flats left by the fill are routed towards their outlets along the shortest path across
+      the flat (Jenson & Domingue, 1988), so every valid cell drains off the raster.
+
+    Flow accumulation counts the upstream cells draining through each cell (the cell itself
+    is not included, as in ArcGIS).  It is computed by a topological sweep: cells with no
+    inflow are released first, pass their count downstream, and each receiving cell is
+    released once all of its donors have been processed.  Every cell is visited once; the
+    sweep is done in vectorised "waves", so Python overhead scales with the longest flow
+    path rather than with the number of cells.  Working memory is the uint8 direction and
+    in-degree grids plus the float32 accumulation grid.
+__________________________________________________________________________________________________
+'''
+
+import math
+import multiprocessing
+
+import numpy
+
+# ESRI D8 codes and their (row, col) offsets, in code order
+D8_CODES = (1, 2, 4, 8, 16, 32, 64, 128)
+D8_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+D8_DISTANCE = (1.0, math.sqrt(2.0), 1.0, math.sqrt(2.0), 1.0, math.sqrt(2.0), 1.0, math.sqrt(2.0))
+
+# Order in which an outward direction is chosen for edge cells (cardinals first)
+_OUTWARD_ORDER = (6, 0, 2, 4, 5, 7, 1, 3)
+
+CELLS_PER_KM2 = 10000.0       # 10 m cells: facc / 10000 = drainage area in km2
+CELLS_PER_MI2 = 25899.8811    # 10 m cells: facc / 25899.8811 = drainage area in mi2
+
+_BLOCK_ROWS = 512             # Rows per chunk when computing directions
+
+
+def code_lookup():
+    '''Return (drow, dcol) lookup arrays indexed by ESRI D8 code (0 = no flow).'''
+    drow = numpy.zeros(129, dtype=numpy.int64)
+    dcol = numpy.zeros(129, dtype=numpy.int64)
+    for code, (dr, dc) in zip(D8_CODES, D8_OFFSETS):
+        drow[code] = dr
+        dcol[code] = dc
+    return drow, dcol
+
+
+_DROW, _DCOL = code_lookup()
+
+
+def downstream_index(idx, fdir_flat, shape):
+    '''Return the flat index of the cell each of idx drains to, or -1 where flow leaves the grid.'''
+    nrows, ncols = shape
+    codes = fdir_flat[idx]
+    r = idx // ncols + _DROW[codes]
+    c = idx % ncols + _DCOL[codes]
+    inside = (codes > 0) & (r >= 0) & (r < nrows) & (c >= 0) & (c < ncols)
+    down = numpy.where(inside, r * ncols + c, -1)
+    if inside.any():
+        # Flow into a NoData cell leaves the grid as well
+        down[inside] = numpy.where(fdir_flat[down[inside]] > 0, down[inside], -1)
+    return down
+
+
+def _direction_block(zp):
+    # zp: block of elevations padded by one row/col on each side (NaN = NoData / off grid)
+    z = zp[1:-1, 1:-1]
+    rows, cols = z.shape
+    best_drop = numpy.zeros(z.shape, dtype=numpy.float64)
+    best_code = numpy.zeros(z.shape, dtype=numpy.uint8)
+    outward = numpy.zeros(z.shape, dtype=numpy.uint8)
+    with numpy.errstate(invalid='ignore'):
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            nb = zp[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+            drop = (z - nb) / D8_DISTANCE[k]
+            better = drop > best_drop
+            best_drop[better] = drop[better]
+            best_code[better] = D8_CODES[k]
+        # Cells with no downslope neighbour but touching NoData/the edge flow outward
+        for k in reversed(_OUTWARD_ORDER):
+            dr, dc = D8_OFFSETS[k]
+            nb = zp[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+            outward[numpy.isnan(nb)] = D8_CODES[k]
+    use_outward = (best_code == 0) & (outward > 0)
+    best_code[use_outward] = outward[use_outward]
+    best_code[numpy.isnan(z)] = 0
+    return best_code
+
+
+def _resolve_flats(z_flat, fdir_flat, shape):
+    # Route cells with no downslope neighbour across their flat towards an outlet,
+    # breadth-first from the cells of the flat that already drain.  Each flat cell is
+    # resolved exactly once, pointing back at the neighbour it was reached from.
+    nrows, ncols = shape
+    pending = (fdir_flat == 0) & ~numpy.isnan(z_flat)
+    if not pending.any():
+        return
+    pending_2d = pending.reshape(shape)
+    near_pending = numpy.zeros(shape, dtype=bool)
+    for dr, dc in D8_OFFSETS:
+        near_pending[max(0, dr):nrows + min(0, dr), max(0, dc):ncols + min(0, dc)] |= \
+            pending_2d[max(0, -dr):nrows - max(0, dr), max(0, -dc):ncols - max(0, dc)]
+    frontier = numpy.flatnonzero(near_pending.ravel() & (fdir_flat > 0))
+    del near_pending
+    while frontier.size:
+        r = frontier // ncols
+        c = frontier % ncols
+        z = z_flat[frontier]
+        reached = []
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            rr = r + dr
+            cc = c + dc
+            inside = (rr >= 0) & (rr < nrows) & (cc >= 0) & (cc < ncols)
+            nb = (rr * ncols + cc)[inside]
+            ok = pending[nb] & (z_flat[nb] == z[inside])
+            nb = nb[ok]
+            if nb.size:
+                fdir_flat[nb] = D8_CODES[(k + 4) % 8]   # Neighbour points back at the frontier
+                pending[nb] = False
+                reached.append(nb)
+        if not reached:
+            break   # Anything still pending is a true sink (DEM not filled); left as NoFlow
+        frontier = numpy.concatenate(reached)
+
+
+def flow_direction(fdem):
+    '''Return the ESRI-coded D8 flow direction (uint8, 0 = NoData) of a filled DEM array.'''
+    fdem = numpy.asarray(fdem)
+    nrows, ncols = fdem.shape
+    fdir = numpy.zeros((nrows, ncols), dtype=numpy.uint8)
+    zp = numpy.empty((_BLOCK_ROWS + 2, ncols + 2), dtype=numpy.float64)
+    for r0 in range(0, nrows, _BLOCK_ROWS):
+        r1 = min(r0 + _BLOCK_ROWS, nrows)
+        block = zp[:r1 - r0 + 2]
+        block.fill(numpy.nan)
+        h0 = max(r0 - 1, 0)
+        h1 = min(r1 + 1, nrows)
+        block[h0 - (r0 - 1):h1 - (r0 - 1), 1:-1] = fdem[h0:h1]
+        fdir[r0:r1] = _direction_block(block)
+
+    if fdem.dtype.kind != 'f':
+        fdem = fdem.astype(numpy.float64)
+    z_flat = fdem.ravel()
+    _resolve_flats(z_flat, fdir.ravel(), fdir.shape)
+    return fdir
+
+
+def in_degree(fdir):
+    '''Return the number of neighbours draining into each cell (uint8).'''
+    nrows, ncols = fdir.shape
+    indeg = numpy.zeros((nrows, ncols), dtype=numpy.uint8)
+    for code, (dr, dc) in zip(D8_CODES, D8_OFFSETS):
+        src = fdir[max(0, -dr):nrows - max(0, dr), max(0, -dc):ncols - max(0, dc)] == code
+        indeg[max(0, dr):nrows + min(0, dr), max(0, dc):ncols + min(0, dc)] += src
+    indeg[fdir == 0] = 0
+    return indeg
+
+
+def flow_accumulation(fdir, weights=None, inflow=None):
+    '''Return the float32 D8 flow accumulation of an ESRI-coded direction array.
+
+    weights  optional per-cell weight array (default 1 per cell).
+    inflow   optional array of flow entering each cell from outside the array (used by the
+             tiled mode to carry accumulation across tile edges).
+    NoData cells (direction 0) are NaN in the output.
+    '''
+    fdir = numpy.ascontiguousarray(fdir, dtype=numpy.uint8)
+    shape = fdir.shape
+    fdir_flat = fdir.ravel()
+    valid = fdir_flat > 0
+
+    indeg = in_degree(fdir).ravel()
+
+    if inflow is None:
+        facc = numpy.zeros(fdir_flat.size, dtype=numpy.float32)
+    else:
+        facc = numpy.array(inflow, dtype=numpy.float32).ravel()
+    if weights is None:
+        cell_w = None
+    else:
+        cell_w = numpy.asarray(weights, dtype=numpy.float32).ravel()
+
+    frontier = numpy.flatnonzero(valid & (indeg == 0))
+    while frontier.size:
+        down = downstream_index(frontier, fdir_flat, shape)
+        passing = down >= 0
+        if cell_w is None:
+            outflow = facc[frontier] + 1.0
+        else:
+            outflow = facc[frontier] + cell_w[frontier]
+        down = down[passing]
+        outflow = outflow[passing]
+        if not down.size:
+            break
+        receivers, inv = numpy.unique(down, return_inverse=True)
+        facc[receivers] += numpy.bincount(inv, weights=outflow).astype(numpy.float32)
+        indeg[receivers] -= numpy.bincount(inv).astype(numpy.uint8)
+        frontier = receivers[indeg[receivers] == 0]
+
+    facc[~valid] = numpy.nan
+    return facc.reshape(shape)
+
+
+def watershed(fdir, seed_idx, seed_labels):
+    '''Spatial Analyst Watershed on arrays: label every cell with the first seed it drains to.
+
+    fdir         ESRI-coded direction array
+    seed_idx     flat indices of the pour point cells (e.g. the cells of each valley segment)
+    seed_labels  label of each seed (e.g. the segment ARCID), > 0
+
+    Labels are passed upstream along the inverted D8 graph, one wave of cells at a time
+    starting from the seeds, so every cell is visited once.  Cells that do not drain through
+    a seed are 0 (NoData).  Returns an int32 array.
+    '''
+    fdir = numpy.ascontiguousarray(fdir, dtype=numpy.uint8)
+    nrows, ncols = fdir.shape
+    fdir_flat = fdir.ravel()
+    labels = numpy.zeros(fdir_flat.size, dtype=numpy.int32)
+    frontier = numpy.asarray(seed_idx, dtype=numpy.int64)
+    labels[frontier] = seed_labels
+    while frontier.size:
+        r = frontier // ncols
+        c = frontier % ncols
+        reached = []
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            rr = r + dr
+            cc = c + dc
+            inside = numpy.flatnonzero((rr >= 0) & (rr < nrows) & (cc >= 0) & (cc < ncols))
+            nb = rr[inside] * ncols + cc[inside]
+            # Neighbour drains into the frontier cell and has no label yet (seeds keep theirs)
+            up = (fdir_flat[nb] == D8_CODES[(k + 4) % 8]) & (labels[nb] == 0)
+            nb = nb[up]
+            if nb.size:
+                labels[nb] = labels[frontier[inside[up]]]
+                reached.append(nb)
+        if not reached:
+            break
+        frontier = numpy.concatenate(reached)
+    return labels.reshape(fdir.shape)
+
+
+# ###########################################################################
+# Tiled mode for DEMs larger than RAM
+#
+# The direction grid is read from a .npy file through a memory map, one tile (plus a
+# one-cell halo) at a time, so only a few tiles are ever in memory.
+#   1. Each tile is accumulated on its own (flow leaving the tile is dropped).  The worker
+#      returns the tile's exit cells (cells draining into a neighbouring tile) with their
+#      local outflow and target cell, and for each entry cell (cell receiving flow from a
+#      neighbouring tile) the exit cell its flow path leaves the tile through.
+#   2. The parent resolves the small boundary graph exit -> entry -> exit in topological
+#      order, giving the total flow entering every entry cell.
+#   3. Each tile is accumulated again seeded with those inflows and written to the output
+#      .npy files (facc and, optionally, strm/da_km/da_mi) through memory maps.
+
+def _tile_bounds(shape, tile_size):
+    nrows, ncols = shape
+    tiles = []
+    for r0 in range(0, nrows, tile_size):
+        for c0 in range(0, ncols, tile_size):
+            tiles.append((r0, min(r0 + tile_size, nrows), c0, min(c0 + tile_size, ncols)))
+    return tiles
+
+
+def _read_tile(fdir_path, bounds):
+    # Return the tile with a one-cell halo (0 = NoData/off grid) and the tile's slice of it
+    r0, r1, c0, c1 = bounds
+    fdir_mm = numpy.load(fdir_path, mmap_mode='r')
+    nrows, ncols = fdir_mm.shape
+    h0, h1 = max(r0 - 1, 0), min(r1 + 1, nrows)
+    g0, g1 = max(c0 - 1, 0), min(c1 + 1, ncols)
+    haloed = numpy.zeros((r1 - r0 + 2, c1 - c0 + 2), dtype=numpy.uint8)
+    haloed[h0 - r0 + 1:h1 - r0 + 1, g0 - c0 + 1:g1 - c0 + 1] = fdir_mm[h0:h1, g0:g1]
+    del fdir_mm
+    return haloed, haloed[1:-1, 1:-1]
+
+
+def _global_index(local_idx, bounds, shape):
+    r0, r1, c0, c1 = bounds
+    tcols = c1 - c0
+    return (local_idx // tcols + r0) * shape[1] + (local_idx % tcols + c0)
+
+
+def _tile_boundary(task):
+    # Phase 1 worker: local accumulation and boundary summary of one tile
+    fdir_path, shape, bounds = task
+    r0, r1, c0, c1 = bounds
+    haloed, tile = _read_tile(fdir_path, bounds)
+    tile = numpy.ascontiguousarray(tile)
+    tshape = tile.shape
+    tile_flat = tile.ravel()
+    facc = flow_accumulation(tile).ravel()
+
+    # Exit cells: their direction points at a valid cell of the halo
+    codes = tile_flat
+    idx = numpy.arange(tile_flat.size)
+    hr = idx // tshape[1] + 1 + _DROW[codes]
+    hc = idx % tshape[1] + 1 + _DCOL[codes]
+    leaves = (codes > 0) & ((hr == 0) | (hr == tshape[0] + 1) | (hc == 0) | (hc == tshape[1] + 1))
+    exit_local = idx[leaves]
+    exit_valid = haloed[hr[leaves], hc[leaves]] > 0
+    exit_target = numpy.where(exit_valid, (hr[leaves] - 1 + r0) * shape[1] + (hc[leaves] - 1 + c0), -1)
+    exit_out = facc[exit_local].astype(numpy.float64) + 1.0
+    del idx, hr, hc, leaves
+
+    # Entry cells: cells of the tile that a halo cell drains into
+    entry = (in_degree(haloed)[1:-1, 1:-1] - in_degree(tile)) > 0
+    entry_local = numpy.flatnonzero(entry.ravel() & (tile_flat > 0))
+
+    # Walk each entry downstream to the cell where its flow leaves the tile
+    pos = entry_local.copy()
+    active = numpy.ones(pos.size, dtype=bool)
+    while active.any():
+        down = downstream_index(pos[active], tile_flat, tshape)
+        moving = down >= 0
+        act_idx = numpy.flatnonzero(active)
+        pos[act_idx[moving]] = down[moving]
+        active[act_idx[~moving]] = False
+
+    return (_global_index(exit_local, bounds, shape), exit_out, exit_target,
+            _global_index(entry_local, bounds, shape), _global_index(pos, bounds, shape))
+
+
+def _solve_boundary(summaries):
+    # Phase 2: propagate flow through the exit -> entry -> exit graph (a DAG, since it
+    # follows the flow directions) and return {entry cell: total inflow}
+    out = {}
+    target = {}
+    exit_of = {}
+    for exit_idx, exit_out, exit_target, entry_idx, entry_exit in summaries:
+        for x, o, t in zip(exit_idx.tolist(), exit_out.tolist(), exit_target.tolist()):
+            out[x] = o
+            target[x] = t
+        for e, x in zip(entry_idx.tolist(), entry_exit.tolist()):
+            exit_of[e] = x
+
+    # Entries whose path ends inside their tile (off the grid or into NoData) pass nothing on
+    indeg = dict.fromkeys(out, 0)
+    for x, t in target.items():
+        y = exit_of.get(t)
+        if y in indeg:
+            indeg[y] += 1
+    queue = [x for x, d in indeg.items() if d == 0]
+    inflow = {}
+    while queue:
+        x = queue.pop()
+        t = target[x]
+        if t < 0:
+            continue
+        inflow[t] = inflow.get(t, 0.0) + out[x]
+        y = exit_of.get(t)
+        if y not in out:
+            continue
+        out[y] += out[x]
+        indeg[y] -= 1
+        if indeg[y] == 0:
+            queue.append(y)
+    return inflow
+
+
+def _tile_correct(task):
+    # Phase 3 worker: accumulate the tile again seeded with its inflows and write the outputs
+    fdir_path, shape, bounds, entry_idx, entry_flow, out_paths, threshold = task
+    r0, r1, c0, c1 = bounds
+    haloed, tile = _read_tile(fdir_path, bounds)
+    inflow = numpy.zeros(tile.shape, dtype=numpy.float32)
+    if len(entry_idx):
+        entry_idx = numpy.asarray(entry_idx)
+        inflow[entry_idx // shape[1] - r0, entry_idx % shape[1] - c0] = entry_flow
+    facc = flow_accumulation(tile, inflow=inflow)
+
+    products = {'facc': facc}
+    if 'strm' in out_paths:
+        with numpy.errstate(invalid='ignore'):
+            products['strm'] = (facc > threshold).astype(numpy.uint8)
+    if 'da_km' in out_paths:
+        products['da_km'] = facc / numpy.float32(CELLS_PER_KM2)
+    if 'da_mi' in out_paths:
+        products['da_mi'] = facc / numpy.float32(CELLS_PER_MI2)
+    for name, arr in products.items():
+        out_mm = numpy.load(out_paths[name], mmap_mode='r+')
+        out_mm[r0:r1, c0:c1] = arr
+        out_mm.flush()
+        del out_mm
+
+
+def _run_tasks(func, tasks, processes):
+    if processes == 1:
+        return [func(t) for t in tasks]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tiled_flow_accumulation(fdir_path, facc_path, tile_size=4096, processes=None,
+                            threshold=None, strm_path=None, da_km_path=None, da_mi_path=None):
+    '''Flow accumulation of a direction grid too large for memory, on a process pool.
+
+    fdir_path   .npy file of ESRI-coded uint8 directions (see raster_io.raster_to_npy)
+    facc_path   .npy file to create for the float32 accumulation
+    tile_size   tile edge in cells; each worker holds a few tile-sized arrays
+    processes   worker processes (None = all cores, 1 = run in this process)
+    threshold   accumulation threshold for strm_path (cells with facc > threshold = 1)
+    strm_path, da_km_path, da_mi_path   optional .npy outputs derived in the same pass
+
+    NOTE: on Windows the pool re-imports the calling script, which must therefore keep its
+    processing under an "if __name__ == '__main__':" guard.
+    '''
+    fdir_mm = numpy.load(fdir_path, mmap_mode='r')
+    shape = fdir_mm.shape
+    del fdir_mm
+    tiles = _tile_bounds(shape, tile_size)
+
+    summaries = _run_tasks(_tile_boundary, [(fdir_path, shape, b) for b in tiles], processes)
+    inflow = _solve_boundary(summaries)
+    del summaries
+
+    # Create the outputs, then let each worker fill its own tile
+    out_paths = {'facc': facc_path}
+    out_types = {'facc': numpy.float32, 'strm': numpy.uint8,
+                 'da_km': numpy.float32, 'da_mi': numpy.float32}
+    if strm_path is not None:
+        if threshold is None:
+            raise ValueError("threshold is required to derive strm")
+        out_paths['strm'] = strm_path
+    if da_km_path is not None:
+        out_paths['da_km'] = da_km_path
+    if da_mi_path is not None:
+        out_paths['da_mi'] = da_mi_path
+    for name, path in out_paths.items():
+        out_mm = numpy.lib.format.open_memmap(path, mode='w+', dtype=out_types[name], shape=shape)
+        del out_mm
+
+    # Group the resolved inflows by tile
+    ntile_cols = (shape[1] + tile_size - 1) // tile_size
+    by_tile = {}
+    for e, flow in inflow.items():
+        key = (e // shape[1]) // tile_size * ntile_cols + (e % shape[1]) // tile_size
+        by_tile.setdefault(key, []).append((e, flow))
+    tasks = []
+    for k, b in enumerate(tiles):
+        entries = by_tile.get(k, [])
+        tasks.append((fdir_path, shape, b, [e for e, f in entries], [f for e, f in entries],
+                      out_paths, threshold))
+    _run_tasks(_tile_correct, tasks, processes)
+    return out_paths
@@ -0,0 +1,476 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: map_algebra
+Description: Lazy NumPy map algebra for the ValleySegs preprocessing chain.
+
+    Calls such as Con, Float, Slope, ZonalStatistics and Reclassify (and +, -, *, / and the
+    comparisons between nodes) only build an expression graph.  Nothing is computed until
+    Graph.run() (or Graph.evaluate()) is called, and then only the nodes needed for the
+    declared outputs are evaluated, each exactly once.  Intermediate arrays are dropped as
+    soon as their last consumer has been computed, and nothing is written to disk except
+    the declared outputs and, for debugging, any node whose name is listed in debug_save.
+
+    The operations follow the Spatial Analyst conventions used in the scripts:
+        - NoData is NaN; integer zone rasters use 0 for "no zone".
+        - Con(cond, true, false) takes true where cond is non-zero, false (or NoData when
+          no false value is given) elsewhere, and NoData where cond is NoData.
+        - Slope is the Horn (1981) 3x3 method used by ArcGIS, with NoData/edge neighbours
+          replaced by the centre cell.
+        - Reclassify ranges are "from to new; ..." with the first matching range winning,
+          so a value on a shared boundary goes to the lower range (as in ArcGIS).
+
+    Graph.run(chunk_rows=...) evaluates the outputs as one fused pass instead: every
+    declared output is computed block of rows by block of rows, reading each input block
+    once, so chains of cell-wise operations (arithmetic, comparisons, Con, Float,
+    ExtractByMask, Reclassify) need no temporaries the size of the full raster.
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+import raster_io
+
+
+class Node(object):
+    '''A raster expression in a Graph. Combine nodes with + - * / and comparisons.'''
+
+    def __init__(self, graph, op, args, params=None, name=None):
+        self.graph = graph
+        self.op = op
+        self.args = args
+        self.params = params or {}
+        self.name = None
+        if name is not None:
+            graph.name(self, name)
+
+    def _binary(self, other, op, reverse=False):
+        other = self.graph._as_node(other)
+        args = (other, self) if reverse else (self, other)
+        return Node(self.graph, op, args)
+
+    def __add__(self, other):
+        return self._binary(other, 'add')
+
+    def __radd__(self, other):
+        return self._binary(other, 'add', True)
+
+    def __sub__(self, other):
+        return self._binary(other, 'sub')
+
+    def __rsub__(self, other):
+        return self._binary(other, 'sub', True)
+
+    def __mul__(self, other):
+        return self._binary(other, 'mul')
+
+    def __rmul__(self, other):
+        return self._binary(other, 'mul', True)
+
+    def __truediv__(self, other):
+        return self._binary(other, 'div')
+
+    def __rtruediv__(self, other):
+        return self._binary(other, 'div', True)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __pow__(self, other):
+        return self._binary(other, 'pow')
+
+    def __gt__(self, other):
+        return self._binary(other, 'gt')
+
+    def __ge__(self, other):
+        return self._binary(other, 'ge')
+
+    def __lt__(self, other):
+        return self._binary(other, 'lt')
+
+    def __le__(self, other):
+        return self._binary(other, 'le')
+
+
+# ###########################################################################
+# Cell operations
+
+def _binary_op(op, a, b):
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if op == 'add':
+            return a + b
+        if op == 'sub':
+            return a - b
+        if op == 'mul':
+            return a * b
+        if op == 'div':
+            return numpy.true_divide(a, b)
+        if op == 'pow':
+            return numpy.power(a, b)
+        # Comparisons give 1/0, NoData where either side is NoData
+        result = {'gt': numpy.greater, 'ge': numpy.greater_equal,
+                  'lt': numpy.less, 'le': numpy.less_equal}[op](a, b).astype(numpy.float32)
+        nodata = numpy.isnan(a) | numpy.isnan(b)
+        if numpy.ndim(result):
+            result[nodata] = numpy.nan
+        return result
+
+
+def extract_by_mask(values, mask):
+    '''Spatial Analyst ExtractByMask on arrays: values where mask has data, NoData elsewhere.'''
+    mask = numpy.asarray(mask)
+    if mask.dtype.kind == 'f':
+        outside = numpy.isnan(mask)
+    else:
+        outside = mask == 0
+    out = numpy.array(values, dtype=numpy.float32)
+    out[outside] = numpy.nan
+    return out
+
+
+def con(cond, true_value, false_value=None):
+    '''Spatial Analyst Con on arrays (NaN = NoData).'''
+    cond = numpy.asarray(cond)
+    with numpy.errstate(invalid='ignore'):
+        if cond.dtype.kind == 'f':
+            is_true = (cond != 0) & ~numpy.isnan(cond)
+            is_nodata = numpy.isnan(cond)
+        else:
+            is_true = cond != 0
+            is_nodata = numpy.zeros(cond.shape, dtype=bool)
+    if false_value is None:
+        false_value = numpy.nan
+    out = numpy.where(is_true, true_value, false_value).astype(numpy.float32)
+    out[is_nodata] = numpy.nan
+    return out
+
+
+def slope(dem, cell_size, measurement="PERCENT_RISE", z_factor=1.0):
+    '''Horn (1981) slope of a DEM array as ArcGIS computes it.'''
+    z = numpy.asarray(dem, dtype=numpy.float64) * z_factor
+    nrows, ncols = z.shape
+    zp = numpy.empty((nrows + 2, ncols + 2), dtype=numpy.float64)
+    zp.fill(numpy.nan)
+    zp[1:-1, 1:-1] = z
+
+    def nb(dr, dc):
+        # Neighbour grid with NoData/off-raster cells replaced by the centre cell
+        n = zp[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        return numpy.where(numpy.isnan(n), z, n)
+
+    return _horn_slope(nb, cell_size, measurement).astype(numpy.float32)
+
+
+def slope_at(dem, idx, cell_size, measurement="PERCENT_RISE", z_factor=1.0):
+    '''Horn slope of a DEM array at the cells with flat indices idx only (same values as slope()).
+
+    Work scales with the number of cells asked for, not with the size of the DEM.
+    '''
+    dem = numpy.asarray(dem)
+    nrows, ncols = dem.shape
+    flat = dem.ravel()
+    idx = numpy.asarray(idx, dtype=numpy.int64)
+    r = idx // ncols
+    c = idx % ncols
+    z = flat[idx].astype(numpy.float64) * z_factor
+
+    def nb(dr, dc):
+        rr = r + dr
+        cc = c + dc
+        inside = (rr >= 0) & (rr < nrows) & (cc >= 0) & (cc < ncols)
+        n = z.copy()
+        n[inside] = flat[rr[inside] * ncols + cc[inside]] * z_factor
+        return numpy.where(numpy.isnan(n), z, n)
+
+    return _horn_slope(nb, cell_size, measurement)
+
+
+def _horn_slope(nb, cell_size, measurement):
+    # Horn's 3x3 finite differences; nb(dr, dc) returns the neighbour values at offset (dr, dc)
+    a, b, c = nb(-1, -1), nb(-1, 0), nb(-1, 1)
+    d, f = nb(0, -1), nb(0, 1)
+    g, h, i = nb(1, -1), nb(1, 0), nb(1, 1)
+    dzdx = ((c + 2.0 * f + i) - (a + 2.0 * d + g)) / (8.0 * cell_size)
+    dzdy = ((g + 2.0 * h + i) - (a + 2.0 * b + c)) / (8.0 * cell_size)
+    rise = numpy.sqrt(dzdx * dzdx + dzdy * dzdy)
+    if measurement == "PERCENT_RISE":
+        return rise * 100.0
+    if measurement == "DEGREE":
+        return numpy.degrees(numpy.arctan(rise))
+    raise ValueError("measurement must be PERCENT_RISE or DEGREE")
+
+
+def zone_labels(zones):
+    '''Integer zone labels from a zone array (NaN/negative = no zone = 0).'''
+    zones = numpy.asarray(zones)
+    if zones.dtype.kind == 'f':
+        labels = numpy.where(numpy.isnan(zones), 0, zones).astype(numpy.int64)
+    else:
+        labels = zones.astype(numpy.int64)
+    labels[labels < 0] = 0
+    return labels
+
+
+def zonal_statistics(zones, values, statistic="MEAN"):
+    '''Spatial Analyst ZonalStatistics (ignoring NoData values) broadcast back to the zones.'''
+    labels = zone_labels(zones)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    use = (labels > 0) & ~numpy.isnan(values)
+    nzones = labels.max() + 1 if labels.size else 1
+    counts = numpy.bincount(labels[use], minlength=nzones)
+    if statistic == "MEAN":
+        sums = numpy.bincount(labels[use], weights=values[use], minlength=nzones)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            per_zone = sums / counts
+    elif statistic == "SUM":
+        per_zone = numpy.bincount(labels[use], weights=values[use], minlength=nzones)
+    else:
+        raise ValueError("statistic must be MEAN or SUM")
+    per_zone[counts == 0] = numpy.nan
+    per_zone[0] = numpy.nan
+    return per_zone[labels].astype(numpy.float32)
+
+
+def parse_remap(remap):
+    '''Parse a Reclassify range string "from to new;from to new;..." into a list of tuples.'''
+    ranges = []
+    for item in remap.split(';'):
+        parts = item.split()
+        if parts:
+            ranges.append((float(parts[0]), float(parts[1]), float(parts[2])))
+    return ranges
+
+
+def reclassify(values, remap, missing_values="DATA"):
+    '''Spatial Analyst Reclassify with a range remap (first matching range wins).'''
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if missing_values == "DATA":
+        out = values.copy()
+    else:
+        out = numpy.empty(values.shape)
+        out.fill(numpy.nan)
+    done = numpy.isnan(values)
+    with numpy.errstate(invalid='ignore'):
+        for low, high, new in parse_remap(remap):
+            hit = ~done & (values >= low) & (values <= high)
+            out[hit] = new
+            done |= hit
+    return out.astype(numpy.float32)
+
+
+# ###########################################################################
+# Graph
+
+class Graph(object):
+    '''Lazy raster expression graph on the grid described by a raster_io.RasterInfo.
+
+    debug_save    names of nodes to also write to debug_folder when they are computed
+    debug_folder  folder for the debug rasters (saved as debug_folder/name)
+    '''
+
+    def __init__(self, info, debug_save=(), debug_folder=None):
+        self.info = info
+        self.debug_save = set(debug_save)
+        self.debug_folder = debug_folder
+        self.outputs = []
+        self.named = {}
+
+    def _as_node(self, value):
+        if isinstance(value, Node):
+            return value
+        return Node(self, 'const', (), {'value': value})
+
+    # Sources ---------------------------------------------------------------
+    def source(self, name, data):
+        '''A raster input: an array, or a function returning the array when first needed.'''
+        return Node(self, 'source', (), {'data': data}, name)
+
+    # Spatial Analyst style operations --------------------------------------
+    def Con(self, cond, true_value, false_value=None, name=None):
+        args = (cond, self._as_node(true_value))
+        if false_value is not None:
+            args += (self._as_node(false_value),)
+        return Node(self, 'con', args, name=name)
+
+    def Float(self, x, name=None):
+        return Node(self, 'float', (x,), name=name)
+
+    def Slope(self, dem, measurement="PERCENT_RISE", z_factor=1.0, name=None):
+        return Node(self, 'slope', (dem,), {'measurement': measurement, 'z_factor': z_factor}, name)
+
+    def ZonalStatistics(self, zones, values, statistic="MEAN", name=None):
+        return Node(self, 'zonal', (zones, values), {'statistic': statistic}, name)
+
+    def Reclassify(self, x, remap, missing_values="DATA", name=None):
+        return Node(self, 'reclass', (x,), {'remap': remap, 'missing_values': missing_values}, name)
+
+    def ExtractByMask(self, x, mask, name=None):
+        return Node(self, 'extract', (x, mask), name=name)
+
+    def name(self, node, name):
+        '''Name a node (e.g. the result of an arithmetic expression) so it can be debug-saved.'''
+        node.name = name
+        self.named[name] = node
+        return node
+
+    def release(self, *names):
+        '''Forget named nodes, dropping the arrays held by sources, once they are no longer needed.'''
+        for name in names:
+            node = self.named.pop(name, None)
+            if node is not None and node.op == 'source':
+                node.params['data'] = None
+
+    # Evaluation ------------------------------------------------------------
+    def output(self, node, out_path, dtype=numpy.float32):
+        '''Declare node as a product to be written to out_path by run().
+
+        Integer dtypes are written with 0 as NoData (e.g. numpy.uint8 for a 1/NoData stream grid).
+        '''
+        self.outputs.append((node, out_path, dtype))
+        return node
+
+    def _compute(self, node, inputs, rows=None):
+        op = node.op
+        p = node.params
+        if op == 'source':
+            data = p['data']
+            if rows is not None:
+                # Fused mode: read just this block of rows
+                if hasattr(data, 'read_rows'):
+                    return data.read_rows(rows[0], rows[1])
+                if callable(data):
+                    raise ValueError("source '%s' must be an array or block reader in fused mode" % node.name)
+                return numpy.asarray(data[rows[0]:rows[1]])
+            return numpy.asarray(data() if callable(data) else data)
+        if op == 'const':
+            return p['value']
+        if op == 'float':
+            return numpy.asarray(inputs[0], dtype=numpy.float32)
+        if op == 'con':
+            return con(*inputs)
+        if op == 'extract':
+            return extract_by_mask(inputs[0], inputs[1])
+        if op == 'reclass':
+            return reclassify(inputs[0], p['remap'], p['missing_values'])
+        if rows is not None and op in ('slope', 'zonal'):
+            raise ValueError("%s is not a cell-wise operation and cannot be fused" % op)
+        if op == 'slope':
+            return slope(inputs[0], self.info.cell_size, p['measurement'], p['z_factor'])
+        if op == 'zonal':
+            return zonal_statistics(inputs[0], inputs[1], p['statistic'])
+        return _binary_op(op, inputs[0], inputs[1])
+
+    def _schedule(self, targets):
+        # Topological order of the nodes needed for targets, and how many times each is consumed
+        # (so it can be freed after its last use)
+        order = []
+        consumers = {}
+        seen = set()
+        stack = [(t, False) for t in reversed(targets)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+                continue
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            stack.append((node, True))
+            for a in node.args:
+                consumers[id(a)] = consumers.get(id(a), 0) + 1
+                if id(a) not in seen:
+                    stack.append((a, False))
+        return order, consumers
+
+    def evaluate(self, *targets):
+        '''Compute the target nodes and return their arrays (a single array for one target).'''
+        order, consumers = self._schedule(targets)
+        keep = set(id(t) for t in targets)
+        values = {}
+        for node in order:
+            inputs = [values[id(a)] for a in node.args]
+            values[id(node)] = self._compute(node, inputs)
+            if node.name in self.debug_save and self.debug_folder is not None:
+                raster_io.write_raster(values[id(node)], self.info, self.debug_folder + '/' + node.name)
+                self.debug_save.discard(node.name)   # Write each debug raster once
+            for a in node.args:
+                consumers[id(a)] -= 1
+                if consumers[id(a)] == 0 and id(a) not in keep:
+                    del values[id(a)]
+
+        results = [values[id(t)] for t in targets]
+        return results[0] if len(results) == 1 else results
+
+    def evaluate_fused(self, targets, dtypes=None, chunk_rows=1024):
+        '''Compute cell-wise targets block of rows by block of rows in a single pass.
+
+        Each input block is read once and shared by every target; only the output arrays
+        (of the given dtypes, float32 by default) are full size.
+        '''
+        nrows, ncols = self.info.shape
+        if dtypes is None:
+            dtypes = [numpy.float32] * len(targets)
+        outs = [numpy.empty((nrows, ncols), dtype=dt) for dt in dtypes]
+        order, total_consumers = self._schedule(targets)
+        keep = set(id(t) for t in targets)
+        for r0 in range(0, nrows, chunk_rows):
+            r1 = min(r0 + chunk_rows, nrows)
+            consumers = dict(total_consumers)
+            values = {}
+            for node in order:
+                inputs = [values[id(a)] for a in node.args]
+                values[id(node)] = self._compute(node, inputs, (r0, r1))
+                for a in node.args:
+                    consumers[id(a)] -= 1
+                    if consumers[id(a)] == 0 and id(a) not in keep:
+                        del values[id(a)]
+            for out, t in zip(outs, targets):
+                out[r0:r1] = _cast_block(values[id(t)], out.dtype)
+        return outs
+
+    def to_raster(self, node):
+        '''Evaluate node into an unsaved (scratch) arcpy raster for a downstream arcpy tool.'''
+        return raster_io.write_raster(self.evaluate(node), self.info)
+
+    def run(self, chunk_rows=None):
+        '''Evaluate every declared output in one sweep and write it; returns {path: arcpy.Raster}.
+
+        Named nodes listed in debug_save are evaluated (and so written) as well, even when no
+        declared output depends on them.  With chunk_rows the outputs are computed as one
+        fused, block-wise pass (cell-wise operations only, see evaluate_fused).
+        '''
+        targets = [node for node, path, dtype in self.outputs]
+        paths = [path for node, path, dtype in self.outputs]
+        dtypes = [dtype for node, path, dtype in self.outputs]
+        for name in sorted(self.debug_save):
+            node = self.named.get(name)
+            if node is not None and node not in targets:
+                targets.append(node)
+                paths.append(self.debug_folder + '/' + name if self.debug_folder else None)
+                dtypes.append(numpy.float32)
+        if not targets:
+            return {}
+        if chunk_rows is not None:
+            arrays = self.evaluate_fused(targets, dtypes, chunk_rows)
+            self.debug_save -= set(t.name for t in targets)
+        else:
+            arrays = self.evaluate(*targets)
+            if len(targets) == 1:
+                arrays = [arrays]
+            arrays = [_cast_block(a, dt) for a, dt in zip(arrays, dtypes)]
+        written = {}
+        for i, (out_path, arr) in enumerate(zip(paths, arrays)):
+            if i >= len(self.outputs) and chunk_rows is None:
+                continue    # Debug rasters already written by evaluate()
+            if out_path is not None and out_path not in written:
+                written[out_path] = raster_io.write_raster(arr, self.info, out_path)
+        self.outputs = []
+        return written
+
+
+def _cast_block(arr, dtype):
+    # Cast a result to an output dtype; NoData (NaN) becomes 0 for integer outputs
+    arr = numpy.asarray(arr)
+    if numpy.dtype(dtype).kind != 'f' and arr.dtype.kind == 'f':
+        arr = numpy.where(numpy.isnan(arr), 0, arr)
+    return arr.astype(dtype)
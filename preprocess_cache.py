@@ -0,0 +1,153 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: preprocess_cache
+Description: Content-addressed cache for the ValleySegs preprocessing products (filled DEM,
+    flow direction, flow accumulation) so a rerun with the same DEM does not recompute them.
+
+    Each stage's entry is keyed by a hash of everything it depends on: the DEM file contents
+    for the fill, the fill key plus the flow settings for the flow grids, and so on.  A change
+    to a parameter therefore only misses the stages downstream of it.  Entries are folders
+    of .npy files under the cache folder; an index (index.json) records their size and last
+    use, and the least recently used entries are deleted once the cache grows past max_bytes.
+
+    The index is written every flush_every puts and by flush(), not on every look-up.  It is
+    written to a temporary file and renamed over index.json, merged first with the entries
+    another process sharing the folder may have added meanwhile.
+__________________________________________________________________________________________________
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy
+
+_CHUNK = 16 * 1024 * 1024     # Bytes read at a time when hashing files
+
+
+def file_digest(path):
+    '''SHA-1 of a raster's contents: a file, or every file of a folder (e.g. an ESRI grid).'''
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                files.append(os.path.join(root, name))
+    else:
+        files = [path]
+    for f in files:
+        h.update(os.path.relpath(f, path).encode('utf-8'))
+        with open(f, 'rb') as fh:
+            chunk = fh.read(_CHUNK)
+            while chunk:
+                h.update(chunk)
+                chunk = fh.read(_CHUNK)
+    return h.hexdigest()
+
+
+def _replace(src, dst):
+    # Rename src over dst, atomically where the platform allows it
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)      # Python 2 on Windows cannot rename over an existing file
+        os.rename(src, dst)
+
+
+class StageCache(object):
+    '''Cache of stage products in folder, bounded to max_bytes with least-recently-used eviction.
+
+    flush_every   puts between writes of the index (1 = after every put); call flush() once
+                  the cache is no longer needed so the last uses are recorded
+    '''
+
+    def __init__(self, folder, max_bytes, flush_every=1):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.index_path = os.path.join(folder, 'index.json')
+        self.index = self._load_index()
+        self._evicted = set()
+        self._dirty = False
+        self._puts = 0
+
+    def key(self, stage, *params):
+        '''Key of a stage from its name and the (repr-able) keys/parameters it depends on.'''
+        return stage + '_' + hashlib.sha1(repr((stage,) + params).encode('utf-8')).hexdigest()
+
+    def get(self, key, mmap_mode=None):
+        '''Return {name: array} of a cached entry (marking it as used), or None on a miss.'''
+        entry = self.index.get(key)
+        path = os.path.join(self.folder, key)
+        if entry is None or not os.path.isdir(path):
+            return None
+        arrays = {}
+        for name in entry['names']:
+            arrays[name] = numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        entry['used'] = time.time()
+        self._dirty = True
+        return arrays
+
+    def put(self, key, **arrays):
+        '''Store arrays under key, then evict least recently used entries down to max_bytes.'''
+        path = os.path.join(self.folder, key)
+        scratch = path + '.tmp'
+        shutil.rmtree(scratch, True)
+        os.makedirs(scratch)
+        nbytes = 0
+        for name, arr in arrays.items():
+            numpy.save(os.path.join(scratch, name + '.npy'), arr)
+            nbytes += os.path.getsize(os.path.join(scratch, name + '.npy'))
+        shutil.rmtree(path, True)
+        os.rename(scratch, path)
+        self.index[key] = {'names': sorted(arrays), 'bytes': nbytes, 'used': time.time()}
+        self._evicted.discard(key)
+        self._evict(key)
+        self._dirty = True
+        self._puts += 1
+        if self._puts >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        '''Write the index if it changed since it was last written.'''
+        if not self._dirty:
+            return
+        # Keep entries another process added since the index was read
+        for key, entry in self._load_index().items():
+            if key in self._evicted or not os.path.isdir(os.path.join(self.folder, key)):
+                continue
+            mine = self.index.get(key)
+            if mine is None or entry['used'] > mine['used']:
+                self.index[key] = entry
+        scratch = '%s.%d.tmp' % (self.index_path, os.getpid())
+        with open(scratch, 'w') as fh:
+            json.dump(self.index, fh)
+        _replace(scratch, self.index_path)
+        self._dirty = False
+        self._puts = 0
+
+    def _evict(self, keep):
+        total = sum(e['bytes'] for e in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index.pop(key)['bytes']
+            self._evicted.add(key)
+            shutil.rmtree(os.path.join(self.folder, key), True)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as fh:
+            return json.load(fh)
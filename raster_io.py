@@ -0,0 +1,306 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: raster_io
+Description: Helpers for moving rasters between ArcGIS and NumPy so the NumPy engines used by
+    ValleySegs_rrm_test.py and HGVC10_rrm_test.py can read their inputs and write their
+    products on the same grid (extent, cell size, spatial reference) as the source DEM.
+
+    NoData cells are carried as NaN in floating point arrays.  Integer arrays (flow
+    direction, link and segment labels) use 0 as NoData, matching the ESRI convention that
+    label 0 is "no zone".
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+FLOAT_NODATA = -3.4028235e+38   # Value written to disk for NaN cells (ESRI float NoData)
+
+
+class RasterInfo(object):
+    '''Grid description needed to write an array back out on the source grid.'''
+
+    def __init__(self, x_min, y_min, cell_size, nrows, ncols, nodata=None, spatial_reference=None):
+        self.x_min = float(x_min)
+        self.y_min = float(y_min)
+        self.cell_size = float(cell_size)
+        self.nrows = int(nrows)
+        self.ncols = int(ncols)
+        self.nodata = nodata
+        self.spatial_reference = spatial_reference
+
+    @property
+    def y_max(self):
+        return self.y_min + self.nrows * self.cell_size
+
+    @property
+    def x_max(self):
+        return self.x_min + self.ncols * self.cell_size
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    def window(self, box, margin=0.0):
+        '''(r0, r1, c0, c1): rows r0..r1-1 and columns c0..c1-1 of the cells overlapping box
+        (xmin, ymin, xmax, ymax) grown by margin, clipped to the grid.'''
+        cs = self.cell_size
+        c0 = max(int(numpy.floor((box[0] - margin - self.x_min) / cs)), 0)
+        c1 = min(int(numpy.ceil((box[2] + margin - self.x_min) / cs)), self.ncols)
+        r0 = max(int(numpy.floor((self.y_max - box[3] - margin) / cs)), 0)
+        r1 = min(int(numpy.ceil((self.y_max - box[1] + margin) / cs)), self.nrows)
+        return r0, max(r1, r0), c0, max(c1, c0)
+
+    def subgrid(self, r0, r1, c0, c1):
+        '''RasterInfo of the window rows r0..r1-1, columns c0..c1-1 of this grid.'''
+        return RasterInfo(self.x_min + c0 * self.cell_size, self.y_max - r1 * self.cell_size,
+                          self.cell_size, r1 - r0, c1 - c0, self.nodata, self.spatial_reference)
+
+
+def describe_raster(raster):
+    '''Return a RasterInfo for an ArcGIS raster (path or arcpy.Raster).'''
+    import arcpy
+    r = arcpy.Raster(raster) if not isinstance(raster, arcpy.Raster) else raster
+    ext = r.extent
+    return RasterInfo(ext.XMin, ext.YMin, r.meanCellWidth, r.height, r.width,
+                      r.noDataValue, r.spatialReference)
+
+
+def read_raster(raster, dtype=numpy.float32):
+    '''Read an ArcGIS raster into a NumPy array.
+
+    Floating point results have NoData replaced by NaN; integer results have NoData
+    replaced by 0.  Returns (array, RasterInfo).
+    '''
+    import arcpy
+    info = describe_raster(raster)
+    arr = _nodata_to_value(arcpy.RasterToNumPyArray(raster), info.nodata, dtype)
+    return arr, info
+
+
+def _nodata_to_value(arr, nodata, dtype):
+    # Cast a block read from ArcGIS and mark its NoData cells (NaN for float, 0 for integer)
+    nodata_mask = None
+    if nodata is not None:
+        nodata_mask = (arr == nodata)
+    arr = arr.astype(dtype)
+    if nodata_mask is not None:
+        if numpy.dtype(dtype).kind == 'f':
+            arr[nodata_mask] = numpy.nan
+        else:
+            arr[nodata_mask] = 0
+    return arr
+
+
+def _to_arcpy(arr, x_min, y_min, cell_size):
+    # NumPyArrayToRaster with NaN (float) or 0 (integer) as NoData
+    import arcpy
+    arr = numpy.asarray(arr)
+    if arr.dtype.kind == 'f':
+        out = numpy.where(numpy.isnan(arr), FLOAT_NODATA, arr).astype(arr.dtype)
+        nodata = FLOAT_NODATA
+    else:
+        out = arr
+        nodata = 0
+    return arcpy.NumPyArrayToRaster(out, arcpy.Point(x_min, y_min), cell_size, cell_size, nodata)
+
+
+class RasterRows(object):
+    '''Block reader for an ArcGIS raster: read_rows(r0, r1) returns rows r0..r1-1 as an array.
+
+    Used as a map_algebra source so fused evaluation reads each input block once instead of
+    loading the whole raster.  read_box reads only the window around a feature (e.g. one
+    valley block), so per-block reads scale with the block rather than the raster.
+    '''
+
+    def __init__(self, raster, dtype=numpy.float32):
+        self.raster = raster
+        self.dtype = dtype
+        self.info = describe_raster(raster)
+
+    def read_rows(self, r0, r1):
+        import arcpy
+        info = self.info
+        lower_left = arcpy.Point(info.x_min, info.y_max - r1 * info.cell_size)
+        block = arcpy.RasterToNumPyArray(self.raster, lower_left, info.ncols, r1 - r0)
+        return _nodata_to_value(block, info.nodata, self.dtype)
+
+    def read_window(self, r0, r1, c0, c1):
+        '''Rows r0..r1-1, columns c0..c1-1 as an array.'''
+        import arcpy
+        info = self.info
+        if r1 <= r0 or c1 <= c0:
+            return numpy.zeros((max(r1 - r0, 0), max(c1 - c0, 0)), dtype=self.dtype)
+        lower_left = arcpy.Point(info.x_min + c0 * info.cell_size, info.y_max - r1 * info.cell_size)
+        block = arcpy.RasterToNumPyArray(self.raster, lower_left, c1 - c0, r1 - r0)
+        return _nodata_to_value(block, info.nodata, self.dtype)
+
+    def read_box(self, box, margin=0.0):
+        '''Read the cells overlapping box (xmin, ymin, xmax, ymax) grown by margin.
+
+        Returns (array, RasterInfo of the window).
+        '''
+        r0, r1, c0, c1 = self.info.window(box, margin)
+        return self.read_window(r0, r1, c0, c1), self.info.subgrid(r0, r1, c0, c1)
+
+
+def write_raster(arr, info, out_path=None):
+    '''Write a NumPy array to an ArcGIS raster on the grid described by info.
+
+    NaN (float) or 0 (integer) cells are written as NoData.  The raster is saved to out_path
+    when given; the arcpy.Raster object is returned either way.
+    '''
+    import arcpy
+    ras = _to_arcpy(arr, info.x_min, info.y_min, info.cell_size)
+    if out_path is not None:
+        ras.save(out_path)
+        if info.spatial_reference is not None:
+            arcpy.DefineProjection_management(out_path, info.spatial_reference)
+    return ras
+
+
+def add_value_field(raster_path, field, per_value, field_type="LONG"):
+    '''Add a field to the attribute table of an integer raster, set to per_value[VALUE] for each row.
+
+    Used to give rasters labelled in NumPy the attribute fields arcpy tools expect (e.g. the
+    "LINK" field RegionGroup adds with ADD_LINK).
+    '''
+    import arcpy
+    arcpy.BuildRasterAttributeTable_management(raster_path, "Overwrite")
+    arcpy.AddField_management(raster_path, field, field_type)
+    rows = arcpy.UpdateCursor(raster_path)
+    row = rows.next()
+    while row:
+        row.setValue(field, per_value[int(row.getValue("VALUE"))].item())
+        rows.updateRow(row)
+        row = rows.next()
+    del row, rows
+
+
+# ###########################################################################
+# Feature masks on a grid (in-memory replacement for the mask step of ExtractByMask)
+
+def polygon_mask(rings, info):
+    '''Boolean grid: cells of info whose centres fall inside a polygon.
+
+    rings   vertex lists [(x, y), ...] of all rings (outer and holes) of the polygon; a cell
+            is inside when a ray from its centre crosses the rings an odd number of times
+
+    Every edge lists its crossings with the row centre lines; each crossing toggles the cells
+    to its right, and a cumulative sum along the rows turns the toggles into the mask.
+    '''
+    nrows, ncols = info.shape
+    cs = info.cell_size
+    toggles = numpy.zeros(nrows * (ncols + 1), dtype=numpy.int64)
+    for ring in rings:
+        xy = numpy.asarray(ring, dtype=numpy.float64).reshape(-1, 2)
+        if xy.shape[0] < 2:
+            continue
+        x0, y0 = xy[:, 0], xy[:, 1]
+        x1, y1 = numpy.roll(x0, -1), numpy.roll(y0, -1)
+        # Rows around each edge, then those whose centre y has min(y0, y1) <= y < max(y0, y1)
+        #   (half open, so a vertex shared by two edges is crossed once)
+        lo = numpy.minimum(y0, y1)
+        hi = numpy.maximum(y0, y1)
+        first = numpy.maximum(numpy.floor((info.y_max - hi) / cs - 0.5).astype(numpy.int64), 0)
+        last = numpy.minimum(numpy.ceil((info.y_max - lo) / cs - 0.5).astype(numpy.int64), nrows - 1)
+        count = numpy.maximum(last - first + 1, 0)
+        if not count.sum():
+            continue
+        edge = numpy.repeat(numpy.arange(xy.shape[0]), count)
+        row = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count) + first[edge]
+        y = info.y_max - (row + 0.5) * cs
+        keep = (y >= lo[edge]) & (y < hi[edge])
+        edge = edge[keep]
+        row = row[keep]
+        y = y[keep]
+        x = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        col = numpy.clip(numpy.ceil((x - info.x_min) / cs - 0.5), 0, ncols).astype(numpy.int64)
+        toggles += numpy.bincount(row * (ncols + 1) + col, minlength=toggles.size)
+    inside = numpy.cumsum(toggles.reshape(nrows, ncols + 1), axis=1) % 2 == 1
+    return inside[:, :ncols]
+
+
+def polyline_mask(paths, info, step=0.25):
+    '''Boolean grid: cells of info a polyline passes through.
+
+    paths   vertex lists [(x, y), ...] of the parts of the line
+    step    sampling interval along the line, in cells
+    '''
+    nrows, ncols = info.shape
+    cs = info.cell_size
+    mask = numpy.zeros((nrows, ncols), dtype=bool)
+    for path in paths:
+        xy = numpy.asarray(path, dtype=numpy.float64).reshape(-1, 2)
+        if not xy.shape[0]:
+            continue
+        # Points every step cells along each edge, plus the vertices
+        d = numpy.hypot(numpy.diff(xy[:, 0]), numpy.diff(xy[:, 1]))
+        count = numpy.ceil(d / (step * cs)).astype(numpy.int64) + 1
+        edge = numpy.repeat(numpy.arange(d.size), count)
+        t = (numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)) / \
+            numpy.repeat(count.astype(numpy.float64), count)
+        x = numpy.append(xy[edge, 0] + t * (xy[edge + 1, 0] - xy[edge, 0]), xy[-1, 0])
+        y = numpy.append(xy[edge, 1] + t * (xy[edge + 1, 1] - xy[edge, 1]), xy[-1, 1])
+        col = numpy.floor((x - info.x_min) / cs).astype(numpy.int64)
+        row = numpy.floor((info.y_max - y) / cs).astype(numpy.int64)
+        on = (row >= 0) & (row < nrows) & (col >= 0) & (col < ncols)
+        mask[row[on], col[on]] = True
+    return mask
+
+
+# ###########################################################################
+# Block-wise conversion for rasters larger than memory (used by the tiled flow mode)
+
+def raster_to_npy(raster, npy_path, dtype=numpy.float32, block_rows=4096):
+    '''Copy an ArcGIS raster into a .npy file one block of rows at a time.
+
+    Returns the RasterInfo of the source so the results can be written back on its grid.
+    '''
+    import arcpy
+    info = describe_raster(raster)
+    out = numpy.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=info.shape)
+    for r0 in range(0, info.nrows, block_rows):
+        nrows = min(block_rows, info.nrows - r0)
+        lower_left = arcpy.Point(info.x_min, info.y_max - (r0 + nrows) * info.cell_size)
+        block = arcpy.RasterToNumPyArray(raster, lower_left, info.ncols, nrows)
+        out[r0:r0 + nrows] = _nodata_to_value(block, info.nodata, dtype)
+    out.flush()
+    del out
+    return info
+
+
+def npy_to_raster(npy_path, info, out_path, block_rows=4096):
+    '''Write a .npy file to an ArcGIS raster on the grid of info, one block of rows at a time.
+
+    Each block is saved to a scratch raster and the blocks are mosaicked into the first one,
+    which is then copied to out_path.
+    '''
+    import arcpy
+    import shutil
+    import tempfile
+    arr = numpy.load(npy_path, mmap_mode='r')
+    scratch = tempfile.mkdtemp()
+    blocks = []
+    try:
+        for r0 in range(0, info.nrows, block_rows):
+            nrows = min(block_rows, info.nrows - r0)
+            y_min = info.y_max - (r0 + nrows) * info.cell_size
+            block = _to_arcpy(numpy.array(arr[r0:r0 + nrows]), info.x_min, y_min, info.cell_size)
+            block_path = scratch + '/b' + str(len(blocks)) + '.tif'
+            block.save(block_path)
+            blocks.append(block_path)
+        del arr
+        if len(blocks) > 1:
+            arcpy.Mosaic_management(';'.join(blocks[1:]), blocks[0])
+        arcpy.CopyRaster_management(blocks[0], out_path)
+        if info.spatial_reference is not None:
+            arcpy.DefineProjection_management(out_path, info.spatial_reference)
+    finally:
+        for b in blocks:
+            try:
+                arcpy.Delete_management(b)
+            except:
+                pass
+        shutil.rmtree(scratch, True)
+    return arcpy.Raster(out_path)
@@ -0,0 +1,113 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: segment_catalog
+Description: Per-segment attributes for HGVC10_rrm_test.py, read once into a NumPy structured
+    array (replacement for the repeated SearchCursor passes over the segment shapefile and
+    the s_length_dict / slope_class_dict / iter_ARCID_dict dictionaries).
+
+    One row per segment, in shapefile order:
+        ARCID, SLength, GRID_CODE (slope class)
+        start_x/start_y, mid_x/mid_y, end_x/end_y   first point, centroid and last point
+        blk_xmin/blk_ymin/blk_xmax/blk_ymax         extent of the segment's valley block
+                                                    (NaN when the segment has no block)
+    and an ARCID -> row index, so every later stage looks a segment up directly.
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+import vector_io
+
+SEGMENT_DTYPE = numpy.dtype([
+    ('ARCID', numpy.int32), ('SLength', numpy.float64), ('GRID_CODE', numpy.int32),
+    ('start_x', numpy.float64), ('start_y', numpy.float64),
+    ('mid_x', numpy.float64), ('mid_y', numpy.float64),
+    ('end_x', numpy.float64), ('end_y', numpy.float64),
+    ('blk_xmin', numpy.float64), ('blk_ymin', numpy.float64),
+    ('blk_xmax', numpy.float64), ('blk_ymax', numpy.float64)])
+
+
+class SegmentCatalog(object):
+    '''Structured array of segment attributes (see SEGMENT_DTYPE) with an ARCID -> row index.'''
+
+    def __init__(self, records):
+        self.records = records
+        self.row_of = dict(zip(records['ARCID'].tolist(), range(records.size)))
+
+    def __len__(self):
+        return self.records.size
+
+    def __contains__(self, arcid):
+        return arcid in self.row_of
+
+    def __getitem__(self, arcid):
+        '''The record of a segment by ARCID (fields read as rec['SLength'] etc.).'''
+        return self.records[self.row_of[arcid]]
+
+    def select(self, start_arcid=0, max_arcid=None):
+        '''Rows (in catalog order) of the segments with start_arcid <= ARCID <= max_arcid.'''
+        arcid = self.records['ARCID']
+        keep = arcid >= start_arcid
+        if max_arcid is not None:
+            keep &= arcid <= max_arcid
+        return numpy.flatnonzero(keep)
+
+    def has_block(self):
+        '''Boolean array: which rows have a valley block.'''
+        return ~numpy.isnan(self.records['blk_xmin'])
+
+
+def build_catalog(segments, blocks=None):
+    '''Build a SegmentCatalog from in-memory features (vector_io.FeatureStore).
+
+    segments  store of the segment shapefile (the ValleySegs _segs) keyed by ARCID, holding
+              the SLength and GRID_CODE fields
+    blocks    optional store of the valley blocks (the ValleySegs _blks) keyed by the ARCID
+              of each block, for the block extents
+    '''
+    records = numpy.zeros(len(segments), dtype=SEGMENT_DTYPE)
+    for i, arcid in enumerate(segments.keys):
+        feat = segments.geometry[arcid]
+        length, grid_code = segments.values[arcid]
+        first = feat.firstPoint
+        last = feat.lastPoint
+        mid = feat.centroid
+        if blocks is not None and arcid in blocks:
+            ext = blocks.geometry[arcid].extent
+            bbox = (ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+        else:
+            bbox = (numpy.nan, numpy.nan, numpy.nan, numpy.nan)
+        records[i] = (arcid, length, grid_code, first.X, first.Y, mid.X, mid.Y, last.X, last.Y) + bbox
+    return SegmentCatalog(records)
+
+
+def read_catalog(segments, blocks=None, block_field="GRIDCODE"):
+    '''Build a SegmentCatalog from the segment (and optional block) shapefiles, one pass each.'''
+    seg_store = vector_io.FeatureStore(segments, "ARCID", ("SLength", "GRID_CODE"))
+    blk_store = vector_io.FeatureStore(blocks, block_field) if blocks is not None else None
+    return build_catalog(seg_store, blk_store)
+
+
+def cutline_extensions(records, distance):
+    '''Extension lines continuing every segment beyond both of its ends (HGVC section F).
+
+    Each end is extended by distance along the direction from the segment centroid to that
+    end point, so the extensions of both ends point away from the segment.  Returns arrays
+    (ARCID, E1S0, x1, y1, x2, y2) with E1S0 = 1 for the end and 0 for the start extension;
+    an end that coincides with the centroid has no direction and gets no extension.
+    '''
+    arcid = numpy.concatenate((records['ARCID'], records['ARCID']))
+    e1s0 = numpy.repeat(numpy.array([1, 0], dtype=numpy.int32), records.size)
+    x1 = numpy.concatenate((records['end_x'], records['start_x']))
+    y1 = numpy.concatenate((records['end_y'], records['start_y']))
+    mid_x = numpy.concatenate((records['mid_x'], records['mid_x']))
+    mid_y = numpy.concatenate((records['mid_y'], records['mid_y']))
+    dx = x1 - mid_x
+    dy = y1 - mid_y
+    norm = numpy.hypot(dx, dy)
+    ok = norm > 0
+    scale = distance / norm[ok]
+    x2 = x1[ok] + dx[ok] * scale
+    y2 = y1[ok] + dy[ok] * scale
+    return arcid[ok], e1s0[ok], x1[ok], y1[ok], x2, y2
@@ -0,0 +1,284 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: stream_network
+Description: Stream network analysis on the stream cells only (replacement for the StreamLink
+    -> ZonalStatistics(MEAN) -> Raster Calculator -> ZonalStatistics(MEAN) -> Reclassify
+    slope-smoothing chain of ValleySegs_rrm_test.py).
+
+    The stream cells (strm = 1) are a small fraction of the DEM, so everything here works on
+    the flat indices of those cells: the D8 links between them, the link labels and the
+    per-link statistics are all 1D arrays of length "number of stream cells".  Only the
+    final class grid handed to the next arcpy tool is full size.
+
+    Links follow StreamLink: a link starts at every stream cell that does not have exactly
+    one stream cell draining into it (channel heads and the cells just below a junction) and
+    continues downstream until the next such cell.  Links are numbered 1..n in raster order
+    of their first cell.
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+import flow_routing
+import map_algebra
+
+# ValleySegs slope classes: 1 = < 0.1 %, 2 = 0.1 - 3 %, 3 = > 3 %
+SLOPE_CLASS_REMAP = "0 0.10000000000000001 1;0.10000000000000001 3 2;3 10000 3"
+
+
+class StreamCells(object):
+    '''The stream cells of a grid and their D8 connections to each other.
+
+    idx    sorted flat indices of the stream cells
+    down   position (in idx) of the stream cell each cell drains to, -1 where the flow leaves
+           the network (outlet)
+    up_count  number of stream cells draining into each cell
+    code   ESRI D8 flow direction of each cell
+    '''
+
+    def __init__(self, fdir, strm):
+        fdir = numpy.ascontiguousarray(fdir, dtype=numpy.uint8)
+        self.shape = fdir.shape
+        strm = numpy.asarray(strm)
+        if strm.dtype.kind == 'f':
+            with numpy.errstate(invalid='ignore'):
+                is_strm = strm > 0
+        else:
+            is_strm = strm != 0
+        self.idx = numpy.flatnonzero(is_strm.ravel() & (fdir.ravel() > 0))
+        del is_strm
+
+        down_cell = flow_routing.downstream_index(self.idx, fdir.ravel(), self.shape)
+        pos = numpy.minimum(numpy.searchsorted(self.idx, down_cell), max(self.idx.size - 1, 0))
+        self.down = -numpy.ones(self.idx.size, dtype=numpy.int64)
+        if self.idx.size:
+            in_strm = (down_cell >= 0) & (self.idx[pos] == down_cell)
+            self.down[in_strm] = pos[in_strm]
+        self.up_count = numpy.bincount(self.down[self.down >= 0], minlength=self.idx.size)
+        self.code = fdir.ravel()[self.idx]
+
+    @property
+    def size(self):
+        return self.idx.size
+
+    def to_grid(self, values, dtype=numpy.float32):
+        '''Spread per-stream-cell values onto a full grid (NoData elsewhere: NaN, or 0 for integers).'''
+        if numpy.dtype(dtype).kind == 'f':
+            grid = numpy.empty(self.shape, dtype=dtype)
+            grid.fill(numpy.nan)
+        else:
+            grid = numpy.zeros(self.shape, dtype=dtype)
+        grid.ravel()[self.idx] = values
+        return grid
+
+
+def _link_upstream(cells):
+    # Upstream stream cell of every cell inside a link; link starts point at themselves
+    starts = cells.up_count != 1
+    up = numpy.arange(cells.size)
+    single = cells.down >= 0
+    single[single] = ~starts[cells.down[single]]
+    up[cells.down[single]] = numpy.flatnonzero(single)
+    return starts, up
+
+
+def stream_links(cells):
+    '''Return the StreamLink label (1..n) of every stream cell of a StreamCells.
+
+    Each cell inside a link has exactly one upstream stream cell, so labels are passed down
+    the links by pointer jumping: log2(longest link) vectorised passes.
+    '''
+    starts, root = _link_upstream(cells)
+    while True:
+        nxt = root[root]
+        if numpy.array_equal(nxt, root):
+            break
+        root = nxt
+    label = numpy.zeros(cells.size, dtype=numpy.int64)
+    label[starts] = numpy.arange(1, starts.sum() + 1)
+    return label[root]
+
+
+def link_rank(cells):
+    '''Return the number of D8 steps from the start of its link to every stream cell.
+
+    List ranking by pointer jumping, so the cells of each link can be put in flow order with
+    one sort of (label, rank).
+    '''
+    starts, up = _link_upstream(cells)
+    rank = (~starts).astype(numpy.int64)
+    while True:
+        rank += rank[up]    # Link starts have rank 0, so pointers that reached them add nothing
+        nxt = up[up]
+        if numpy.array_equal(nxt, up):
+            break
+        up = nxt
+    return rank
+
+
+def link_means(labels, values):
+    '''Mean of values over each link label; returns an array indexed by label (NaN for label 0).'''
+    nlinks = labels.max() + 1 if labels.size else 1
+    counts = numpy.bincount(labels, minlength=nlinks)
+    sums = numpy.bincount(labels, weights=values, minlength=nlinks)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means[0] = numpy.nan
+    return means
+
+
+def segment_slope_classes(fdem, fdir, strm, cell_size, remap=SLOPE_CLASS_REMAP):
+    '''Slope class (uint8 grid, 0 = NoData) of every stream link, as seg_slp_cls in ValleySegs.
+
+    Same result as Slope -> StreamLink -> ZonalStatistics(MEAN) -> (slope + link mean) / 2 ->
+    ZonalStatistics(MEAN) -> Reclassify with the mask on the stream cells.  The second zonal
+    mean equals the first (the mean over a link of (s + m) / 2 is m), so each link's class is
+    that of its mean channel slope, computed once in float64.
+
+    Returns (seg_slp_cls, cells, labels) so callers can reuse the stream cells and links.
+    '''
+    cells = StreamCells(fdir, strm)
+    labels = stream_links(cells)
+    slp = map_algebra.slope_at(fdem, cells.idx, cell_size, "PERCENT_RISE", 1.0)
+    per_link = map_algebra.reclassify(link_means(labels, slp), remap, "NODATA")
+    cls = per_link[labels]
+    cls[numpy.isnan(cls)] = 0
+    return cells.to_grid(cls.astype(numpy.uint8), numpy.uint8), cells, labels
+
+
+# ###########################################################################
+# Region grouping (replacement for RegionGroup(seg_slp_cls, "EIGHT", "WITHIN", "ADD_LINK"))
+
+# Forward half of the 8-neighbourhood: each adjacent pair of cells is found once
+_FORWARD_OFFSETS = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def _neighbour_pairs(shape, idx, values):
+    # Positions (in idx) of all 8-connected pairs of listed cells with equal values
+    nrows, ncols = shape
+    r = idx // ncols
+    c = idx % ncols
+    firsts = []
+    seconds = []
+    for dr, dc in _FORWARD_OFFSETS:
+        rr = r + dr
+        cc = c + dc
+        inside = numpy.flatnonzero((rr < nrows) & (cc >= 0) & (cc < ncols))
+        nb = rr[inside] * ncols + cc[inside]
+        pos = numpy.minimum(numpy.searchsorted(idx, nb), idx.size - 1)
+        hit = (idx[pos] == nb) & (values[inside] == values[pos])
+        firsts.append(inside[hit])
+        seconds.append(pos[hit])
+    return numpy.concatenate(firsts), numpy.concatenate(seconds)
+
+
+def region_group(shape, idx, values):
+    '''8-connected regions of equal value among the cells idx (sorted flat indices) of a grid.
+
+    Union-find over the adjacent pairs: every pass hooks the root of each pair onto the
+    smaller of the two roots, then compresses the paths, until no pair joins two regions.
+    Only the listed cells are touched, so runtime follows the number of stream cells.
+
+    Returns (labels, counts, link): the region label (1..n, numbered in raster order of the
+    first cell, as RegionGroup does) of every cell, and the cell COUNT and the original value
+    (the ADD_LINK "LINK" field) of every label (index 0 unused).
+    '''
+    idx = numpy.asarray(idx, dtype=numpy.int64)
+    values = numpy.asarray(values)
+    n = idx.size
+    parent = numpy.arange(n)
+    if n:
+        a, b = _neighbour_pairs(shape, idx, values)
+        while a.size:
+            ra = parent[a]
+            rb = parent[b]
+            joined = ra != rb
+            if not joined.any():
+                break
+            a = a[joined]
+            b = b[joined]
+            ra = ra[joined]
+            rb = rb[joined]
+            # Roots only ever point at smaller roots, so any one of several hooks may win
+            parent[numpy.maximum(ra, rb)] = numpy.minimum(ra, rb)
+            while True:
+                nxt = parent[parent]
+                if numpy.array_equal(nxt, parent):
+                    break
+                parent = nxt
+    roots = parent == numpy.arange(n)
+    label_of_root = numpy.zeros(n, dtype=numpy.int64)
+    label_of_root[roots] = numpy.arange(1, roots.sum() + 1)
+    labels = label_of_root[parent]
+    counts = numpy.bincount(labels, minlength=roots.sum() + 1)
+    link = numpy.zeros(roots.sum() + 1, dtype=values.dtype)
+    link[labels] = values
+    return labels, counts, link
+
+
+# ###########################################################################
+# Vectorising (replacement for RasterToPolyline + SLength + deleting short segments)
+
+_STEP = numpy.zeros(129)    # D8 step length (in cells) indexed by direction code
+for _code, _dist in zip(flow_routing.D8_CODES, flow_routing.D8_DISTANCE):
+    _STEP[_code] = _dist
+
+
+def segment_polylines(cells, links, segments, grid_code, info, min_length=0.0):
+    '''Trace the valley segments of a stream network as ordered polylines.
+
+    cells      StreamCells of the network
+    links      stream link label of every stream cell (stream_links)
+    segments   segment label of every stream cell (region_group), 0 = not a segment cell
+    grid_code  value of every segment label (the region_group LINK, i.e. the slope class)
+    info       raster_io.RasterInfo of the grid, for the cell-centre coordinates
+    min_length segments this long or shorter (in map units) are dropped
+
+    An arc is a run of cells of one link and one segment, walked downstream; it ends on the
+    centre of the cell it drains into, as RasterToPolyline joins arcs at junctions.  Its
+    length is the sum of the D8 steps (cell size, or cell size * sqrt(2) on diagonals).
+    Vertices in the middle of straight runs are left out.
+
+    Returns (lines, arcids): a list of (ARCID, GRID_CODE, SLength, [(x, y), ...]) with
+    ARCID = 1..n in order, and the ARCID of every stream cell (0 for cells of dropped or no
+    segments), e.g. as the pour points of flow_routing.watershed.
+    '''
+    arcids = numpy.zeros(cells.size, dtype=numpy.int32)
+    use = numpy.flatnonzero(segments > 0)
+    if not use.size:
+        return [], arcids
+    rank = link_rank(cells)
+    order = use[numpy.lexsort((rank[use], segments[use], links[use]))]
+    new_arc = numpy.ones(order.size, dtype=bool)
+    new_arc[1:] = (links[order[1:]] != links[order[:-1]]) | (segments[order[1:]] != segments[order[:-1]])
+    arc_of = numpy.cumsum(new_arc) - 1
+    first = numpy.flatnonzero(new_arc)
+    last = numpy.append(first[1:], order.size) - 1
+
+    step = numpy.where(cells.down[order] >= 0, _STEP[cells.code[order]], 0.0) * info.cell_size
+    length = numpy.bincount(arc_of, weights=step)
+    keep = numpy.flatnonzero(length > min_length)
+    arc_ids = numpy.zeros(length.size, dtype=numpy.int32)
+    arc_ids[keep] = numpy.arange(1, keep.size + 1)
+    arcids[order] = arc_ids[arc_of]
+
+    # Vertices: turning points of each run plus the cell the run drains into
+    turn = numpy.ones(order.size, dtype=bool)
+    turn[1:] = cells.code[order[1:]] != cells.code[order[:-1]]
+    turn[first] = True
+    turn[last] = True
+    ncols = info.ncols
+    x = info.x_min + (cells.idx % ncols + 0.5) * info.cell_size
+    y = info.y_max - (cells.idx // ncols + 0.5) * info.cell_size
+
+    lines = []
+    for arcid, a in enumerate(keep.tolist()):
+        run = order[first[a]:last[a] + 1]
+        pts = run[turn[first[a]:last[a] + 1]]
+        end = cells.down[run[-1]]
+        if end >= 0:
+            pts = numpy.append(pts, end)
+        lines.append((arcid + 1, grid_code[segments[run[0]]].item(), float(length[a]),
+                      list(zip(x[pts].tolist(), y[pts].tolist()))))
+    return lines, arcids
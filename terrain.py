@@ -0,0 +1,114 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: terrain
+Description: Terrain derivatives of a whole DEM in one 3x3 stencil pass (replacement for the
+    Slope + Raster Calculator steps of HGVC10_rrm_test.py section D and the per-block
+    Curvature_3d of section O).
+
+    The DEM is read in blocks of rows, each with one extra row above and below (the halo)
+    so the stencil of every cell sees its true neighbours; the eight neighbour grids of a
+    block are formed once and shared by every product:
+
+        slope_pct   Horn (1981) slope in percent rise, as Slope(PERCENT_RISE)
+        slope_dec   slope_pct / 100 (decimal slope, all_slp_100)
+        curvature   total curvature, -2 (D + E) * 100
+        profile     profile curvature, 2 (D G^2 + E H^2 + F G H) / (G^2 + H^2) * 100
+        planform    plan curvature, -2 (D H^2 + E G^2 - F G H) / (G^2 + H^2) * 100
+
+    with D, E, F, G, H the Zevenbergen and Thorne (1987) coefficients ArcGIS Curvature
+    uses.  As in map_algebra.slope, NoData and off-raster neighbours take the value of the
+    centre cell; NoData cells stay NoData (NaN).  Computed on the whole DEM, block edges no
+    longer pick up the artefacts of a DEM clipped to the block.
+__________________________________________________________________________________________________
+'''
+
+import numpy
+
+PRODUCTS = ("slope_pct", "slope_dec", "curvature", "profile", "planform")
+
+
+def _read(source, r0, r1):
+    # Rows r0..r1-1 of an array or block reader (raster_io.RasterRows)
+    if hasattr(source, 'read_rows'):
+        return source.read_rows(r0, r1)
+    return numpy.asarray(source[r0:r1])
+
+
+def stencil(zp, cell_size, products=PRODUCTS, z_factor=1.0):
+    '''Terrain derivatives of the interior of a block zp padded with a one-cell halo.
+
+    zp      float array with one row/column of neighbours (NaN where off the raster) on
+            every side of the cells to compute
+    Returns {product: float32 array of the interior cells}.
+    '''
+    zp = numpy.asarray(zp, dtype=numpy.float64) * z_factor
+    nrows = zp.shape[0] - 2
+    ncols = zp.shape[1] - 2
+    z = zp[1:-1, 1:-1]
+
+    def nb(dr, dc):
+        # Neighbour grid with NoData/off-raster cells replaced by the centre cell
+        n = zp[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        return numpy.where(numpy.isnan(n), z, n)
+
+    a, b, c = nb(-1, -1), nb(-1, 0), nb(-1, 1)
+    d, f = nb(0, -1), nb(0, 1)
+    g, h, i = nb(1, -1), nb(1, 0), nb(1, 1)
+    L = float(cell_size)
+    out = {}
+
+    if "slope_pct" in products or "slope_dec" in products:
+        dzdx = ((c + 2.0 * f + i) - (a + 2.0 * d + g)) / (8.0 * L)
+        dzdy = ((g + 2.0 * h + i) - (a + 2.0 * b + c)) / (8.0 * L)
+        pct = numpy.sqrt(dzdx * dzdx + dzdy * dzdy) * 100.0
+        pct[numpy.isnan(z)] = numpy.nan     # Horn's differences leave out the centre cell
+        if "slope_pct" in products:
+            out["slope_pct"] = pct.astype(numpy.float32)
+        if "slope_dec" in products:
+            out["slope_dec"] = (pct / 100.0).astype(numpy.float32)
+
+    if "curvature" in products or "profile" in products or "planform" in products:
+        D = ((d + f) / 2.0 - z) / (L * L)
+        E = ((b + h) / 2.0 - z) / (L * L)
+        if "curvature" in products:
+            out["curvature"] = (-2.0 * (D + E) * 100.0).astype(numpy.float32)
+        if "profile" in products or "planform" in products:
+            F = (-a + c + g - i) / (4.0 * L * L)
+            G = (-d + f) / (2.0 * L)
+            H = (b - h) / (2.0 * L)
+            GG = G * G
+            HH = H * H
+            denom = GG + HH
+            flat = denom == 0     # No aspect: profile and plan curvature are 0
+            denom[flat] = 1.0
+            if "profile" in products:
+                prof = 2.0 * (D * GG + E * HH + F * G * H) / denom * 100.0
+                prof[flat & ~numpy.isnan(z)] = 0.0
+                out["profile"] = prof.astype(numpy.float32)
+            if "planform" in products:
+                plan = -2.0 * (D * HH + E * GG - F * G * H) / denom * 100.0
+                plan[flat & ~numpy.isnan(z)] = 0.0
+                out["planform"] = plan.astype(numpy.float32)
+    return out
+
+
+def derivatives(source, shape, cell_size, products=PRODUCTS, chunk_rows=1024, z_factor=1.0):
+    '''Terrain derivatives of a whole DEM, computed chunk_rows rows at a time.
+
+    source  DEM array, or block reader with read_rows(r0, r1) (raster_io.RasterRows)
+    shape   (nrows, ncols) of the DEM
+    Returns {product: full float32 grid} for the requested products (see PRODUCTS).
+    '''
+    nrows, ncols = shape
+    outs = dict((p, numpy.empty((nrows, ncols), dtype=numpy.float32)) for p in products)
+    for r0 in range(0, nrows, chunk_rows):
+        r1 = min(r0 + chunk_rows, nrows)
+        h0 = max(r0 - 1, 0)
+        h1 = min(r1 + 1, nrows)
+        zp = numpy.empty((r1 - r0 + 2, ncols + 2))
+        zp.fill(numpy.nan)
+        zp[1 - (r0 - h0):1 + (h1 - r0), 1:-1] = _read(source, h0, h1)
+        for p, block in stencil(zp, cell_size, products, z_factor).items():
+            outs[p][r0:r1] = block
+    return outs
@@ -0,0 +1,15 @@
+import numpy
+
+import dem_fill
+
+
+def test_epsilon_survives_float32_dem():
+    dem = numpy.empty((7, 7), dtype=numpy.float32)
+    dem.fill(2100.0)
+    dem[1:-1, 1:-1] = 1990.0
+    dem[3, 0] = 2000.0      # Outlet
+    filled = dem_fill.fill_depressions(dem, 1e-5)
+    assert filled.dtype == numpy.float64
+    assert numpy.allclose(filled[3, 1], 2000.00001)
+    assert filled[3, 2] > filled[3, 1]
+    assert dem_fill.fill_depressions(dem).dtype == numpy.float32
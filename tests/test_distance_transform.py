@@ -0,0 +1,24 @@
+import numpy
+
+import distance_transform
+
+
+def test_edt_matches_nearest_source():
+    rng = numpy.random.RandomState(0)
+    for shape, density in (((13, 17), 0.05), ((1, 9), 0.3), ((20, 6), 0.01), ((8, 8), 0.9)):
+        src = rng.uniform(size=shape) < density
+        src[rng.randint(shape[0]), rng.randint(shape[1])] = True
+        dist, (rows, cols) = distance_transform.edt(src, 10.0, return_indices=True)
+        sr, sc = numpy.nonzero(src)
+        for r in range(shape[0]):
+            for c in range(shape[1]):
+                nearest = numpy.hypot(sr - r, sc - c).min() * 10.0
+                assert numpy.isclose(dist[r, c], nearest)
+                assert src[rows[r, c], cols[r, c]]
+                assert numpy.isclose(numpy.hypot(rows[r, c] - r, cols[r, c] - c) * 10.0, nearest)
+
+
+def test_edt_no_source():
+    dist, (rows, cols) = distance_transform.edt(numpy.zeros((4, 5), dtype=bool), return_indices=True)
+    assert numpy.isnan(dist).all()
+    assert (rows == -1).all() and (cols == -1).all()
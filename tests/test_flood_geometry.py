@@ -0,0 +1,87 @@
+import numpy
+
+import flood_geometry
+
+
+def _block():
+    src = numpy.zeros((80, 80), dtype=bool)
+    src[40, 10:70] = True
+    slope = numpy.empty((80, 80))
+    slope.fill(0.05)
+    return src, slope
+
+
+def test_geometry_matches_flooded_cells():
+    src, slope = _block()
+    table = flood_geometry.stage_table(src, slope, 10.0)
+    hac = flood_geometry.cost_distance(src, slope, 10.0)
+    for d in (0.0, 0.1, 0.25, 0.5, 1.0, 3.7):
+        wet = hac <= d
+        area_2d, area_3d, volume = table.geometry(d)
+        assert numpy.isclose(area_2d, wet.sum() * 100.0)
+        assert numpy.isclose(area_2d * d - volume, ((d - hac[wet]) * 100.0).sum())
+        assert area_2d * d - volume >= 0.0
+        assert wet.sum() == table.extent_grid(d).sum()
+
+
+def test_manning_discharge_small_depth():
+    # Between two stages the cross-section area must not go negative
+    src, slope = _block()
+    table = flood_geometry.stage_table(src, slope, 10.0)
+    q = flood_geometry.manning_discharge(table, 0.1, 600.0, 0.01, 0.05)
+    assert isinstance(q, float) and q >= 0.0
+    depth, q, n, resid, status = flood_geometry.solve_depth(table, 50.0, 600.0, 0.01, 0.05, 0.1, 0.05)
+    assert status == "converged"
+
+
+def _relaxed_cost(sources, cost, cell_size):
+    # Bellman-Ford: relax every cell over its 8 neighbours until nothing improves
+    nrows, ncols = cost.shape
+    dist = numpy.where(sources & ~numpy.isnan(cost), 0.0, numpy.inf)
+    changed = True
+    while changed:
+        changed = False
+        for r in range(nrows):
+            for c in range(ncols):
+                if numpy.isnan(cost[r, c]):
+                    continue
+                for dr in (-1, 0, 1):
+                    for dc in (-1, 0, 1):
+                        rr, cc = r + dr, c + dc
+                        if not (dr or dc) or not (0 <= rr < nrows and 0 <= cc < ncols):
+                            continue
+                        step = 0.5 * numpy.hypot(dr, dc) * cell_size * (cost[r, c] + cost[rr, cc])
+                        if dist[rr, cc] + step < dist[r, c] - 1e-12:    # NaN cost never passes
+                            dist[r, c] = dist[rr, cc] + step
+                            changed = True
+    return numpy.where(numpy.isinf(dist), numpy.nan, dist)
+
+
+def test_cost_distance_max_cost():
+    rng = numpy.random.RandomState(0)
+    cost = rng.uniform(0.01, 0.2, (15, 18))
+    cost[7, 2:14] = numpy.nan       # Barrier
+    src = numpy.zeros(cost.shape, dtype=bool)
+    src[2, 3] = src[12, 15] = True
+    expected = _relaxed_cost(src, cost, 10.0)
+    full = flood_geometry.cost_distance(src, cost, 10.0)
+    assert numpy.array_equal(numpy.isnan(full), numpy.isnan(expected))
+    assert numpy.allclose(full[~numpy.isnan(full)], expected[~numpy.isnan(expected)])
+    for max_cost in (0.0, 1.5, 4.0):
+        cut = flood_geometry.cost_distance(src, cost, 10.0, max_cost)
+        reached = ~numpy.isnan(cut)
+        assert numpy.array_equal(reached, numpy.where(numpy.isnan(full), numpy.inf, full) <= max_cost)
+        assert numpy.array_equal(cut[reached], full[reached])
+
+
+def test_solve_depth_beyond_table():
+    # A search cut off below the solved depth is reported, not taken as converged
+    src, slope = _block()
+    table = flood_geometry.stage_table(src, slope, 10.0, 0.2)
+    depth, q, n, resid, status = flood_geometry.solve_depth(table, 500.0, 600.0, 0.01, 0.05, 0.1, 0.05)
+    assert depth > table.max_depth and status == "beyond_table"
+    deeper = flood_geometry.deepen(table, src, slope, 10.0, 2.0 * depth)
+    assert deeper.max_depth >= 2.0 * depth
+    assert flood_geometry.deepen(deeper, src, slope, 10.0, depth) is deeper
+    depth, q, n, resid, status = flood_geometry.solve_depth(deeper, 500.0, 600.0, 0.01, 0.05, 0.1, 0.05)
+    assert status == "converged" and depth <= deeper.max_depth
@@ -0,0 +1,135 @@
+import numpy
+
+import flow_routing
+
+
+def _dem(nrows=23, ncols=31, seed=0):
+    # Tilted south-east with noise smaller than the tilt: no pits, no flats, few ties
+    rng = numpy.random.RandomState(seed)
+    rows, cols = numpy.mgrid[0:nrows, 0:ncols]
+    return 100.0 - 1.0 * rows - 0.3 * cols + rng.uniform(0.0, 0.2, (nrows, ncols))
+
+
+def _down(fdir, r, c):
+    # Cell (r, c) drains to, or None where the flow leaves the grid or enters NoData
+    code = int(fdir[r, c])
+    if code == 0:
+        return None
+    dr, dc = flow_routing.D8_OFFSETS[flow_routing.D8_CODES.index(code)]
+    rr, cc = r + dr, c + dc
+    if not (0 <= rr < fdir.shape[0] and 0 <= cc < fdir.shape[1]) or fdir[rr, cc] == 0:
+        return None
+    return rr, cc
+
+
+def _brute_direction(dem):
+    nrows, ncols = dem.shape
+    fdir = numpy.zeros(dem.shape, dtype=numpy.uint8)
+    for r in range(nrows):
+        for c in range(ncols):
+            if numpy.isnan(dem[r, c]):
+                continue
+            best, code, outward = 0.0, 0, 0
+            for k, (dr, dc) in enumerate(flow_routing.D8_OFFSETS):
+                rr, cc = r + dr, c + dc
+                if not (0 <= rr < nrows and 0 <= cc < ncols) or numpy.isnan(dem[rr, cc]):
+                    continue
+                drop = (dem[r, c] - dem[rr, cc]) / flow_routing.D8_DISTANCE[k]
+                if drop > best:
+                    best, code = drop, flow_routing.D8_CODES[k]
+            if code == 0:
+                for k in flow_routing._OUTWARD_ORDER:
+                    dr, dc = flow_routing.D8_OFFSETS[k]
+                    rr, cc = r + dr, c + dc
+                    if not (0 <= rr < nrows and 0 <= cc < ncols) or numpy.isnan(dem[rr, cc]):
+                        outward = flow_routing.D8_CODES[k]
+                        break
+                code = outward
+            fdir[r, c] = code
+    return fdir
+
+
+def _brute_accumulation(fdir):
+    facc = numpy.zeros(fdir.shape)
+    for r in range(fdir.shape[0]):
+        for c in range(fdir.shape[1]):
+            cell = _down(fdir, r, c) if fdir[r, c] else None
+            while cell is not None:
+                facc[cell] += 1.0
+                cell = _down(fdir, *cell)
+    facc[fdir == 0] = numpy.nan
+    return facc
+
+
+def test_flow_direction_steepest_drop():
+    dem = _dem()
+    dem[5:8, 10:14] = numpy.nan     # NoData hole: its neighbours may flow into it
+    fdir = flow_routing.flow_direction(dem)
+    assert numpy.array_equal(fdir, _brute_direction(dem))
+
+
+def test_flow_direction_routes_flats_off_the_grid():
+    dem = numpy.empty((9, 12))
+    dem.fill(50.0)
+    dem[0, :] = 60.0
+    dem[:, 0] = 60.0
+    dem[:, -1] = 60.0
+    dem[-1, 4] = 49.0               # Only outlet of the flat
+    fdir = flow_routing.flow_direction(dem)
+    assert (fdir > 0).all()
+    for r in range(dem.shape[0]):
+        for c in range(dem.shape[1]):
+            cell, steps = (r, c), 0
+            while cell is not None:
+                steps += 1
+                assert steps <= dem.size
+                cell = _down(fdir, *cell)
+
+
+def test_flow_accumulation_counts_upstream_cells():
+    dem = _dem(seed=1)
+    dem[12:14, 3:9] = numpy.nan
+    fdir = flow_routing.flow_direction(dem)
+    facc = flow_routing.flow_accumulation(fdir)
+    assert facc.dtype == numpy.float32
+    assert numpy.array_equal(numpy.isnan(facc), fdir == 0)
+    assert numpy.array_equal(facc[fdir > 0], _brute_accumulation(fdir)[fdir > 0])
+
+
+def test_tiled_matches_untiled(tmpdir):
+    dem = _dem(37, 29, seed=2)
+    dem[20:23, 5:12] = numpy.nan
+    fdir = flow_routing.flow_direction(dem)
+    expected = flow_routing.flow_accumulation(fdir)
+    fdir_path = str(tmpdir.join('fdir.npy'))
+    numpy.save(fdir_path, fdir)
+    for tile_size in (1, 4, 7, 10, 64):
+        facc_path = str(tmpdir.join('facc_%d.npy' % tile_size))
+        strm_path = str(tmpdir.join('strm_%d.npy' % tile_size))
+        flow_routing.tiled_flow_accumulation(fdir_path, facc_path, tile_size, processes=1,
+                                             threshold=20.0, strm_path=strm_path)
+        facc = numpy.load(facc_path)
+        assert numpy.array_equal(numpy.isnan(facc), numpy.isnan(expected))
+        assert numpy.array_equal(facc[fdir > 0], expected[fdir > 0])
+        assert numpy.array_equal(numpy.load(strm_path) == 1, numpy.nan_to_num(expected) > 20.0)
+
+
+def test_watershed_labels_first_seed_downstream():
+    dem = _dem(seed=3)
+    fdir = flow_routing.flow_direction(dem)
+    rng = numpy.random.RandomState(3)
+    seed_idx = rng.choice(fdir.size, 25, replace=False)
+    seed_labels = numpy.arange(1, 26)
+    labels = flow_routing.watershed(fdir, seed_idx, seed_labels)
+    seeds = dict(zip(seed_idx.tolist(), seed_labels.tolist()))
+    ncols = fdir.shape[1]
+    expected = numpy.zeros(fdir.shape, dtype=numpy.int32)
+    for r in range(fdir.shape[0]):
+        for c in range(ncols):
+            cell = (r, c)
+            while cell is not None and cell[0] * ncols + cell[1] not in seeds:
+                cell = _down(fdir, *cell)
+            if cell is not None:
+                expected[r, c] = seeds[cell[0] * ncols + cell[1]]
+    assert labels.dtype == numpy.int32
+    assert numpy.array_equal(labels, expected)
@@ -0,0 +1,107 @@
+import numpy
+
+import flow_routing
+import raster_io
+import stream_network
+
+
+def _network(seed=0, threshold=8.0):
+    rng = numpy.random.RandomState(seed)
+    rows, cols = numpy.mgrid[0:25, 0:30]
+    dem = 100.0 - 1.0 * rows - 0.3 * cols + rng.uniform(0.0, 0.9, rows.shape)
+    fdir = flow_routing.flow_direction(dem)
+    strm = (flow_routing.flow_accumulation(fdir) > threshold).astype(numpy.uint8)
+    return fdir, strm
+
+
+def _down(fdir, strm, i):
+    # Stream cell the stream cell of flat index i drains to, or None
+    ncols = fdir.shape[1]
+    dr, dc = flow_routing.D8_OFFSETS[flow_routing.D8_CODES.index(int(fdir.flat[i]))]
+    r, c = i // ncols + dr, i % ncols + dc
+    if 0 <= r < fdir.shape[0] and 0 <= c < ncols and strm[r, c] and fdir[r, c]:
+        return r * ncols + c
+    return None
+
+
+def test_stream_links_follow_streamlink():
+    fdir, strm = _network()
+    cells = stream_network.StreamCells(fdir, strm)
+    idx = cells.idx.tolist()
+    ups = dict((i, []) for i in idx)
+    for i in idx:
+        j = _down(fdir, strm, i)
+        if j is not None:
+            ups[j].append(i)
+    starts = [i for i in idx if len(ups[i]) != 1]    # Raster order, as idx is sorted
+    labels = stream_network.stream_links(cells)
+    for i, label in zip(idx, labels.tolist()):
+        while len(ups[i]) == 1:
+            i = ups[i][0]
+        assert label == starts.index(i) + 1
+    assert labels.max() == len(starts) > 1
+
+
+def test_region_group_matches_flood_fill():
+    rng = numpy.random.RandomState(1)
+    shape = (20, 25)
+    listed = rng.uniform(size=shape) < 0.6
+    grid = numpy.where(listed, rng.randint(1, 4, shape), 0)
+    idx = numpy.flatnonzero(listed)
+    labels, counts, link = stream_network.region_group(shape, idx, grid.ravel()[idx])
+
+    # Flood fill of equal 8-connected values, regions numbered in raster order
+    expected = numpy.zeros(shape, dtype=numpy.int64)
+    n = 0
+    for r0, c0 in zip(*numpy.nonzero(listed)):
+        if expected[r0, c0]:
+            continue
+        n += 1
+        expected[r0, c0] = n
+        queue = [(r0, c0)]
+        while queue:
+            r, c = queue.pop()
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    rr, cc = r + dr, c + dc
+                    if (0 <= rr < shape[0] and 0 <= cc < shape[1] and listed[rr, cc] and
+                            not expected[rr, cc] and grid[rr, cc] == grid[r, c]):
+                        expected[rr, cc] = n
+                        queue.append((rr, cc))
+    assert numpy.array_equal(labels, expected.ravel()[idx])
+    assert numpy.array_equal(counts[1:], numpy.bincount(expected.ravel()[idx])[1:])
+    for k in range(1, n + 1):
+        assert link[k] == grid[expected == k][0]
+
+
+def test_link_rank_counts_steps_from_link_start():
+    fdir, strm = _network(seed=2)
+    cells = stream_network.StreamCells(fdir, strm)
+    rank = stream_network.link_rank(cells)
+    starts = cells.up_count != 1
+    for p in range(cells.size):
+        q, steps = p, 0
+        while not starts[q]:
+            q = numpy.flatnonzero(cells.down == q)[0]   # The one upstream stream cell
+            steps += 1
+        assert rank[p] == steps
+
+
+def test_segment_polylines_trace_runs():
+    # Stream of 4 cells: east, south-east, east, then east off the grid; two segments
+    fdir = numpy.zeros((2, 4), dtype=numpy.uint8)
+    fdir[0, 0], fdir[0, 1], fdir[1, 2], fdir[1, 3] = 1, 2, 1, 1
+    cells = stream_network.StreamCells(fdir, fdir > 0)
+    links = stream_network.stream_links(cells)
+    segments = numpy.array([1, 1, 2, 2])
+    grid_code = numpy.array([0, 3, 2])
+    info = raster_io.RasterInfo(1000.0, 2000.0, 10.0, 2, 4)
+    lines, arcids = stream_network.segment_polylines(cells, links, segments, grid_code, info)
+    assert [l[:2] for l in lines] == [(1, 3), (2, 2)]
+    assert numpy.isclose(lines[0][2], 10.0 + 10.0 * numpy.sqrt(2.0))
+    assert numpy.isclose(lines[1][2], 10.0)
+    assert lines[0][3] == [(1005.0, 2015.0), (1015.0, 2015.0), (1025.0, 2005.0)]
+    assert lines[1][3] == [(1025.0, 2005.0), (1035.0, 2005.0)]
+    assert arcids.tolist() == [1, 1, 2, 2]
+    lines, arcids = stream_network.segment_polylines(cells, links, segments, grid_code, info, 10.0)
+    assert [l[0] for l in lines] == [1] and arcids.tolist() == [1, 1, 0, 0]
@@ -0,0 +1,50 @@
+import numpy
+
+import terrain
+
+
+def _padded(z):
+    zp = numpy.empty((z.shape[0] + 2, z.shape[1] + 2))
+    zp.fill(numpy.nan)
+    zp[1:-1, 1:-1] = z
+    return zp
+
+
+def test_plane():
+    # z = 0.2 x - 0.05 y: Horn slope is the exact gradient, curvature is 0
+    cell = 10.0
+    rows, cols = numpy.mgrid[0:12, 0:15]
+    z = 500.0 + 0.2 * cols * cell + 0.05 * rows * cell
+    out = terrain.stencil(_padded(z), cell, ("slope_pct", "slope_dec", "curvature"))
+    inner = (slice(1, -1), slice(1, -1))
+    assert numpy.allclose(out["slope_pct"][inner], 100.0 * numpy.hypot(0.2, 0.05), rtol=1e-6)
+    assert numpy.allclose(out["slope_dec"][inner], numpy.hypot(0.2, 0.05), rtol=1e-6)
+    assert numpy.allclose(out["curvature"][inner], 0.0, atol=1e-4)
+
+
+def test_paraboloid():
+    # z = k (x^2 + y^2): D = E = k, so the ArcGIS total curvature -2 (D + E) * 100 is -400 k,
+    # and the Horn differences of a quadratic are exact, slope = 2 k r
+    cell, k = 5.0, 0.003
+    rows, cols = numpy.mgrid[0:11, 0:13]
+    x = (cols - 6) * cell
+    y = (5 - rows) * cell
+    z = 100.0 + k * (x * x + y * y)
+    out = terrain.stencil(_padded(z), cell)
+    inner = (slice(1, -1), slice(1, -1))
+    assert numpy.allclose(out["curvature"][inner], -400.0 * k, rtol=1e-4)
+    assert numpy.allclose(out["slope_pct"][inner], (200.0 * k * numpy.hypot(x, y))[inner],
+                          rtol=1e-5, atol=1e-5)
+
+
+def test_derivatives_chunks_see_their_neighbours():
+    rng = numpy.random.RandomState(0)
+    dem = rng.uniform(100.0, 120.0, (17, 9))
+    dem[4, 3] = numpy.nan
+    whole = terrain.derivatives(dem, dem.shape, 10.0)
+    chunked = terrain.derivatives(dem, dem.shape, 10.0, chunk_rows=4)
+    valid = ~numpy.isnan(dem)
+    for p in terrain.PRODUCTS:
+        assert numpy.array_equal(numpy.isnan(whole[p]), ~valid)
+        assert numpy.array_equal(numpy.isnan(chunked[p]), ~valid)
+        assert numpy.array_equal(whole[p][valid], chunked[p][valid])
@@ -0,0 +1,121 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: threshold_sweep
+Description: Channel-initiation threshold sweep for ValleySegs_rrm_test.py.
+
+    The filled DEM, flow direction and flow accumulation do not depend on DA_Threshold, so
+    they are computed once and saved as .npy files.  For every threshold a worker process
+    then memory-maps them and runs the threshold-dependent tail of ValleySegs with the NumPy
+    engines: stream cells (facc > threshold), link slope classes, segment grouping, segment
+    tracing (short segments dropped) and segment watersheds, and writes a complete workspace
+    for HGVC (fdem, da_km, strm, segs, blks).  The workers share the memory-mapped grids
+    through the page cache, so each only holds the arrays of its own network.
+
+    A summary table (csv) lists, per threshold, the workspace, the number of stream cells,
+    the number of segments and their total length.
+
+    NOTE: on Windows the pool re-imports the calling script, which must therefore keep its
+    processing under an "if __name__ == '__main__':" guard.
+__________________________________________________________________________________________________
+'''
+
+import csv
+import multiprocessing
+import os
+
+import numpy
+
+import flow_routing
+import raster_io
+import stream_network
+import vector_io
+
+SUMMARY_FIELDS = ("DA_Threshold", "Workspace", "Stream_cells", "Segments", "Total_length_m")
+
+
+def _sweep_tail(task):
+    # Worker: the threshold-dependent part of ValleySegs for one threshold
+    npy_prefix, template, threshold, min_seg_length, workspace, root, shared = task
+    import arcpy
+    info = raster_io.describe_raster(template)
+    for folder in (workspace, workspace + '/temp'):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    # Threshold-independent products HGVC reads from the workspace
+    for name in ("_fdem", "_da_km"):
+        arcpy.CopyRaster_management(shared + '/' + root + name, workspace + '/' + root + name)
+
+    fdem = numpy.load(npy_prefix + "_fdem.npy", mmap_mode='r')
+    fdir = numpy.load(npy_prefix + "_fdir.npy", mmap_mode='r')
+    facc = numpy.load(npy_prefix + "_facc.npy", mmap_mode='r')
+
+    # Stream cells, link slope classes and segments
+    with numpy.errstate(invalid='ignore'):
+        strm = (facc > threshold).astype(numpy.uint8)
+    raster_io.write_raster(strm, info, workspace + '/' + root + "_strm")
+    cls, cells, links = stream_network.segment_slope_classes(fdem, fdir, strm, info.cell_size)
+    del strm
+    cls_values = cls.ravel()[cells.idx]
+    del cls
+    on_cls = cls_values > 0
+    seg_labels, seg_counts, seg_link = stream_network.region_group(info.shape, cells.idx[on_cls],
+                                                                   cls_values[on_cls])
+    cell_segs = numpy.zeros(cells.size, dtype=numpy.int64)
+    cell_segs[on_cls] = seg_labels
+    lines, arcids = stream_network.segment_polylines(cells, links, cell_segs, seg_link, info,
+                                                     min_seg_length)
+    vector_io.write_polylines(workspace + '/' + root + "_segs.shp", lines,
+                              [("ARCID", "LONG"), ("GRID_CODE", "LONG"), ("SLength", "FLOAT")],
+                              info.spatial_reference)
+
+    # Valley blocks: watershed of every segment
+    on_seg = arcids > 0
+    ws = flow_routing.watershed(fdir, cells.idx[on_seg], arcids[on_seg])
+    raster_io.write_raster(ws, info, workspace + '/temp/val_seg_ws')
+    del ws
+    arcpy.RasterToPolygon_conversion(workspace + '/temp/val_seg_ws', workspace + '/temp/valley_bl_sh.shp',
+                                     "NO_SIMPLIFY", "VALUE")
+    arcpy.Dissolve_management(workspace + '/temp/valley_bl_sh.shp', workspace + '/' + root + "_blks.shp",
+                              "GRIDCODE")
+
+    return (threshold, workspace, int(cells.size), len(lines), sum(line[2] for line in lines))
+
+
+def sweep(thresholds, fdem, fdir, facc, info, folder, root, min_seg_length=50.0, processes=None):
+    '''Run the ValleySegs tail for every threshold in thresholds, one workspace each.
+
+    fdem, fdir, facc  threshold-independent grids (arrays)
+    info              raster_io.RasterInfo of the grids
+    folder            sweep folder; must already hold root_fdem and root_da_km (copied into
+                      every workspace).  Threshold t is written to folder/T<t>.
+    processes         worker processes (None = all cores, 1 = run in this process)
+
+    Returns the summary rows (see SUMMARY_FIELDS), also written to folder/root_sweep.csv.
+    '''
+    npy_prefix = folder + '/temp/' + root
+    if not os.path.isdir(folder + '/temp'):
+        os.makedirs(folder + '/temp')
+    numpy.save(npy_prefix + "_fdem.npy", fdem)
+    numpy.save(npy_prefix + "_fdir.npy", fdir)
+    numpy.save(npy_prefix + "_facc.npy", facc)
+
+    template = folder + '/' + root + "_fdem"
+    tasks = [(npy_prefix, template, t, min_seg_length, folder + '/T' + str(t), root, folder)
+             for t in thresholds]
+    if processes == 1:
+        rows = [_sweep_tail(t) for t in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            rows = pool.map(_sweep_tail, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    with open(folder + '/' + root + "_sweep.csv", 'w') as fh:
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(SUMMARY_FIELDS)
+        writer.writerows(rows)
+    return rows
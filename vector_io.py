@@ -0,0 +1,164 @@
+'''
+_________________________________________________________________________________________________
+
+Module Name: vector_io
+Description: Helpers for writing features built in Python straight to a feature class in one
+    pass (one CreateFeatureclass, one AddField per attribute and one insert cursor), instead of
+    writing a shapefile with an arcpy tool and then rewriting it to add or remove fields and
+    features, and an in-memory store of the features of a shapefile keyed by ID.
+__________________________________________________________________________________________________
+'''
+
+import os
+
+
+# ESRI field types (arcpy.ListFields) -> AddField types
+FIELD_TYPES = {'SmallInteger': "SHORT", 'Integer': "LONG", 'Single': "FLOAT", 'Double': "DOUBLE",
+               'String': "TEXT", 'Date': "DATE"}
+
+
+def _create(out_path, geometry_type, fields, spatial_reference):
+    # New empty feature class (shapefile or in_memory) with the given attribute fields
+    import arcpy
+    if arcpy.Exists(out_path):
+        arcpy.Delete_management(out_path)
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_path), os.path.basename(out_path),
+                                        geometry_type, "", "DISABLED", "DISABLED", spatial_reference)
+    for name, field_type in fields:
+        arcpy.AddField_management(out_path, name, field_type)
+    try:
+        arcpy.DeleteField_management(out_path, "Id")    # Default field of a new shapefile
+    except:
+        pass
+
+
+def write_polylines(out_path, lines, fields, spatial_reference=None):
+    '''Write polylines to a new shapefile.
+
+    out_path    .shp to create (overwritten if it exists)
+    lines       list of records (value_1, ..., value_n, [(x, y), ...]), the values in the
+                order of fields
+    fields      list of (name, type) for the attribute fields, e.g. [("ARCID", "LONG")]
+    '''
+    import arcpy
+    _create(out_path, "POLYLINE", fields, spatial_reference)
+    rows = arcpy.InsertCursor(out_path)
+    point = arcpy.Point()
+    for record in lines:
+        vertices = arcpy.Array()
+        for x, y in record[-1]:
+            point.X = x
+            point.Y = y
+            vertices.add(point)
+        row = rows.newRow()
+        row.shape = arcpy.Polyline(vertices)
+        for (name, field_type), value in zip(fields, record[:-1]):
+            row.setValue(name, value)
+        rows.insertRow(row)
+    del rows
+    return out_path
+
+
+def write_geometries(out_path, geometry_type, records, fields, spatial_reference=None):
+    '''Write arcpy geometries to a new feature class (e.g. "in_memory/block").
+
+    records     list of (value_1, ..., value_n, geometry), the values in the order of fields
+    '''
+    import arcpy
+    _create(out_path, geometry_type, fields, spatial_reference)
+    rows = arcpy.InsertCursor(out_path)
+    for record in records:
+        row = rows.newRow()
+        row.shape = record[-1]
+        for (name, field_type), value in zip(fields, record[:-1]):
+            row.setValue(name, value)
+        rows.insertRow(row)
+    del rows
+    return out_path
+
+
+def geometry_parts(geometry):
+    '''Vertex lists [(x, y), ...] of an arcpy polyline or polygon: one per path of a line, one
+    per ring (outer boundary or hole) of a polygon.'''
+    parts = []
+    for i in range(geometry.partCount):
+        part = geometry.getPart(i)
+        ring = []
+        for j in range(part.count):
+            point = part.getObject(j)
+            if point is None:   # Separator before an interior ring
+                if ring:
+                    parts.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if ring:
+            parts.append(ring)
+    return parts
+
+
+def feature_box(geometry):
+    '''(xmin, ymin, xmax, ymax) of the extent of an arcpy geometry.'''
+    ext = geometry.extent
+    return ext.XMin, ext.YMin, ext.XMax, ext.YMax
+
+
+def boxes_overlap(a, b, margin=0.0):
+    '''True if box a intersects box b grown by margin (boxes as (xmin, ymin, xmax, ymax)).'''
+    return (a[0] <= b[2] + margin and a[2] >= b[0] - margin and
+            a[1] <= b[3] + margin and a[3] >= b[1] - margin)
+
+
+def extent_string(box, margin=0.0):
+    '''"xmin ymin xmax ymax" of box grown by margin, as taken by arcpy.env.extent.'''
+    return ' '.join([repr(float(v)) for v in (box[0] - margin, box[1] - margin,
+                                               box[2] + margin, box[3] + margin)])
+
+
+class FeatureStore(object):
+    '''The features of a feature class held in memory, keyed by an ID field (e.g. ARCID).
+
+    Read with one cursor pass; write(key, out_path) hands a single feature (geometry and
+    fields) to a geoprocessing tool as an in_memory feature class, instead of selecting it
+    out of the source into its own shapefile.
+
+    keys      IDs in source order
+    geometry  {ID: arcpy geometry}
+    values    {ID: tuple of the values of fields}
+    '''
+
+    def __init__(self, source, key_field, fields=()):
+        import arcpy
+        desc = arcpy.Describe(source)
+        self.geometry_type = desc.shapeType.upper()
+        self.spatial_reference = desc.spatialReference
+        types = dict((f.name, FIELD_TYPES.get(f.type, "DOUBLE")) for f in arcpy.ListFields(source))
+        self.key_field = key_field
+        self.fields = [(key_field, types[key_field])] + [(name, types[name]) for name in fields]
+        self.keys = []
+        self.geometry = {}
+        self.values = {}
+        cursor = arcpy.SearchCursor(source)
+        row = cursor.next()
+        while row:
+            key = int(row.getValue(key_field))
+            self.keys.append(key)
+            self.geometry[key] = row.getValue(desc.shapeFieldName)
+            self.values[key] = tuple([row.getValue(name) for name in fields])
+            row = cursor.next()
+        del row, cursor
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.geometry
+
+    def __getitem__(self, key):
+        return self.geometry[key]
+
+    def write(self, key, out_path):
+        '''Write the feature with ID key (and its fields) to out_path; returns out_path.'''
+        record = (key,) + self.values[key] + (self.geometry[key],)
+        return write_geometries(out_path, self.geometry_type, [record], self.fields,
+                                self.spatial_reference)